@@ -1,72 +1,54 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 import os, sys
 import time
 import logging
-import ConfigParser
 import json
 from argparse import ArgumentParser
 
-import Adafruit_DHT
 from rcswitch import RCSwitch
 import solarcalc
-
-argParser = ArgumentParser(description='Monitor and attemt to manage an environment')
-argParser.add_argument("-v","--verbose",dest="verbose",action="store_true",default=False,
-                    help="output verbose log messages")
-argParser.add_argument("-d","--debug",dest="debug",action="store_true",default=False,
-                    help="output debug log messages")
-argParser.add_argument("-c","--config",dest="config",default="EnvironmentManager.cfg",
-                    metavar="CONFIG",help="use configuration from CONFIG file (ConfigParser compatible)")
-argParser.add_argument("-l","--logfile",dest="logfile",default="EnvironmentManager.log",
-                    metavar="LOGFILE",help="output logging to LOGFILE")
-
-options = argParser.parse_args()
-
-if options.debug == True:
-    logLevel = logging.DEBUG
-elif options.verbose == True:
-    logLevel = logging.INFO
-else:
-    logLevel = logging.WARN
+import channelregistry
+import lightsconfig
+import rfarbiter
 
 logger = logging.getLogger()
-logger.setLevel(logLevel)
-
-logFd = None
-try:
-    logFd = open(options.logfile,"w",0)
-except Exception as e:
-    sys.stderr.write("Unable to open logfile '%s': %s\n"%(options.logfile,e))
-    sys.exit(1)
-if logFd is None:
-    sys.stderr.write("Unabled to get logfile file descriptor. Aborting.\n")
-    sys.exit(1)
-ch = logging.StreamHandler(logFd)
-ch.setLevel(logLevel)
-
-fh = logging.Formatter("[%(asctime)s] %(levelname)s: %(filename)s:%(funcName)s:%(lineno)d - %(message)s")
-ch.setFormatter(fh)
-logger.addHandler(ch)
-
-cfgParser = ConfigParser.ConfigParser()
-config = None
-if options.config is not None:
-    try:
-        config = cfgParser.read(options.config)
-    except Exception as e:
-        logger.error("Enable to read config file '%s': %s",options.config,e)
-else:
-    logger.error("No configuration file specified and default not found. Aborting.")
-    sys.exit(1)
 
 class EnvironmentManager():
 
     def __init__(self,config):
         self.config = config
+        self.registry = channelregistry.ChannelRegistry.from_config(config)
+        self.switch = None
         self.updateTimes()
         pass
 
+    def setChannel(self,name,state):
+        '''
+        Send the 'on' or 'off' code of channel (or group) `name`. The radio
+        is shared with LightsManager; environment control asks for it at high
+        priority, so it goes ahead of the frames of a lights sweep.
+        '''
+        channels = self.registry.group(name) or [self.registry.get(name)]
+        if channels[0] is None:
+            logger.error("No channel or group named '%s'",name)
+            return False
+        if self.switch is None:
+            self.switch = RCSwitch(transmitterPin=self.config.lights.txpin,
+                                   pulseLength=self.config.lights.pulse.start)
+        # one transmitter setup for the whole group, one radio grant per frame
+        with self.switch.session() as session:
+            for channel in channels:
+                code = channel.get(state)
+                if code is None:
+                    logger.error("No '%s' code configured for channel '%s'",state,channel.name)
+                    continue
+                logger.info("Switching channel '%s' %s (code %d)",channel.name,state,code)
+                with self.registry.radio.grant(rfarbiter.HIGH):
+                    session.send(code,24)
+        self.registry.radio.save()
+        return True
+
     def updateTimes(self):
         newtime = time.localtime()
         newdate = time.mktime((newtime[0],newtime[1],newtime[2],0,0,0,newtime[6],newtime[7],newtime[8]))
@@ -83,16 +65,70 @@ class EnvironmentManager():
                 dst = True
             tzoffset = time.timezone / (60*60) * -1
             julianday = solarcalc.getJulianDay(newtime[0],newtime[1],newtime[2])
-            lat = float(self.config.get('location','latitude'))
-            long = float(self.config.get('location','longitude'))
+            lat = self.config.location.latitude
+            long = self.config.location.longitude
             logger.info("location: %.03f, %.03f",lat,long)
             self.sunrise = solarcalc.calcSunriseSet(1,julianday,lat,long,tzoffset,dst)
             self.sunrise = solarcalc.calcSunriseSet(0,julianday,lat,long,tzoffset,dst)
 
 
 
-if __name__ == "__main__":
-    manager = EnvironmentManager(cfgParser)
+def main():
+    # the sensors need the Adafruit DHT driver, which only the Pi has
+    import Adafruit_DHT
+    argParser = ArgumentParser(description='Monitor and attemt to manage an environment')
+    argParser.add_argument("-v","--verbose",dest="verbose",action="store_true",default=False,
+                        help="output verbose log messages")
+    argParser.add_argument("-d","--debug",dest="debug",action="store_true",default=False,
+                        help="output debug log messages")
+    argParser.add_argument("-c","--config",dest="config",default="EnvironmentManager.cfg",
+                        metavar="CONFIG",help="use configuration from CONFIG file (ConfigParser compatible)")
+    argParser.add_argument("-l","--logfile",dest="logfile",default="EnvironmentManager.log",
+                        metavar="LOGFILE",help="output logging to LOGFILE")
+
+    options = argParser.parse_args()
+
+    if options.debug == True:
+        logLevel = logging.DEBUG
+    elif options.verbose == True:
+        logLevel = logging.INFO
+    else:
+        logLevel = logging.WARN
+
+    logger.setLevel(logLevel)
+
+    logFd = None
+    try:
+        logFd = open(options.logfile,"w",1)
+    except Exception as e:
+        sys.stderr.write("Unable to open logfile '%s': %s\n"%(options.logfile,e))
+        return 1
+    if logFd is None:
+        sys.stderr.write("Unabled to get logfile file descriptor. Aborting.\n")
+        return 1
+    ch = logging.StreamHandler(logFd)
+    ch.setLevel(logLevel)
+
+    fh = logging.Formatter("[%(asctime)s] %(levelname)s: %(filename)s:%(funcName)s:%(lineno)d - %(message)s")
+    ch.setFormatter(fh)
+    logger.addHandler(ch)
+
+    config = None
+    if options.config is not None:
+        try:
+            config = lightsconfig.load(options.config)
+        except (IOError, lightsconfig.ConfigError) as e:
+            logger.error("Unable to read config file '%s': %s",options.config,e)
+            return 1
+    else:
+        logger.error("No configuration file specified and default not found. Aborting.")
+        return 1
+
+    manager = EnvironmentManager(config)
     logger.info("To be continued...")
     sys.stdout.write("To be continued...\n")
-    sys.exit(0)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,8 +3,6 @@
 import os, sys
 import subprocess
 import errno
-import fcntl
-import psutil
 import requests
 import time
 import datetime
@@ -14,47 +12,14 @@ import json
 from string import Template
 from argparse import ArgumentParser
 
-lockFile = "/tmp/LightsManager.lock"
-lockFd = None
-lastPid = None
-if os.path.exists(lockFile):
-    try:
-        lockFd = open(lockFile,'r')
-    except IOError as e:
-        sys.stderr.write("Error: unable to open lock file '%s' for reading: %s\n" % (lockFile, e))
-        sys.exit(1)
+import rfarbiter
+import runlock
 
-    lastPid = lockFd.read()
-    if len(lastPid) > 0:
-        lastPid = int(lastPid.strip())
-    lockFd.close()
-
-try:
-    lockFd = open(lockFile,'w')
-except IOError as e:
-    sys.stderr.write("Error: unable to open lock file '%s' for writing: %s.\n" % (lockFile, e))
+lockFile = "/tmp/LightsManager.lock"
+lock = runlock.RunLock(lockFile)
+if not lock.acquire():
+    sys.stderr.write("Error: unable to lock lock file '%s'. Still held by '%s'.\n" % (lockFile, lock.holder()))
     sys.exit(1)
-##
-# TODO: still need to finish locking logic
-#
-try:
-    rv = fcntl.flock(lockFd, fcntl.LOCK_EX|fcntl.LOCK_NB)
-except OSError as e:
-    sys.stderr.write("Warning: lock file last held by '%d'. Checking to see if that PID still running.\n" % (lastPid))
-    if lastPid and psutil.pid_exists(lastPid):
-        sys.stderr.write("Warning: PID '%d' found to be running. Checking to see if that is us.\n" % (lastPid))
-        for process in psutil.process_iter():
-            if process.pid == lastPid:
-                if sys.argv[1] == process.cmdline()[1]:
-                    sys.stderr.write("Error: unable to lock lock file '%s': %s. Still held by '%d' (%s).\n" % (lockFile, e, process.pid, process.cmdline()[1]))
-                    sys.exit(1)
-                else:
-                    sys.stderr.write("Warning: PID '%d' is not us: %s != %s\n" % (process.pid, process.cmdline()[1], sys.argv[1]))
-                break
-        pass
-    else:
-        pass
-lockFd.write(str(os.getpid()))
 
 ##
 # Process command-line options
@@ -228,6 +193,9 @@ try:
     #rcswitch.setRepeatTransmit(6)
 
     cmdbin = '/usr/bin/codesend'
+    # every frame takes a grant of the radio shared with LightsManager_v2
+    # and EnvironmentManager
+    radio = rfarbiter.get_arbiter()
 
     txpin = fileConfig.get("lights").get("txpin")
     pulsestart = fileConfig.get("lights").get("pulse").get("start")
@@ -276,7 +244,8 @@ try:
             cmdargs = [cmdbin, '-l', str(pulse), str(channel["on"])]
             try:
                 #rcswitch.send(str(channel["on"]),24)
-                rc = subprocess.call(cmdargs)
+                with radio.grant(rfarbiter.LOW):
+                    rc = subprocess.call(cmdargs)
                 if rc > 0:
                     logger.warn("Subprocess returned '%d' from '%s'", rc, cmdargs)
                 else:
@@ -299,6 +268,8 @@ try:
         logger.info("Pausing for %d seconds", pulsewait)
         time.sleep(pulsewait)
 
+    radio.save()
+
     waittime = timedata.get('sunset') - time.time()
     while waittime < 0:
         # if loading from cache
@@ -336,7 +307,8 @@ try:
             cmdargs = [cmdbin, '-l', str(pulse), str(channel["off"])]
             try:
                 #rcswitch.send(str(channel["off"]),24)
-                rc = subprocess.call(cmdargs)
+                with radio.grant(rfarbiter.LOW):
+                    rc = subprocess.call(cmdargs)
                 if rc > 0:
                     logger.warn("Subprocess returned '%d' from '%s'", rc, cmdargs)
                 else:
@@ -357,14 +329,12 @@ try:
 
         logger.info("Pausing for %d seconds", pulsewait)
         time.sleep(pulsewait)
+    radio.save()
 except:
     raise
     sys.exit(1)
 
-try:
-    rv = fcntl.flock(lockFd, fcntl.LOCK_UN)
-except OSError as e:
-    logging.warn("Exception releasing lock on '%s': %s", lockFile, e)
+lock.release()
 logger.info("All done. Cleaning up and exiting.")
 #GPIO.cleanup()
 sys.exit(0)
@@ -1,94 +1,266 @@
 #!/usr/bin/env python3
 
 from argparse import ArgumentParser
+import collections
 import datetime
-import errno
-import fcntl
 import json
 import logging
-import logging.handlers
 import os
-import pytz
-import requests
-import subprocess
 import sys
-from string import Template
+import threading
 import time
 
-import psutil
+import actuationqueue
+import channelregistry
+import channelstate
+import lightsconfig
+import lightsplanner
+import lightsschedule
+import rfarbiter
+import rfpolicy
+import rfverify
+import runlock
+import sunprovider
 
 F_RESPONSE = 'response.json'
 LOCKFILE = '/tmp/LightsManager.lock'
+SOCKET_NAME = 'LightsManager'
+# seconds after local midnight at which the resident daemon starts a new day
+DAY_START = 60
 LOGGER = logging.getLogger('LightsManager')
-CMDBIN = '/usr/bin/codesend'
-
-
-def cycle_lights(config, key):
-    txpin = config.get("lights").get("txpin")
-    pulsestart = config.get("lights").get("pulse").get("start")
-    pulsestop = config.get("lights").get("pulse").get("end")
-    pulsewait = config.get("lights").get("pulse").get("spacing")
-    retransmit = config.get("lights").get("pulse").get("retransmit")
-    channels = config.get("lights").get("channels")
-    LOGGER.info("Radio config: Pulse { start: %d, stop: %d, wait: %f }, TXPin %d.",
-                pulsestart, pulsestop, pulsewait, txpin)
+CYCLE_LOCK = threading.Lock()
+TRANSMIT_LOCK = threading.RLock()
+SCHEDULE = {}
+# guards the objects SCHEDULE shares between the schedule and control threads
+SCHEDULE_LOCK = threading.RLock()
+# sweeps listening with each verifier, which a reload must not stop under them
+VERIFIER_USERS = collections.Counter()
+
+
+def get_transmitter(config):
+    '''
+    The resident RCSwitch on lights.txpin: the transmitter is set up once
+    and stays set up, instead of a codesend process per frame
+    '''
+    with TRANSMIT_LOCK:
+        switch = SCHEDULE.get('transmitter')
+        if switch is None or switch.transmitterPin != config.lights.txpin:
+            import rcswitch
+            switch = rcswitch.RCSwitch(repeatTransmit=lightsplanner.DEFAULT_REPEATS)
+            switch.enableTransmit(config.lights.txpin)
+            SCHEDULE['transmitter'] = switch
+        return switch
+
+
+def send_code(config, frame, on_air=None):
+    '''
+    Send `frame` on the resident transmitter. `on_air(True)` is called as
+    soon as its first edge is out, `on_air(False)` if it failed.
+    '''
+    try:
+        with TRANSMIT_LOCK:
+            switch = get_transmitter(config)
+            switch.transmitWaveform(switch.waveform(frame.code, lightsplanner.DEFAULT_BITS, frame.pulse_len),
+                                    lightsplanner.DEFAULT_REPEATS, on_air and (lambda: on_air(True)))
+    except (ImportError, RuntimeError, ValueError, OSError) as err:
+        LOGGER.error("Unable to send code '%s' on GPIO pin %s: %s", frame.code, config.lights.txpin, err)
+        if on_air is not None:
+            on_air(False)
+        return False
+    LOGGER.debug("Sent code '%s' with pulse length %d", frame.code, frame.pulse_len)
+    return True
+
+
+def cycle_lights(config, key, only=None, priority=rfarbiter.LOW, force=False, on_air=None):
+    '''
+    Send `key` to the managed channels that need it. With `force`, every
+    channel in `only` is sent, managed or not, whatever its recorded state.
+    `on_air(sent)` is called for each frame: with True as soon as its first
+    edge is on the air, with False if it could not be sent.
+    '''
+    lights = config.lights
+    pulse = lights.pulse
+    channels = lights.channels
+    LOGGER.info("Radio config: Pulse { start: %d, stop: %d, wait: %f, gap: %f }, TXPin %s.",
+                pulse.start, pulse.end, pulse.spacing, pulse.gap, lights.txpin)
     LOGGER.info("Channel config: %s.", channels)
 
-    # Send requested 'key' code on each channel
-    errors = 0
-    for i in range(len(channels)):
-        channel = channels[i]
-        code = channel.get(key)
-        if not code:
-            LOGGER.warning('Skipping channel "%s" with no "%s" key', channel, key)
-        LOGGER.info("Processing channel %d '%s'", i+1, repr(channel))
-        if channel["manage"] is not True:
-            LOGGER.info("Skipping unmanaged channel %d.", i+1)
-            continue
-        for pulse_len in range(pulsestart, pulsestop):
-            LOGGER.info("Using pulse length %d", pulse_len)
-            for xmt in range(retransmit):
-                LOGGER.info("Attempting to transmit code '%d'...", code)
-                cmdargs = [CMDBIN, str(code), '-l', str(pulse_len)]
-                try:
-                    rc = subprocess.call(cmdargs)
-                    if rc > 0:
-                        LOGGER.warn("Subprocess returned '%d' from '%s'", rc, cmdargs)
-                    else:
-                        LOGGER.info("Successfully executed '%s'", cmdargs)
-                except Exception as err:
-                    LOGGER.error("Error sending code: %s", err)
-                    errors += 1
-  
-            LOGGER.info("Pausing for %d seconds", pulsewait)
-            time.sleep(pulsewait)
+    # Only channels whose recorded state differs (or has gone stale) are sent
+    store = channelstate.ChannelStateStore(lights.state_file)
+    reconciler = channelstate.Reconciler(store, lights.refresh)
+    if force:
+        pending = list(only or ())
+    else:
+        pending = reconciler.pending(channels, key)
+        if only is not None:
+            pending = [i for i in pending if i in only]
+    if not pending:
+        LOGGER.info("All managed channels already %s. Nothing to transmit.", key)
+        return 0
+
+    # Send requested 'key' code on every channel from one interleaved plan,
+    # each channel at its own repeats and pulse lengths when a policy learns them
+    verifier = get_verifier(config)
+    try:
+        policy = get_policy(config)
+        names = [channelstate.channel_name(i, channel) for (i, channel) in enumerate(channels)]
+        overrides = None
+        if policy is not None:
+            overrides = policy.overrides(names, pending, pulse.lengths, pulse.retransmit, verifier is not None)
+        plan = lightsplanner.build_plan(channels, key, pulse.lengths, pulse.retransmit,
+                                        gap=pulse.gap, spacing=pulse.spacing, deadline=lights.deadline, only=pending,
+                                        managed_only=not force, overrides=overrides)
+        LOGGER.info("Planned %d frames over %.2f seconds", len(plan), plan.duration())
+        # each frame is one grant of the shared transmitter, so higher priority
+        # clients (the humidifier) get in between the frames of a sweep
+        radio = get_registry(config).radio
+        send = radio.wrap(lambda frame: send_code(config, frame, on_air), priority)
+        if verifier is None:
+            errors = lightsplanner.execute_plan(plan, send)
+            confirmed = ()
+        else:
+            # listen for each frame after the radio is released, and stop
+            # sending a channel once its code has been heard
+            sweep = verifier.sweep(channels)
+            errors = lightsplanner.execute_plan(plan, sweep.wrap(send), done=sweep.done)
+            confirmed = sweep.finish(plan)
+            if policy is not None:
+                policy.record_sweep(names, sweep.results, confirmed, pulse.retransmit)
+                policy.save()
+            LOGGER.info("Verified %d of %d channels, skipped %d frames", len(confirmed), len(pending),
+                        sum(plan.skipped.values()))
+    finally:
+        release_verifier(verifier)
+    radio.save()
+    LOGGER.info("Radio usage: %s", radio.stats.as_dict())
+    reconciler.commit(channels, key, [i for i in pending if plan.sent[i] and i not in confirmed])
+    if confirmed:
+        reconciler.commit(channels, key, sorted(confirmed), confirmed=True)
+    unsent = plan.unsent()
+    if unsent:
+        LOGGER.error("Channels %s: no frame was sent; they stay pending.", [i+1 for i in unsent])
     if errors:
         LOGGER.warning('Cycle completed with %d errors', errors)
     return errors
 
 
+def get_registry(config):
+    with SCHEDULE_LOCK:
+        registry = SCHEDULE.get('registry')
+        if registry is None or registry.config is not config:
+            registry = channelregistry.ChannelRegistry.from_config(config)
+            SCHEDULE['registry'] = registry
+        return registry
+
+
+def get_verifier(config):
+    '''
+    The running TransmitVerifier for lights.verify, or None to send blind.
+    Every verifier returned must be handed back to release_verifier(); one
+    a sweep is still listening with is only replaced after a reload once
+    it is idle, so there is never more than one receiver.
+    '''
+    settings = config.lights.verify
+    key = settings and (settings.rxpin, settings.confirmations, settings.listen, settings.stats_file)
+    with SCHEDULE_LOCK:
+        verifier = SCHEDULE.get('verifier')
+        if SCHEDULE.get('verify') != key and not VERIFIER_USERS[verifier]:
+            if verifier is not None:
+                verifier.stop()
+            verifier = None
+            SCHEDULE.update(verifier=None, verify=key)
+            if settings is not None:
+                try:
+                    verifier = rfverify.TransmitVerifier(settings.rxpin, settings.confirmations,
+                                                         settings.listen, settings.stats_file).start()
+                except (RuntimeError, ValueError, OSError) as err:
+                    LOGGER.error("Unable to listen on GPIO %d for verification: %s. Sending blind.",
+                                 settings.rxpin, err)
+                SCHEDULE['verifier'] = verifier
+        if verifier is not None:
+            VERIFIER_USERS[verifier] += 1
+        return verifier
+
+
+def release_verifier(verifier):
+    '''
+    Done with a verifier from get_verifier()
+    '''
+    if verifier is None:
+        return
+    with SCHEDULE_LOCK:
+        VERIFIER_USERS[verifier] -= 1
+        if VERIFIER_USERS[verifier] <= 0:
+            del VERIFIER_USERS[verifier]
+
+
+def get_policy(config):
+    '''
+    The RetransmitPolicy for lights.policy, or None for the global settings
+    '''
+    settings = config.lights.policy
+    key = settings and tuple(getattr(settings, name) for name in settings.__slots__)
+    with SCHEDULE_LOCK:
+        if SCHEDULE.get('policy_key') != key:
+            SCHEDULE.update(policy=rfpolicy.from_config(config), policy_key=key)
+        return SCHEDULE.get('policy')
+
+
+def policy_feedback(config, request):
+    '''
+    Tell the retransmit policy whether the last sweep of some channels
+    switched them
+    '''
+    policy = get_policy(config)
+    if policy is None:
+        return {'error': 'no lights.policy configured'}
+    names = request.get('channels') or [request.get('channel')]
+    registry = get_registry(config)
+    try:
+        indexes = registry.resolve(names)
+    except KeyError as err:
+        return {'error': err.args[0]}
+    worked = request.get('worked') is True
+    for i in indexes:
+        policy.feedback(registry.channels[i].name, worked, config.lights.pulse.retransmit)
+    policy.save()
+    return {'channels': dict((registry.channels[i].name, 'worked' if worked else 'missed') for i in indexes)}
+
+
+def get_policy_stats(config):
+    lights = config.lights
+    return get_policy(config).as_dict([channel.name for channel in lights.channels], lights.pulse.lengths,
+                                      lights.pulse.retransmit, SCHEDULE.get('verifier') is not None)
+
+
 def get_config(options):
-    fileConfig = None
+    '''
+    Watcher keeping the compiled configuration current, or None
+    '''
+    watcher = None
     if options.config is not None:
         try:
-            fileConfigHandle = open(options.config,"r")
-            fileConfig = json.load(fileConfigHandle)
-            LOGGER.debug('Config: %s', fileConfig)
-            logLevelCfg = fileConfig.get('logging', {}).get('loglevel', '').upper()
-            if logLevelCfg and hasattr(logging, logLevelCfg):
-                LOGGER.setLevel(getattr(logging, logLevelCfg))
-                for handler in LOGGER.handlers:
-                    handler.setLevel(getattr(logging, logLevelCfg))
-        except Exception as err:
+            watcher = lightsconfig.ConfigWatcher(options.config)
+            LOGGER.debug('Config: %s', watcher.config.sections)
+            set_loglevel(watcher.config)
+        except (IOError, lightsconfig.ConfigError) as err:
             LOGGER.error("Problem reading configuration from '%s': %s.", options.config, err)
-    return fileConfig
+    return watcher
+
+
+def set_loglevel(config):
+    logLevelCfg = (config.loglevel or '').upper()
+    if logLevelCfg and hasattr(logging, logLevelCfg):
+        LOGGER.setLevel(getattr(logging, logLevelCfg))
+        for handler in LOGGER.handlers:
+            handler.setLevel(getattr(logging, logLevelCfg))
 
 def get_location(options, config):
     location = {'latitude': None, 'longitude': None}
     (fileConfig, apikey, servicenames) = (None, None, [])
     if options.latitude is None:
         if config is not None:
-            latitude = config.get('location', {}).get('latitude')
+            latitude = config.location.latitude
             if latitude is not None:
                 location.update({'latitude': latitude})
             else:
@@ -99,7 +271,7 @@ def get_location(options, config):
 
     if options.longitude is None:
         if config is not None:
-            longitude = config.get('location').get('longitude')
+            longitude = config.location.longitude
             if longitude is not None:
                 location.update({'longitude': longitude})
             else:
@@ -111,137 +283,303 @@ def get_location(options, config):
 
 
 def get_lock():
-    last_pid = None
-    lock_handle = None
-    if os.path.exists(LOCKFILE):
-        try:
-            lock_handle = open(LOCKFILE, 'r')
-        except IOError as err:
-            LOGGER.error('Unable to open lockfile %s for reading: %s', LOCKFILE, err)
-            return None
-        last_pid = lock_handle.read()
-        if len(last_pid) > 0:
-            last_pid = int(last_pid.strip())
-        lock_handle.close()
-    try:
-        lock_handle = open(LOCKFILE, 'w')
-    except IOError as err:
-        LOGGER.error('Unable to open lockfile %s for writing: %s', LOCKFILE, err)
+    lock = runlock.RunLock(LOCKFILE, SOCKET_NAME)
+    if not lock.acquire():
+        LOGGER.error('Unable to lock %s. Still held by PID %s.', LOCKFILE, lock.holder())
         return None
-    try:
-        rv = fcntl.flock(lock_handle, fcntl.LOCK_EX|fcntl.LOCK_NB)
-    except OSError as err:
-        LOGGER.error('Lock file last held by %s. Checking to see if PID still running.', last_pid)
-        if last_pid and psutil.pid_exists(last_pid):
-            LOGGER.error('PID %s found to be running. Checking to see if that is this process.', last_pid)
-            success = True
-            for process in psutil.process_iter():
-                if process.pid == last_pid:
-                    if sys.argv[1] == process.cmdline()[1]:
-                        LOGGER.error('Unable to lock file %s: %s. Still held by %s (%s).', LOCKFILE, err, process.pid,
-                                     process.cmdline()[1])
-                        success = False
-                    else:
-                        LOGGER.error('PID %s is not us: %s != %s', process.pid, process.cmdline()[1], sys.argv[1])
-                        success = False
-                    break
-            if not success:
-                return None
-        else:
-            LOGGER.error('Could not match last PID %s with any running process', last_pid)
-            return None
-    lock_handle.write(str(os.getpid()))
-    return lock_handle
+    return lock
 
 
-def get_response(location):
+def handle_request(request, config):
+    '''
+    Answer a request handed off by another instance over the control socket
+    '''
+    command = request.get('command')
+    LOGGER.info("Control request: %s", request)
+    if command == 'status':
+        reply = {'pid': os.getpid(), 'next_transition': SCHEDULE.get('next')}
+        if SCHEDULE.get('queue') is not None:
+            reply['queue'] = SCHEDULE.get('queue').stats()
+        if SCHEDULE.get('verifier') is not None:
+            reply['verify'] = SCHEDULE.get('verifier').stats.as_dict()
+        if config is not None and config.lights is not None and config.lights.policy is not None:
+            reply['policy'] = get_policy_stats(config)
+        return reply
+    if command == 'set':
+        return set_channels(config, request)
+    if command == 'state':
+        return get_channel_states(config)
+    if command == 'feedback':
+        return policy_feedback(config, request)
+    if command == 'apply':
+        if 'timeline' not in SCHEDULE:
+            return {'error': 'schedule not loaded yet'}
+        only = None
+        if request.get('channels'):
+            try:
+                only = get_registry(config).resolve(request.get('channels'))
+            except KeyError as err:
+                return {'error': err.args[0]}
+        errors = apply_desired_states(config, SCHEDULE.get('timelines'), SCHEDULE.get('timeline'), time.time(),
+                                      only, rfarbiter.NORMAL)
+        return {'errors': errors, 'queued': SCHEDULE.get('queue') is not None}
+    return {'error': "unknown command '%s'" % command}
+
+
+def set_channels(config, request, timeout=5.0):
+    '''
+    Switch channels (or groups) to 'on', 'off' or 'toggle' right away. The
+    sweep runs on its own thread at normal priority, next to any scheduled
+    sweep, and the reply goes out as soon as the first edge of the first
+    frame is on the air.
+    '''
+    received = time.monotonic()
+    state = request.get('state')
+    if state not in ('on', 'off', 'toggle'):
+        return {'error': "state must be 'on', 'off' or 'toggle', not '%s'" % state}
+    names = request.get('channels') or [request.get('channel')]
+    registry = get_registry(config)
+    try:
+        indexes = registry.resolve(names)
+    except KeyError as err:
+        return {'error': err.args[0]}
+    desired = dict((i, state) for i in indexes)
+    if state == 'toggle':
+        store = channelstate.ChannelStateStore(config.lights.state_file)
+        for i in indexes:
+            last = store.get(registry.channels[i].name) or {}
+            desired[i] = 'off' if last.get('state') == 'on' else 'on'
+    if SCHEDULE.get('queue') is not None:
+        SCHEDULE.get('queue').override(desired)
+
+    first = threading.Event()
+    stamps = []
+    failed = []
+    def on_air(sent):
+        if not sent:
+            failed.append(time.monotonic())
+        elif not stamps:
+            stamps.append(time.monotonic())
+            first.set()
+    def switch():
+        try:
+            for (key, group) in lightsschedule.group_by_state(desired).items():
+                cycle_lights(config, key, only=group, priority=rfarbiter.NORMAL, force=True, on_air=on_air)
+        finally:
+            first.set()
+    threading.Thread(target=switch, name='switch', daemon=True).start()
+    first.wait(timeout)
+    reply = {'channels': dict((registry.channels[i].name, s) for (i, s) in desired.items())}
+    if stamps:
+        reply['latency_ms'] = round(1000 * (stamps[0] - received), 3)
+        LOGGER.info("Switched %s; first frame on air after %.1f ms", reply['channels'], reply['latency_ms'])
+    if failed:
+        reply['error'] = '%d frames failed to send' % len(failed)
+    elif not stamps:
+        reply['error'] = 'nothing was transmitted'
+    return reply
+
+
+def get_channel_states(config):
+    '''
+    Last commanded and currently scheduled state of every channel
+    '''
+    store = channelstate.ChannelStateStore(config.lights.state_file)
+    desired = {}
+    if 'timeline' in SCHEDULE:
+        desired = get_desired_states(config, SCHEDULE.get('timelines'), SCHEDULE.get('timeline'), time.time())
+    pending = {}
+    if SCHEDULE.get('queue') is not None:
+        pending = dict((i, entry.state) for (i, entry) in list(SCHEDULE.get('queue').pending.items()))
+    channels = {}
+    for channel in config.lights.channels:
+        last = store.get(channel.name) or {}
+        channels[channel.name] = {'state': last.get('state'), 'since': last.get('timestamp'),
+                                  'scheduled': desired.get(channel.index), 'pending': pending.get(channel.index)}
+    return {'channels': channels}
+
+
+def get_response(location, config=None):
     '''
     Attempt to get sunrise/sunset times based on locality
     Using the API made available by Sunrise-Sunset.org:
         http://www.sunrise-sunset.org/api/
+    Days ahead are prefetched into a multi-day cache, and times are computed
+    locally when the API is slow or unreachable.
     '''
+    provider = sunprovider.get_provider(location, config)
+    LOGGER.info("Requesting sun times from '%s'", provider.url)
+    obj = {'results': provider.get()}
+    LOGGER.debug("Response data:\n%s", json.dumps(obj, sort_keys=True, indent=4, separators=(',',': ')))
+    if obj['results'].get('source') == 'local':
+        LOGGER.warning('Using locally computed sun times')
+    LOGGER.info('Sun times deviation from local calculation: %s', provider.stats.as_dict())
+    # let the prefetch finish in the background while we sleep
+    provider.close(wait=False)
+    return obj
 
-    params = {
-        'formatted': 0,
-        'lat': location.get('latitude'),
-        'lng': location.get('longitude')
-    }
 
-    url = 'http://api.sunrise-sunset.org/json'
-    LOGGER.info("Requesting URL '%s'", url)
+def get_channel_timelines(config, location):
+    '''
+    Compile the timelines of channels that have their own "rules" over
+    yesterday and today, so a mid-day start sees yesterday's last transition.
+    '''
+    channels = config.lights.channels
+    if not any(channel.rules for channel in channels):
+        return {}
+    import lightrules
+    import sunevents
+    tz = None
+    if config.location.timezone:
+        import zoneinfo
+        tz = zoneinfo.ZoneInfo(config.location.timezone)
+    today = datetime.datetime.fromtimestamp(time.time(), tz).date()
+    series = sunevents.SunSeries(today - datetime.timedelta(days=1), 2,
+                                 float(location.get('latitude')), float(location.get('longitude')), tz)
+    timelines = {}
+    for i, channel in enumerate(channels):
+        if not channel.rules:
+            continue
+        try:
+            timelines[i] = lightrules.channel_timeline(channel, series)
+        except lightrules.RuleError as err:
+            LOGGER.error("Channel %d: %s. Using sunrise/sunset instead.", i+1, err)
+    return timelines
 
-    response = None
-    obj = {}
-    cacheFilename = 'SunRiseSetTimes.json'
-    try:
-        response = requests.get(url, params=params)
-        obj = response.json()
-        LOGGER.info("Request return HTTP %d", response.status_code)
-        response.close()
-        LOGGER.debug("Response data:\n%s", json.dumps(obj, sort_keys=True, indent=4, separators=(',',': ')))
-        with open(cacheFilename, 'w') as hCachefile:
-            hCachefile.write(json.dumps(obj, sort_keys=True, indent=4))
-            hCachefile.close()
-    except Exception as e:
-        LOGGER.error("Error connecting to URL '%s': %s. Attempt to load from cache file.", url, e)
-        fInfo = os.stat(cacheFilename)
-
-        if datetime.datetime.now() - datetime.datetime.fromtimestamp(fInfo.st_mtime) > datetime.timedelta(days=7):
-            LOGGER.error('Error: Cache file is over a week old. Aborting.')
-            return None
-        with open(cacheFilename, 'r') as hCachefile:
-            utc_now = pytz.utc.localize(datetime.datetime.utcnow())
-            obj = json.load(hCachefile)
-            cached_sunrise = datetime.datetime.fromisoformat(obj.get('results').get('sunrise'))
-            today_sunrise = pytz.utc.localize(datetime.datetime.combine(utc_now.date(), cached_sunrise.time()))
-            LOGGER.warning('Attempt to fast-forward cached sunrise %s to today: %s', cached_sunrise, today_sunrise)
-            cached_sunset = datetime.datetime.fromisoformat(obj.get('results').get('sunset'))
-            today_sunset = pytz.utc.localize(datetime.datetime.combine(utc_now.date(), cached_sunset.time()))
-            LOGGER.warning('Attempt to fast-forward cached sunset %s to today: %s', cached_sunset, today_sunset)
-            obj['result'].update({'sunrise': today_sunrise.isoformat(),
-                                  'sunset': today_sunset.isoformat()})
-            hCachefile.close()
-
-    if obj.get('results') is None:
-        LOGGER.warning("Result object has no 'results' key")
-    return obj
 
+def get_desired_states(config, timelines, timeline, when, only=None):
+    desired = lightsschedule.desired_states(config.lights.channels, timelines, when, default=timeline)
+    if only is not None:
+        desired = dict((i, state) for (i, state) in desired.items() if i in only)
+    return desired
 
-def get_timedeltas(data):
-    utc_now = pytz.utc.localize(datetime.datetime.utcnow())
-    day_seconds = 60 * 60 * 24  # seconds in one day, generically
-    LOGGER.info('Now: %s', utc_now)
-    deltas = {}
-    sunrise = datetime.datetime.fromisoformat(data.get('sunrise'))
-    LOGGER.info('Sunrise: %s', sunrise)
-    deltas.setdefault('sunrise', (sunrise - utc_now).total_seconds())
-    if utc_now < sunrise:
-        LOGGER.info('Delta to sunrise: %s seconds', deltas['sunrise'])
-    else:
-        LOGGER.info('Delta to sunrise: %s seconds ago', deltas['sunrise'] * -1)
-    sunset = datetime.datetime.fromisoformat(data.get('sunset'))
-    LOGGER.info('Sunset: %s', sunset)
-    deltas.setdefault('sunset', (sunset - sunrise).total_seconds())
-    if utc_now < sunset:
-        LOGGER.info('Delta to sunset: %s seconds', deltas['sunset'])
-    else:
-        LOGGER.info('Delta to sunset: %s seconds ago', deltas['sunset'] * -1)
 
-    return deltas
+def actuate(config, desired, priority=rfarbiter.LOW):
+    errors = 0
+    with CYCLE_LOCK:
+        for (state, indexes) in lightsschedule.group_by_state(desired).items():
+            LOGGER.info("Channels %s should be %s.", [i+1 for i in indexes], state)
+            errors += cycle_lights(config, state, only=indexes, priority=priority)
+    return errors
 
 
-def release_lock(lock_handle):
-    try:
-        rv = fcntl.flock(lock_handle, fcntl.LOCK_UN)
-    except OSError as err:
-        LOGGER.error('Exception releasing lock on %s: %s', LOCKFILE, err)
-        return 255
-    return 0
+def apply_desired_states(config, timelines, timeline, when, only=None, priority=rfarbiter.LOW):
+    '''
+    Send the channels their desired state at `when`, through the debounce
+    queue when the daemon runs one
+    '''
+    desired = get_desired_states(config, timelines, timeline, when, only)
+    queue = SCHEDULE.get('queue')
+    if queue is not None:
+        queue.submit(desired, priority)
+        return 0
+    return actuate(config, desired, priority)
+
+
+def wait_until(when, watcher=None):
+    '''
+    Sleep until `when`. With a watcher, wake up every poll interval to check
+    the configuration file and return early with the new configuration if it
+    changed.
+    '''
+    wait = when - time.time()
+    while wait > 0:
+        if watcher is None:
+            time.sleep(wait)
+        else:
+            time.sleep(min(wait, watcher.interval))
+            config = watcher.reload()
+            if config is not None:
+                return config
+        wait = when - time.time()
+    return None
+
+
+def run_schedule(config, location, data, watcher=None, options=None):
+    '''
+    Apply whatever the lights should be doing right now, then wait only for
+    the transitions still ahead. A reloaded configuration also reaches the
+    actuation queue's debounce window and, unless `options` fixes it on the
+    command line, the location.
+    '''
+    timeline = lightsschedule.sun_timeline(data)
+    timelines = get_channel_timelines(config, location)
+    everything = list(timelines.values()) + [timeline]
+    SCHEDULE.update(config=config, timelines=timelines, timeline=timeline)
+    errors = apply_desired_states(config, timelines, timeline, time.time())
+    when = lightsschedule.next_change(everything, time.time())
+    while when is not None:
+        SCHEDULE['next'] = when
+        wait = when - time.time()
+        if wait > 0:
+            LOGGER.info("Sleep %d seconds before the next lights transition.", wait)
+        reloaded = wait_until(when, watcher)
+        if reloaded is not None:
+            # channels or rules may have changed: recompile and catch up now
+            config = reloaded
+            set_loglevel(config)
+            if SCHEDULE.get('queue') is not None:
+                SCHEDULE.get('queue').window = config.lights.debounce
+            if options is not None:
+                moved = get_location(options, config)
+                if moved != location and moved.get('latitude') and moved.get('longitude'):
+                    LOGGER.warning('Location changed to %s; fetching its sun times.', moved)
+                    location = moved
+                    timeline = lightsschedule.sun_timeline(get_response(location, config).get('results'))
+            timelines = get_channel_timelines(config, location)
+            everything = list(timelines.values()) + [timeline]
+            SCHEDULE.update(config=config, timelines=timelines, timeline=timeline)
+            errors += apply_desired_states(config, timelines, timeline, time.time())
+            when = lightsschedule.next_change(everything, time.time())
+            continue
+        if wait > 0:
+            LOGGER.info('Sleep over. Cycle lights.')
+        errors += apply_desired_states(config, timelines, timeline, max(when, time.time()))
+        when = lightsschedule.next_change(everything, when)
+    SCHEDULE['next'] = None
+    return errors
+
+
+def next_day(now):
+    '''
+    When the day after the one containing `now` starts: DAY_START seconds
+    past the following local midnight
+    '''
+    tomorrow = datetime.date.fromtimestamp(now) + datetime.timedelta(days=1)
+    return time.mktime(tomorrow.timetuple()) + DAY_START
+
+
+def wait_for_day(config, watcher=None):
+    '''
+    Sleep through the night until next_day(), taking in configuration reloads
+    so the control socket answers with the current channels meanwhile.
+    Returns the configuration to start the new day with.
+    '''
+    when = next_day(time.time())
+    SCHEDULE['next'] = when
+    LOGGER.info('No transitions left today. Sleep %d seconds until tomorrow.', when - time.time())
+    reloaded = wait_until(when, watcher)
+    while reloaded is not None:
+        config = reloaded
+        set_loglevel(config)
+        if SCHEDULE.get('queue') is not None:
+            SCHEDULE.get('queue').window = config.lights.debounce
+        SCHEDULE['config'] = config
+        reloaded = wait_until(when, watcher)
+    return config
+
+
+def release_lock(lock):
+    return lock.release()
 
 
 def main():
     LOGGER.info('Begin')
     parser = ArgumentParser(description='Manage configured lights')
+    parser.add_argument("-a","--apply-now",dest="apply_now",action="store_true",default=False,
+                        help="ask an already running instance to apply the desired light states now")
+    parser.add_argument("-n","--channels",dest="channels",default=None,
+                        metavar="NAMES",help="limit --apply-now to the comma separated channels or groups NAMES")
     parser.add_argument("-c","--config",dest="config",default=None,
                         metavar="CONFIG",help="use configuration from CONFIG file (JSON serialized)")
     parser.add_argument("-d","--debug",dest="debug",action="store_true",default=False,
@@ -254,6 +592,8 @@ def main():
                         metavar="LOGFILE",help="write logging output to LOGFILE")
     parser.add_argument("-v","--verbose",dest="verbose",action="store_true",default=False,
                         help="output verbose log messages")
+    parser.add_argument("-o","--once",dest="once",action="store_true",default=False,
+                        help="exit after the day's last transition instead of staying resident")
     options = parser.parse_args()
 
     if options.debug == True:
@@ -267,8 +607,9 @@ def main():
 
     handler = None
     if options.logfile is not None:
+        from logging.handlers import RotatingFileHandler
         try:
-            handler = logging.handlers.RotatingFileHandler(filename=options.logfile,maxBytes=1024000)
+            handler = RotatingFileHandler(filename=options.logfile,maxBytes=1024000)
         except IOError as err:
             sys.stderr.write('Unable to open file %s for writing: %s. Will continue without.', options.logfile, err)
             handler = logging.StreamHandler()
@@ -284,12 +625,21 @@ def main():
     LOGGER.info('Getting process lock')
     lock_handle = get_lock()
     if not lock_handle:
-        LOGGER.error('Unable to acquire run lock. Aborting.')
-        return 255
+        request = {'command': 'apply' if options.apply_now else 'status'}
+        if options.apply_now and options.channels:
+            request['channels'] = options.channels.split(',')
+        reply = runlock.send(SOCKET_NAME, request)
+        if reply is None:
+            LOGGER.error('Unable to acquire run lock. Aborting.')
+            return 255
+        LOGGER.warning('Already running; handed off %s: %s', request, reply)
+        # the resident instance is serving: a plain start has nothing to do
+        return 0 if 'error' not in reply else 255
 
     LOGGER.info('Loading configuration')
-    config = get_config(options)
-    LOGGER.info('Configuration: %s', config)
+    watcher = get_config(options)
+    config = watcher.config if watcher is not None else None
+    LOGGER.info('Configuration: %s', config.sections if config is not None else None)
 
     LOGGER.info('Setting location')
     location =  get_location(options, config)
@@ -298,22 +648,34 @@ def main():
         LOGGER.error('No location information provided. Unable to continue.')
         return release_lock(lock_handle)
 
-    data = get_response(location).get('results')
-    LOGGER.info('Data: %s', data)
-    time_deltas = get_timedeltas(data)
-
-    if time_deltas.get('sunrise') > 0:
-        LOGGER.info("Sleep %d seconds before turning lights on.", time_deltas.get('sunrise'))
-        time.sleep(time_deltas.get('sunrise'))
-        LOGGER.info('Sleep over. Cycle lights.')
-    cycle_lights(config, 'on')
-
-    if time_deltas.get('sunset') > 0:
-        LOGGER.info("Sleep %d seconds before turning lights off.", time_deltas.get('sunset'))
-        time.sleep(time_deltas.get('sunset'))
-        LOGGER.info('Sleep over. Cycle lights.')
-    cycle_lights(config, 'off')
-
+    # commands are debounced so a channel flipped back and forth within the
+    # window is only sent its final state
+    queue = actuationqueue.ActuationQueue(
+        lambda state, indexes, priority: actuate(SCHEDULE.get('config', config),
+                                                 dict((i, state) for i in indexes), priority),
+        window=config.lights.debounce if config is not None else actuationqueue.DEFAULT_WINDOW)
+    SCHEDULE['queue'] = queue.start()
+    lock_handle.serve(lambda request: handle_request(request, SCHEDULE.get('config', config)))
+
+    # stay resident between days so the control socket keeps answering;
+    # --once keeps the old run-per-day behaviour for cron
+    while True:
+        data = get_response(location, config).get('results')
+        LOGGER.info('Data: %s', data)
+
+        run_schedule(config, location, data, watcher, options)
+        if options.once:
+            break
+        config = wait_for_day(SCHEDULE.get('config', config), watcher)
+        moved = get_location(options, config)
+        if moved.get('latitude') and moved.get('longitude'):
+            location = moved
+
+    SCHEDULE.pop('queue').stop()
+    LOGGER.info('Actuation queue: %s', queue.stats())
+    with SCHEDULE_LOCK:
+        if SCHEDULE.get('verifier') is not None:
+            SCHEDULE.pop('verifier').stop()
     return release_lock(lock_handle)
 
 
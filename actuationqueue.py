@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+'''
+Debounce channel commands so only the net change is transmitted.
+
+Every scheduled transition and --apply-now hand-off is queued per channel
+and held for a short debounce window. A newer command for the same channel
+replaces the pending one and restarts the window; a repeat of the pending
+state is dropped. When the window expires the channel's final state is
+handed to `actuate(state, indexes, priority)`, with channels going to the
+same state batched into one call, and a channel that ends up back in the
+state it was last actuated to is not sent at all. So on -> off -> on
+within the window costs no sweep. Channels switched directly by a control
+request are taken out of the queue with override(), so a manual command
+also cancels a pending one.
+
+The queue is driven either by its own worker thread (start()/stop()) or by
+the caller through next_due()/flush(), which is how the simulator keeps it
+on its virtual clock.
+'''
+
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger('LightsManager')
+
+DEFAULT_WINDOW = 2.0  # seconds
+
+
+class Pending():
+    __slots__ = ('state', 'due', 'priority', 'commands', 'before')
+
+    def __init__(self, state, due, priority, before):
+        self.state = state
+        self.due = due
+        self.priority = priority
+        self.commands = 1
+        self.before = before
+
+
+class ActuationQueue():
+    def __init__(self, actuate, window=DEFAULT_WINDOW, clock=None):
+        self.actuate = actuate
+        self.window = window
+        self.clock = clock or time.monotonic
+        self.pending = {}
+        self.last = {}
+        self.cond = threading.Condition()
+        self.thread = None
+        self.running = False
+        self.counters = dict((key, 0) for key in
+                             ('submitted', 'duplicates', 'superseded', 'reverted', 'actuated', 'batches'))
+
+    def submit(self, desired, priority=0, now=None):
+        '''
+        Queue `desired` ({channel index: state}); returns when it is due
+        '''
+        if now is None:
+            now = self.clock()
+        due = now + self.window
+        with self.cond:
+            for (i, state) in desired.items():
+                self.counters['submitted'] += 1
+                entry = self.pending.get(i)
+                if entry is None:
+                    self.pending[i] = Pending(state, due, priority, self.last.get(i))
+                    continue
+                if entry.state == state:
+                    # same as what is already queued; keep the original due time
+                    self.counters['duplicates'] += 1
+                    entry.priority = max(entry.priority, priority)
+                    continue
+                self.counters['superseded'] += 1
+                entry.state = state
+                entry.due = due
+                entry.priority = max(entry.priority, priority)
+                entry.commands += 1
+            self.cond.notify()
+        return due
+
+    def override(self, desired):
+        '''
+        Drop the pending commands of channels switched directly (e.g. by a
+        manual request), which now are in the state given in `desired`
+        '''
+        with self.cond:
+            for (i, state) in desired.items():
+                if self.pending.pop(i, None) is not None:
+                    self.counters['superseded'] += 1
+                self.last[i] = state
+
+    def next_due(self):
+        with self.cond:
+            if not self.pending:
+                return None
+            return min(entry.due for entry in self.pending.values())
+
+    def take(self, now=None, everything=False):
+        '''
+        Remove the entries that are due; returns {(state, priority): [indexes]}
+        '''
+        if now is None:
+            now = self.clock()
+        batches = {}
+        with self.cond:
+            for (i, entry) in sorted(self.pending.items()):
+                if not everything and entry.due > now:
+                    continue
+                del self.pending[i]
+                if entry.commands > 1 and entry.state == entry.before:
+                    LOGGER.info("Channel %d went back to %s within the debounce window; not transmitting.",
+                                i+1, entry.state)
+                    self.counters['reverted'] += 1
+                    continue
+                self.last[i] = entry.state
+                batches.setdefault((entry.state, entry.priority), []).append(i)
+        return batches
+
+    def flush(self, now=None, everything=False):
+        '''
+        Actuate the entries that are due; returns the actuate() error count
+        '''
+        errors = 0
+        for ((state, priority), indexes) in sorted(self.take(now, everything).items(),
+                                                   key=lambda item: -item[0][1]):
+            self.counters['actuated'] += len(indexes)
+            self.counters['batches'] += 1
+            try:
+                errors += self.actuate(state, indexes, priority) or 0
+            except Exception as err:
+                LOGGER.error("Error actuating channels %s %s: %s", [i+1 for i in indexes], state, err)
+                errors += 1
+        return errors
+
+    def stats(self):
+        with self.cond:
+            stats = dict(self.counters)
+            stats['pending'] = len(self.pending)
+        stats['saved'] = stats['duplicates'] + stats['superseded'] + stats['reverted']
+        return stats
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='actuationqueue', daemon=True)
+        self.thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            with self.cond:
+                if not self.running:
+                    break
+                due = self.next_due()
+                wait = None if due is None else due - self.clock()
+                if wait is None or wait > 0:
+                    self.cond.wait(wait)
+                    continue
+            self.flush()
+
+    def stop(self, flush=True):
+        '''
+        Stop the worker; with `flush`, send whatever is still pending now
+        '''
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if flush:
+            return self.flush(everything=True)
+        return 0
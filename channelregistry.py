@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+'''
+One index of the RF channels and one queue for the radio that sends them.
+
+LightsManager (JSON) and EnvironmentManager (INI) both compile their
+configuration with lightsconfig and build a ChannelRegistry from it: channels
+by name, by group and by code, in memory. Every transmission goes through
+the registry's radio, the rfarbiter.AirtimeArbiter for the lock file shared
+by every process using the same transmitter, so the two managers never key
+it at the same time and their frames cannot collide on the air:
+
+    channelregistry.py -c lights.json daytime
+    channelregistry.py -c EnvironmentManager.cfg --who
+'''
+
+import fcntl
+import logging
+import sys
+from argparse import ArgumentParser
+
+import lightsconfig
+import rfarbiter
+
+LOGGER = logging.getLogger('LightsManager')
+
+class ChannelRegistry():
+    def __init__(self, channels=(), groups=None, radio=None, config=None):
+        self.config = config
+        self.channels = tuple(channels)
+        self.radio = radio or rfarbiter.get_arbiter()
+        self.by_name = {}
+        self.by_code = {}
+        for channel in self.channels:
+            self.by_name[channel.name] = channel
+            for state in ('on', 'off'):
+                code = channel.get(state)
+                if code is None:
+                    continue
+                if code in self.by_code:
+                    LOGGER.warning("Code %d is used by both '%s' and '%s'", code, self.by_code[code][0].name,
+                                   channel.name)
+                self.by_code[code] = (channel, state)
+        self.groups = dict((group, tuple(self.by_name[name] for name in names))
+                           for (group, names) in (groups or {}).items())
+
+    def __len__(self):
+        return len(self.channels)
+
+    @classmethod
+    def from_config(cls, config):
+        if config.lights is None:
+            (channels, groups) = ((), {})
+        else:
+            (channels, groups) = (config.lights.channels, config.lights.groups)
+        radio = rfarbiter.get_arbiter((config.get('radio') or {}).get('lock') or rfarbiter.DEFAULT_LOCKFILE)
+        return cls(channels, groups, radio, config)
+
+    def get(self, name):
+        return self.by_name.get(name)
+
+    def group(self, name):
+        return self.groups.get(name, ())
+
+    def lookup(self, code):
+        '''
+        (channel, state) that `code` switches, or None
+        '''
+        return self.by_code.get(code)
+
+    def resolve(self, names):
+        '''
+        Sorted indexes of the channels named, directly or by group, in `names`
+        '''
+        indexes = set()
+        for name in names:
+            if name in self.by_name:
+                indexes.add(self.by_name[name].index)
+            elif name in self.groups:
+                indexes.update(channel.index for channel in self.groups[name])
+            else:
+                raise KeyError("No channel or group named '%s'" % name)
+        return sorted(indexes)
+
+
+def main():
+    parser = ArgumentParser(description='List configured RF channels by name or group')
+    parser.add_argument("names", nargs='*', metavar="NAME", help="channel or group to list (default: all)")
+    parser.add_argument("-c","--config",dest="config",required=True,
+                        metavar="CONFIG",help="use channels from CONFIG (JSON, or INI with a .cfg/.ini suffix)")
+    parser.add_argument("-w","--who",dest="who",action="store_true",default=False,
+                        help="report whether another process holds the radio right now")
+    options = parser.parse_args()
+
+    try:
+        registry = ChannelRegistry.from_config(lightsconfig.load(options.config, snapshot=False))
+        indexes = registry.resolve(options.names) if options.names else range(len(registry))
+    except (OSError, lightsconfig.ConfigError, KeyError) as err:
+        sys.stderr.write('%s\n' % err)
+        return 1
+    for i in indexes:
+        channel = registry.channels[i]
+        groups = sorted(group for (group, members) in registry.groups.items() if channel in members)
+        sys.stdout.write('%-12s on %-8s off %-8s %s%s\n' % (channel.name, channel.on, channel.off,
+                                                           'managed ' if channel.manage else '',
+                                                           ' '.join(groups)))
+    if options.who:
+        try:
+            with open(registry.radio.lockfile, 'a') as handle:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            sys.stdout.write('radio %s is idle\n' % registry.radio.lockfile)
+        except OSError:
+            sys.stdout.write('radio %s is busy\n' % registry.radio.lockfile)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
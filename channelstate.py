@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+'''
+Remember what each channel was last told to do.
+
+The RF outlets give no feedback, so the best we know about a channel is the
+last state we commanded, when we did it and whether it was confirmed. That is
+kept in a small JSON file so it survives restarts, and the reconciler uses it
+to only transmit when the desired state differs from the recorded one or the
+record is older than the refresh interval.
+'''
+
+import json
+import logging
+import os
+import threading
+import time
+
+LOGGER = logging.getLogger('LightsManager')
+
+DEFAULT_STATE_FILE = '/var/tmp/LightsManager.state.json'
+DEFAULT_REFRESH = 12 * 60 * 60  # re-send a state at least twice a day
+COMMIT_LOCK = threading.Lock()
+
+
+def channel_name(index, channel):
+    return channel.get('name') or 'channel%d' % (index + 1)
+
+
+class ChannelStateStore():
+    def __init__(self, filename=DEFAULT_STATE_FILE):
+        self.filename = filename
+        self.states = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename, 'r') as handle:
+                self.states = json.load(handle)
+        except (IOError, ValueError) as err:
+            LOGGER.error("Unable to read channel state from '%s': %s. Starting empty.", self.filename, err)
+            self.states = {}
+
+    def get(self, name):
+        return self.states.get(name)
+
+    def record(self, name, state, timestamp=None, confirmed=False):
+        if timestamp is None:
+            timestamp = time.time()
+        self.states[name] = {'state': state, 'timestamp': timestamp, 'confirmed': confirmed}
+        self.dirty = True
+
+    def save(self):
+        '''
+        Write the states through a temporary file so a crash never leaves a
+        truncated state file behind.
+        '''
+        if not self.dirty:
+            return True
+        import tempfile
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        try:
+            (fd, tmpname) = tempfile.mkstemp(prefix='.channelstate', dir=dirname)
+            with os.fdopen(fd, 'w') as handle:
+                json.dump(self.states, handle, sort_keys=True)
+            os.replace(tmpname, self.filename)
+        except (IOError, OSError) as err:
+            LOGGER.error("Unable to save channel state to '%s': %s", self.filename, err)
+            return False
+        self.dirty = False
+        return True
+
+
+class Reconciler():
+    def __init__(self, store, refresh=DEFAULT_REFRESH):
+        self.store = store
+        self.refresh = refresh
+
+    def needs_transmit(self, name, desired, now=None):
+        if now is None:
+            now = time.time()
+        last = self.store.get(name)
+        if last is None:
+            return True
+        if last.get('state') != desired:
+            return True
+        if self.refresh is not None and now - last.get('timestamp', 0) >= self.refresh:
+            return True
+        return False
+
+    def pending(self, channels, desired, now=None):
+        '''
+        Indexes of the managed channels that have to be sent `desired`
+        '''
+        indexes = []
+        for i, channel in enumerate(channels):
+            if channel.get('manage') is not True:
+                continue
+            name = channel_name(i, channel)
+            if self.needs_transmit(name, desired, now):
+                indexes.append(i)
+            else:
+                LOGGER.info("Channel '%s' already %s; not transmitting.", name, desired)
+        return indexes
+
+    def commit(self, channels, desired, indexes, now=None, confirmed=False):
+        with COMMIT_LOCK:
+            # pick up whatever a concurrent cycle (e.g. a manual switch)
+            # committed since this store was loaded
+            self.store.load()
+            for i in indexes:
+                self.store.record(channel_name(i, channels[i]), desired, now, confirmed)
+            return self.store.save()
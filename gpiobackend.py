@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+'''
+GPIO access for rcswitch, behind one small interface.
+
+    RPiGPIOBackend     RPi.GPIO
+    GpioChipBackend    the /dev/gpiochipN character device through libgpiod
+    SimulatedBackend   no hardware; every edge is recorded with its
+                       perf_counter_ns timestamp into preallocated arrays
+
+A backend drives output pins, reports input edges to a callback as
+(pin, level, timestamp_ns) and provides the microsecond delays used between
+edges. Pins are physical header pins (BOARD numbering, as rcswitch always
+used) whichever backend is in use; each backend translates them to its own
+numbering, so switching backends never moves the transmitter. Pass
+numbering='bcm' to address Broadcom GPIO numbers (gpiochip line offsets)
+instead. get_backend() picks a backend from a name or the RCSWITCH_BACKEND
+environment variable, so rcswitch imports and runs on any Linux box:
+
+    RCSWITCH_BACKEND=sim rcswitch.py -c 87347 -p 185 -t 11
+    gpiobackend.py --benchmark     edge throughput and timing
+    rcswitch.py --benchmark        sessions, encoding and code words
+
+The simulator runs in virtual time by default: delays advance a
+nanosecond counter instead of sleeping, so protocol output can be checked
+edge for edge and thousands of frames are generated per second. With
+realtime=True it busy-waits like the hardware backends do, and the recorded
+timestamps show the edge timing accuracy the host can achieve.
+'''
+
+import array
+import os
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+
+LOW = 0
+HIGH = 1
+DEFAULT_CAPACITY = 1 << 20  # edges kept by SimulatedBackend
+SPIN_NS = 200000  # busy-wait the last 200 us of a delay instead of sleeping
+NUMBERINGS = ('board', 'bcm')
+
+# Raspberry Pi 40-pin header: BOARD pin to BCM GPIO (the gpiochip0 line
+# offset); the pins left out are power and ground
+BOARD_TO_BCM = {
+    3: 2, 5: 3, 7: 4, 8: 14, 10: 15, 11: 17, 12: 18, 13: 27, 15: 22, 16: 23, 18: 24, 19: 10, 21: 9,
+    22: 25, 23: 11, 24: 8, 26: 7, 27: 0, 28: 1, 29: 5, 31: 6, 32: 12, 33: 13, 35: 19, 36: 16, 37: 26,
+    38: 20, 40: 21,
+}
+
+
+def check_numbering(numbering):
+    if numbering not in NUMBERINGS:
+        raise ValueError("Unknown pin numbering '%s' (choose from %s)" % (numbering, ', '.join(NUMBERINGS)))
+    return numbering
+
+
+def bcm_gpio(pin, numbering='board'):
+    '''
+    BCM GPIO number of `pin` in `numbering`
+    '''
+    if numbering == 'bcm':
+        return pin
+    if pin not in BOARD_TO_BCM:
+        raise ValueError('Header pin %s is not a GPIO pin (power or ground)' % pin)
+    return BOARD_TO_BCM[pin]
+
+
+def spin_until(deadline_ns):
+    '''
+    Wait until perf_counter_ns() reaches `deadline_ns`, sleeping while it
+    is far away and spinning for the last stretch
+    '''
+    remaining = deadline_ns - time.perf_counter_ns()
+    if remaining > SPIN_NS:
+        time.sleep((remaining - SPIN_NS) / 1e9)
+    while time.perf_counter_ns() < deadline_ns:
+        pass
+
+
+class GPIOBackend():
+    '''
+    Interface shared by the backends. Pins are BOARD header pins unless
+    the backend was created with numbering='bcm'.
+    '''
+    name = 'none'
+
+    def setup_output(self, pin):
+        raise NotImplementedError
+
+    def setup_input(self, pin):
+        raise NotImplementedError
+
+    def output(self, pin, level):
+        raise NotImplementedError
+
+    def add_edge_callback(self, pin, callback):
+        '''
+        Call `callback(pin, level, timestamp_ns)` on every edge of `pin`
+        '''
+        raise NotImplementedError
+
+    def remove_edge_callback(self, pin):
+        raise NotImplementedError
+
+    def now_ns(self):
+        return time.perf_counter_ns()
+
+    def delay_us(self, duration):
+        spin_until(time.perf_counter_ns() + int(duration * 1000))
+
+    def cleanup(self):
+        pass
+
+
+class RPiGPIOBackend(GPIOBackend):
+    name = 'rpi'
+
+    def __init__(self, numbering='board'):
+        from RPi import GPIO
+        self.GPIO = GPIO
+        self.numbering = check_numbering(numbering)
+        GPIO.setmode(GPIO.BOARD if numbering == 'board' else GPIO.BCM)
+
+    def setup_output(self, pin):
+        bcm_gpio(pin, self.numbering)
+        self.GPIO.setup(pin, self.GPIO.OUT)
+
+    def setup_input(self, pin):
+        bcm_gpio(pin, self.numbering)
+        self.GPIO.setup(pin, self.GPIO.IN)
+
+    def output(self, pin, level):
+        self.GPIO.output(pin, level)
+
+    def add_edge_callback(self, pin, callback):
+        GPIO = self.GPIO
+        GPIO.add_event_detect(pin, GPIO.BOTH,
+                              lambda channel: callback(channel, GPIO.input(channel), time.perf_counter_ns()))
+
+    def remove_edge_callback(self, pin):
+        self.GPIO.remove_event_detect(pin)
+
+    def cleanup(self):
+        self.GPIO.cleanup()
+
+
+class GpioChipBackend(GPIOBackend):
+    '''
+    Lines of /dev/gpiochipN through the libgpiod (v2) Python bindings. Pins
+    are translated to line offsets through BOARD_TO_BCM. Edge events carry
+    kernel timestamps, which are converted to perf_counter_ns.
+    '''
+    name = 'gpiochip'
+
+    def __init__(self, chip='/dev/gpiochip0', consumer='rcswitch', numbering='board'):
+        import gpiod
+        self.gpiod = gpiod
+        self.chip = chip
+        self.consumer = consumer
+        self.numbering = check_numbering(numbering)
+        self.requests = {}
+        self.lines = {}
+        self.watchers = {}
+
+    def line(self, pin):
+        return bcm_gpio(pin, self.numbering)
+
+    def _request(self, pin, settings):
+        line = self.line(pin)
+        self.release(pin)
+        self.requests[pin] = self.gpiod.request_lines(self.chip, consumer=self.consumer,
+                                                      config={line: settings})
+        self.lines[pin] = line
+
+    def setup_output(self, pin):
+        from gpiod.line import Direction, Value
+        self._request(pin, self.gpiod.LineSettings(direction=Direction.OUTPUT, output_value=Value.INACTIVE))
+
+    def setup_input(self, pin):
+        from gpiod.line import Direction, Edge
+        self._request(pin, self.gpiod.LineSettings(direction=Direction.INPUT, edge_detection=Edge.BOTH))
+
+    def output(self, pin, level):
+        from gpiod.line import Value
+        self.requests[pin].set_value(self.lines[pin], Value.ACTIVE if level else Value.INACTIVE)
+
+    def add_edge_callback(self, pin, callback):
+        if pin not in self.requests:
+            self.setup_input(pin)
+        request = self.requests[pin]
+        # kernel event timestamps are CLOCK_MONOTONIC
+        offset = time.perf_counter_ns() - time.monotonic_ns()
+        rising = self.gpiod.EdgeEvent.Type.RISING_EDGE
+        stop = threading.Event()
+
+        def watch():
+            while not stop.is_set():
+                if not request.wait_edge_events(0.1):
+                    continue
+                for event in request.read_edge_events():
+                    callback(pin, HIGH if event.event_type == rising else LOW, event.timestamp_ns + offset)
+        thread = threading.Thread(target=watch, name='gpiochip-%d' % pin, daemon=True)
+        self.watchers[pin] = (thread, stop)
+        thread.start()
+
+    def remove_edge_callback(self, pin):
+        (thread, stop) = self.watchers.pop(pin, (None, None))
+        if thread is not None:
+            stop.set()
+            thread.join()
+
+    def release(self, pin):
+        self.remove_edge_callback(pin)
+        self.lines.pop(pin, None)
+        request = self.requests.pop(pin, None)
+        if request is not None:
+            request.release()
+
+    def cleanup(self):
+        for pin in list(self.requests):
+            self.release(pin)
+
+
+class SimulatedBackend(GPIOBackend):
+    '''
+    Records every output edge as (pin, level, timestamp_ns) in preallocated
+    arrays; edges past `capacity` are counted in `overflow` and dropped.
+    Output pins can be connect()ed to input pins to loop edges back into
+    edge callbacks, e.g. to feed a receiver with our own transmissions.
+    '''
+    name = 'sim'
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, realtime=False):
+        self.capacity = capacity
+        self.realtime = realtime
+        self.times = array.array('q', bytes(8 * capacity))
+        self.pins = array.array('h', bytes(2 * capacity))
+        self.levels = bytearray(capacity)
+        self.count = 0
+        self.overflow = 0
+        self.clock = time.perf_counter_ns()
+        self.modes = {}
+        self.state = {}
+        self.callbacks = {}
+        self.links = {}
+
+    def reset(self):
+        self.count = 0
+        self.overflow = 0
+
+    def setup_output(self, pin):
+        self.modes[pin] = 'out'
+        self.state[pin] = LOW
+
+    def setup_input(self, pin):
+        self.modes[pin] = 'in'
+        self.state[pin] = LOW
+
+    def connect(self, output_pin, input_pin):
+        self.links.setdefault(output_pin, []).append(input_pin)
+
+    def now_ns(self):
+        if self.realtime:
+            return time.perf_counter_ns()
+        return self.clock
+
+    def delay_us(self, duration):
+        if self.realtime:
+            spin_until(time.perf_counter_ns() + int(duration * 1000))
+        else:
+            self.clock += int(duration * 1000)
+
+    def output(self, pin, level):
+        if self.modes.get(pin) != 'out':
+            raise RuntimeError('GPIO pin %s is not set up for output' % pin)
+        stamp = self.now_ns()
+        n = self.count
+        if n < self.capacity:
+            self.times[n] = stamp
+            self.pins[n] = pin
+            self.levels[n] = level
+            self.count = n + 1
+        else:
+            self.overflow += 1
+        self.state[pin] = level
+        for target in self.links.get(pin, ()):
+            self.state[target] = level
+            callback = self.callbacks.get(target)
+            if callback is not None:
+                callback(target, level, stamp)
+
+    def add_edge_callback(self, pin, callback):
+        self.callbacks[pin] = callback
+
+    def remove_edge_callback(self, pin):
+        self.callbacks.pop(pin, None)
+
+    def edges(self, pin=None):
+        '''
+        Recorded (timestamp_ns, level) pairs, optionally for one pin only
+        '''
+        return [(self.times[n], self.levels[n]) for n in range(self.count) if pin is None or self.pins[n] == pin]
+
+    def durations_us(self, pin=None):
+        '''
+        Microseconds between consecutive recorded edges
+        '''
+        stamps = [stamp for (stamp, level) in self.edges(pin)]
+        return [(b - a) / 1000.0 for (a, b) in zip(stamps, stamps[1:])]
+
+    def cleanup(self):
+        self.modes.clear()
+        self.callbacks.clear()
+
+
+BACKENDS = {
+    'rpi': RPiGPIOBackend,
+    'gpiochip': GpioChipBackend,
+    'sim': SimulatedBackend,
+}
+
+
+def get_backend(name=None, **kwargs):
+    '''
+    Backend `name`, $RCSWITCH_BACKEND, or the first of RPi.GPIO and
+    gpiochip that works here
+    '''
+    name = name or os.environ.get('RCSWITCH_BACKEND')
+    if name:
+        if name not in BACKENDS:
+            raise ValueError("Unknown GPIO backend '%s' (choose from %s)" % (name, ', '.join(sorted(BACKENDS))))
+        return BACKENDS[name](**kwargs)
+    errors = []
+    for name in ('rpi', 'gpiochip'):
+        try:
+            return BACKENDS[name](**kwargs)
+        except (ImportError, RuntimeError, OSError) as err:
+            errors.append('%s: %s' % (name, err))
+    raise RuntimeError('No GPIO backend available (%s); set RCSWITCH_BACKEND=sim to simulate'
+                       % '; '.join(errors))
+
+
+def benchmark(code='000101010101000101010101', pulse_len=185, repeats=10, frames=200):
+    from rcswitch import RCSwitch
+
+    expected = []
+    for bit in code:
+        expected.extend((1, 3) if bit == '0' else (3, 1))
+    expected.extend((1, 31))
+    expected = [pulse_len * units for units in expected * repeats]
+
+    backend = SimulatedBackend(capacity=len(expected) * frames + 16)
+    rcswitch = RCSwitch(transmitterPin=11, pulseLength=pulse_len, repeatTransmit=repeats, backend=backend)
+    rcswitch.enableTransmit(11)
+    start = time.perf_counter()
+    for n in range(frames):
+        rcswitch.send(code, len(code))
+    elapsed = time.perf_counter() - start
+    durations = backend.durations_us()
+    # the gap after a frame's last sync low is not part of the waveform
+    per_frame = len(expected)
+    correct = all(durations[n * per_frame:(n + 1) * per_frame - 1] == expected[:-1] for n in range(frames))
+    sys.stdout.write('virtual: %d frames, %d edges in %.3f s (%.0f edges/s), waveform %s\n'
+                     % (frames, backend.count, elapsed, backend.count / elapsed,
+                        'correct' if correct else 'WRONG'))
+
+    backend = SimulatedBackend(capacity=len(expected) + 16, realtime=True)
+    rcswitch = RCSwitch(transmitterPin=11, pulseLength=pulse_len, repeatTransmit=repeats, backend=backend)
+    rcswitch.enableTransmit(11)
+    rcswitch.send(code, len(code))
+    errors = sorted(abs(actual - wanted) for (actual, wanted) in zip(backend.durations_us(), expected))
+    sys.stdout.write('realtime: %d edges, timing error mean %.1f us, p99 %.1f us, max %.1f us\n'
+                     % (backend.count, sum(errors) / len(errors), errors[int(0.99 * len(errors))], errors[-1]))
+
+    # receive: our own frames looped back into a receiver on pin 13
+    backend = SimulatedBackend(capacity=len(expected) * 4 + 16, realtime=True)
+    backend.connect(11, 13)
+    rcswitch = RCSwitch(transmitterPin=11, pulseLength=pulse_len, repeatTransmit=repeats, backend=backend)
+    rcswitch.enableTransmit(11)
+    receiver = RCSwitch(backend=backend)
+    receiver.enableReceive(13)
+    for n in range(4):
+        rcswitch.send(code, len(code))
+    receiver.disableReceive()
+    received = receiver.getReceivedValue() == int(code, 2)
+    stamp = time.perf_counter_ns()
+    push = receiver.ring.push
+    start = time.perf_counter()
+    for n in range(100000):
+        push(13, HIGH, stamp)
+    elapsed = time.perf_counter() - start
+    sys.stdout.write('receive: %d edges looped back, %d frames decoded, %d edges lost, code %s, %.0f ns per edge callback\n'
+                     % (backend.count, receiver.receivedCount, receiver.getLostEdges(),
+                        'correct' if received else 'WRONG', elapsed * 1e4))
+
+    return 0 if correct and received else 1
+
+
+def main():
+    parser = ArgumentParser(description='Check which GPIO backend rcswitch would use, or benchmark the simulator')
+    parser.add_argument("-b","--benchmark",dest="benchmark",action="store_true",default=False,
+                        help="measure simulated throughput, waveform correctness, edge timing accuracy and receiving")
+    parser.add_argument("-n","--frames",dest="frames",type=int,default=200,
+                        metavar="FRAMES",help="frames to send in the throughput benchmark")
+    options = parser.parse_args()
+
+    if options.benchmark:
+        return benchmark(frames=options.frames)
+    try:
+        backend = get_backend()
+    except (RuntimeError, ValueError) as err:
+        sys.stderr.write('%s\n' % err)
+        return 1
+    sys.stdout.write('%s\n' % backend.name)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+'''
+Solar-relative switching rules for light channels.
+
+A rule is a comma (or semicolon) separated list of clauses. The first clause
+says when the rule fires, the rest restrict it:
+
+    sunset - 30m
+    civil_twilight_end + 1h, but no later than 22:00
+    sunrise, not before 06:30, weekdays
+    07:15, mon wed fri
+
+The time clause is a sun event name as returned by the API (sunrise,
+civil_twilight_end, ...), one of the aliases dawn/dusk/noon, or a local
+HH:MM clock time, optionally followed by + or - and a duration such as 30m,
+1h or 1h15m. "no later than"/"not after" and "no earlier than"/"not before"
+clamp the fire time to a local clock time. Day clauses are "daily",
+"weekdays", "weekends" or a list of day names (mon or monday, tue or tues
+or tuesday, ...), optionally followed by "only".
+
+Rules are compiled against a precomputed sunevents.SunSeries into a sorted
+array of fire times, so "next fire after T" is a binary search.
+'''
+
+import bisect
+import datetime
+import logging
+import re
+import sys
+import time
+from argparse import ArgumentParser
+
+import sunevents
+from lightsschedule import Timeline
+
+LOGGER = logging.getLogger('LightsManager')
+
+ALIASES = {
+    'dawn': 'civil_twilight_begin',
+    'dusk': 'civil_twilight_end',
+    'noon': 'solar_noon',
+}
+DAY_WORDS = dict((word, n) for (n, words) in enumerate((
+    ('mon', 'monday'),
+    ('tue', 'tues', 'tuesday'),
+    ('wed', 'wednesday'),
+    ('thu', 'thur', 'thurs', 'thursday'),
+    ('fri', 'friday'),
+    ('sat', 'saturday'),
+    ('sun', 'sunday'),
+)) for word in words)
+DAY_SETS = {
+    'daily': frozenset(range(7)),
+    'every day': frozenset(range(7)),
+    'weekdays': frozenset(range(5)),
+    'weekends': frozenset((5, 6)),
+}
+DURATION_UNITS = {'h': 3600, 'm': 60, 's': 1}
+DEFAULT_RULES = {'on': 'sunrise', 'off': 'sunset'}
+
+TIME_RE = re.compile(r'^(?P<anchor>[a-z_]+|\d{1,2}:\d{2})\s*(?:(?P<sign>[-+])\s*(?P<offset>(?:\d+\s*[hms]\s*)+))?$')
+DURATION_RE = re.compile(r'(\d+)\s*([hms])')
+CLOCK_RE = re.compile(r'^(\d{1,2}):(\d{2})$')
+LATEST_RE = re.compile(r'^(?:but\s+)?(?:no later than|not after)\s+(\S+)$')
+EARLIEST_RE = re.compile(r'^(?:but\s+)?(?:no earlier than|not before)\s+(\S+)$')
+
+
+class RuleError(ValueError):
+    pass
+
+
+def parse_clock(text):
+    match = CLOCK_RE.match(text)
+    if not match:
+        raise RuleError("Invalid clock time '%s', expected HH:MM" % text)
+    (hour, minute) = (int(match.group(1)), int(match.group(2)))
+    if hour > 23 or minute > 59:
+        raise RuleError("Invalid clock time '%s'" % text)
+    return datetime.time(hour, minute)
+
+
+def parse_duration(text):
+    return sum(int(n) * DURATION_UNITS[unit] for (n, unit) in DURATION_RE.findall(text))
+
+
+def parse_days(text):
+    '''
+    Weekday numbers (Monday = 0) of a day clause, or None if it is not one.
+    Day names must be whole or one of their usual abbreviations.
+    '''
+    text = re.sub(r'\s+only$', '', text)
+    if text in DAY_SETS:
+        return DAY_SETS[text]
+    days = set()
+    for word in re.split(r'[\s/]+', text):
+        if word not in DAY_WORDS:
+            return None
+        days.add(DAY_WORDS[word])
+    return frozenset(days)
+
+
+class Rule():
+    def __init__(self, text, anchor, offset=0, earliest=None, latest=None, days=DAY_SETS['daily']):
+        self.text = text
+        self.anchor = anchor
+        self.offset = offset
+        self.earliest = earliest
+        self.latest = latest
+        self.days = days
+
+    def __repr__(self):
+        return 'Rule(%r)' % self.text
+
+    def fire_times(self, series):
+        '''
+        Sorted epochs at which the rule fires over every day of `series`. Days
+        on which the anchor event does not happen (polar day/night) are skipped.
+        '''
+        if isinstance(self.anchor, datetime.time):
+            base = series.clock_column(self.anchor)
+        else:
+            base = series.column(self.anchor)
+        lows = series.clock_column(self.earliest) if self.earliest else None
+        highs = series.clock_column(self.latest) if self.latest else None
+        days = self.days
+        offset = self.offset
+        fires = []
+        for n, (when, weekday) in enumerate(zip(base, series.weekdays)):
+            if when is None or weekday not in days:
+                continue
+            when += offset
+            if lows is not None and when < lows[n]:
+                when = lows[n]
+            if highs is not None and when > highs[n]:
+                when = highs[n]
+            fires.append(when)
+        fires.sort()
+        return fires
+
+    def compile(self, series):
+        return RuleTimeline(self, self.fire_times(series))
+
+
+class RuleTimeline():
+    def __init__(self, rule, epochs):
+        self.rule = rule
+        self.epochs = epochs
+
+    def __len__(self):
+        return len(self.epochs)
+
+    def next_fire(self, when):
+        '''
+        First fire time strictly after `when`, or None
+        '''
+        i = bisect.bisect_right(self.epochs, when)
+        if i == len(self.epochs):
+            return None
+        return self.epochs[i]
+
+    def last_fire(self, when):
+        i = bisect.bisect_right(self.epochs, when)
+        if i == 0:
+            return None
+        return self.epochs[i-1]
+
+
+def compile_rule(text):
+    clauses = [c.strip() for c in re.split(r'[,;]', text.replace('−', '-').replace('–', '-').lower())]
+    clauses = [c for c in clauses if c]
+    if not clauses:
+        raise RuleError('Empty rule')
+    match = TIME_RE.match(clauses[0])
+    if not match:
+        raise RuleError("Cannot parse time clause '%s' in rule '%s'" % (clauses[0], text))
+    anchor = match.group('anchor')
+    if ':' in anchor:
+        anchor = parse_clock(anchor)
+    else:
+        anchor = ALIASES.get(anchor, anchor)
+        if anchor not in sunevents.EVENT_KEYS:
+            raise RuleError("Unknown sun event '%s' in rule '%s'" % (anchor, text))
+    offset = 0
+    if match.group('offset'):
+        offset = parse_duration(match.group('offset'))
+        if match.group('sign') == '-':
+            offset = -offset
+
+    rule = Rule(text, anchor, offset)
+    for clause in clauses[1:]:
+        latest = LATEST_RE.match(clause)
+        earliest = EARLIEST_RE.match(clause)
+        if latest:
+            rule.latest = parse_clock(latest.group(1))
+        elif earliest:
+            rule.earliest = parse_clock(earliest.group(1))
+        else:
+            days = parse_days(clause)
+            if days is None:
+                raise RuleError("Cannot parse clause '%s' in rule '%s'" % (clause, text))
+            rule.days = days
+    return rule
+
+
+def channel_timeline(channel, series, default_rules=DEFAULT_RULES, initial='off'):
+    '''
+    Timeline of on/off transitions for a channel with a "rules" entry
+    '''
+    rules = dict(default_rules)
+    rules.update(channel.get('rules', {}))
+    transitions = []
+    for (state, text) in rules.items():
+        for when in compile_rule(text).fire_times(series):
+            transitions.append((when, state))
+    return Timeline(transitions, initial)
+
+
+def benchmark(rules=1000, years=5, queries=100000, latitude=39.63, longitude=-119.9):
+    import random
+    templates = ['sunset - %dm', 'sunrise + %dm, weekdays', 'civil_twilight_end + %dm, but no later than 22:00',
+                 'dawn - %dm, not before 05:30, weekends', '06:%02d, mon wed fri']
+    texts = [templates[n % len(templates)] % (n % 60) for n in range(rules)]
+
+    start = time.perf_counter()
+    series = sunevents.SunSeries(datetime.date.today(), int(years * 365.25), latitude, longitude)
+    t_series = time.perf_counter() - start
+
+    start = time.perf_counter()
+    compiled = [compile_rule(text) for text in texts]
+    t_parse = time.perf_counter() - start
+
+    start = time.perf_counter()
+    timelines = [rule.compile(series) for rule in compiled]
+    t_compile = time.perf_counter() - start
+
+    span = (series.clock_column(datetime.time(0, 0))[0], series.clock_column(datetime.time(0, 0))[-1])
+    probes = [(random.choice(timelines), random.uniform(*span)) for n in range(queries)]
+    start = time.perf_counter()
+    for (timeline, when) in probes:
+        timeline.next_fire(when)
+    t_query = time.perf_counter() - start
+
+    fires = sum(len(t) for t in timelines)
+    sys.stdout.write('%d days of sun events: %.3f s\n' % (len(series), t_series))
+    sys.stdout.write('parse %d rules: %.3f s\n' % (rules, t_parse))
+    sys.stdout.write('compile %d fire times: %.3f s (%.2f us/fire)\n' % (fires, t_compile, 1e6 * t_compile / max(fires, 1)))
+    sys.stdout.write('%d next_fire queries: %.3f s (%.2f us/query)\n' % (queries, t_query, 1e6 * t_query / queries))
+
+
+def main():
+    parser = ArgumentParser(description='Check light switching rules and list their next fire times')
+    parser.add_argument("rules", nargs='*', metavar="RULE", help="rule to compile")
+    parser.add_argument("-t","--latitude",dest="latitude",type=float,default=39.63472221,
+                        metavar="LATITUDE",help="compute sun events for latitude LATITUDE")
+    parser.add_argument("-g","--longitude",dest="longitude",type=float,default=-119.89666667,
+                        metavar="LONGITUDE",help="compute sun events for longitude LONGITUDE")
+    parser.add_argument("-n","--days",dest="days",type=int,default=7,
+                        metavar="DAYS",help="list fire times for the next DAYS days")
+    parser.add_argument("-b","--benchmark",dest="benchmark",action="store_true",default=False,
+                        help="time compiling and querying many rules over several years")
+    parser.add_argument("--bench-rules",dest="bench_rules",type=int,default=1000,
+                        metavar="N",help="number of rules to benchmark")
+    parser.add_argument("--bench-years",dest="bench_years",type=float,default=5,
+                        metavar="YEARS",help="years of sun events to benchmark")
+    options = parser.parse_args()
+
+    if options.benchmark:
+        benchmark(options.bench_rules, options.bench_years, latitude=options.latitude, longitude=options.longitude)
+        return 0
+
+    series = sunevents.SunSeries(datetime.date.today(), options.days, options.latitude, options.longitude)
+    for text in options.rules:
+        try:
+            timeline = compile_rule(text).compile(series)
+        except RuleError as err:
+            sys.stderr.write('%s\n' % err)
+            return 1
+        sys.stdout.write('%s\n' % text)
+        for when in timeline.epochs:
+            sys.stdout.write('  %s\n' % time.strftime('%a %F %T %Z', time.localtime(when)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,530 @@
+#!/usr/bin/env python3
+'''
+Load, validate and watch the LightsManager/EnvironmentManager configuration.
+
+Both the JSON configuration of LightsManager and the INI configuration of
+EnvironmentManager are compiled into the same typed, __slots__ based
+snapshot (Config), so the managers read `config.lights.pulse.start` instead
+of chains of dict lookups and float() conversions on every cycle. The
+configuration is validated once, when it is compiled; a broken file raises
+ConfigError with the offending key. Pins (lights.txpin, lights.verify.rxpin
+and default.txpin in the INI file) are physical header pin numbers (BOARD
+numbering), as rcswitch's backends take them: the data line of the usual
+433 MHz transmitter wiring is pin 11 (GPIO17), not 17, which is 3V3 power.
+
+The normalized configuration of an INI file is cached next to it as a
+marshal snapshot keyed by the file's mtime and size, so an unchanged file
+is never parsed through ConfigParser twice. JSON is parsed directly, which
+is faster than reading a snapshot back. ConfigWatcher polls the file with
+stat() and recompiles it when it changes, so a running daemon picks up
+edits without a restart:
+
+    lightsconfig.py -c lights.json
+    lightsconfig.py -c EnvironmentManager.cfg --benchmark
+'''
+
+import json
+import logging
+import marshal
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+LOGGER = logging.getLogger('LightsManager')
+
+SNAPSHOT_VERSION = 5
+SNAPSHOT_SUFFIX = '.snapshot'
+DEFAULT_POLL = 5.0  # seconds between stat() calls of a ConfigWatcher
+INI_SUFFIXES = ('.cfg', '.ini')
+
+
+class ConfigError(ValueError):
+    pass
+
+
+# The sections below are built by Config from normalize()d dicts, in which
+# normalize() has already filled in every default.
+class LocationConfig():
+    __slots__ = ('latitude', 'longitude', 'timezone')
+
+    def __init__(self, latitude=None, longitude=None, timezone=None):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.timezone = timezone
+
+
+class PulseConfig():
+    __slots__ = ('start', 'end', 'spacing', 'retransmit', 'gap')
+
+    def __init__(self, start, end, spacing, retransmit, gap):
+        self.start = start
+        self.end = end
+        self.spacing = spacing
+        self.retransmit = retransmit
+        self.gap = gap
+
+    @property
+    def lengths(self):
+        return range(self.start, self.end)
+
+
+class VerifyConfig():
+    __slots__ = ('rxpin', 'confirmations', 'listen', 'stats_file')
+
+    def __init__(self, rxpin, confirmations, listen, stats_file):
+        self.rxpin = rxpin
+        self.confirmations = confirmations
+        self.listen = listen
+        self.stats_file = stats_file
+
+
+class PolicyConfig():
+    __slots__ = ('min_retransmit', 'max_retransmit', 'min_pulses', 'target', 'alpha', 'streak', 'state_file')
+
+    def __init__(self, min_retransmit, max_retransmit, min_pulses, target, alpha, streak, state_file):
+        self.min_retransmit = min_retransmit
+        self.max_retransmit = max_retransmit
+        self.min_pulses = min_pulses
+        self.target = target
+        self.alpha = alpha
+        self.streak = streak
+        self.state_file = state_file
+
+
+class ChannelConfig():
+    '''
+    One RF channel. get() mirrors dict.get so the planner, reconciler and
+    rule modules can take these in place of the raw channel dicts.
+    '''
+    __slots__ = ('index', 'name', 'on', 'off', 'manage', 'rules', 'groups')
+
+    def __init__(self, index, name, on=None, off=None, manage=False, rules=None, groups=()):
+        self.index = index
+        self.name = name
+        self.on = on
+        self.off = off
+        self.manage = manage
+        self.rules = rules
+        self.groups = groups
+
+    def __repr__(self):
+        return 'ChannelConfig(%r, on=%r, off=%r)' % (self.name, self.on, self.off)
+
+    def get(self, key, default=None):
+        value = getattr(self, key) if key in self.__slots__ else None
+        return default if value is None else value
+
+
+class LightsConfig():
+    __slots__ = ('txpin', 'pulse', 'deadline', 'state_file', 'refresh', 'debounce', 'channels', 'groups', 'verify',
+                 'policy')
+
+    def __init__(self, txpin, pulse, channels, deadline, state_file, refresh, debounce, groups=None,
+                 verify=None, policy=None):
+        self.txpin = txpin
+        self.pulse = pulse
+        self.channels = channels
+        self.deadline = deadline
+        self.state_file = state_file
+        self.refresh = refresh
+        self.debounce = debounce
+        self.groups = groups or {}
+        self.verify = verify
+        self.policy = policy
+
+
+class Config():
+    '''
+    Compiled configuration. get() returns the normalized sections as plain
+    dicts for code that takes the JSON layout (e.g. sunprovider's "api").
+    '''
+    __slots__ = ('source', 'stamp', 'sections', 'location', 'lights', 'loglevel')
+
+    def __init__(self, sections, source=None, stamp=None):
+        self.source = source
+        self.stamp = stamp
+        self.sections = sections
+        location = sections.get('location', {})
+        self.location = LocationConfig(location.get('latitude'), location.get('longitude'),
+                                       location.get('timezone'))
+        self.lights = None
+        lights = sections.get('lights')
+        if lights is not None:
+            channels = tuple(ChannelConfig(i, **channel) for (i, channel) in enumerate(lights['channels']))
+            self.lights = LightsConfig(lights['txpin'], PulseConfig(**lights['pulse']), channels,
+                                       lights['deadline'], lights['state_file'], lights['refresh'],
+                                       lights['debounce'], lights['groups'],
+                                       lights['verify'] and VerifyConfig(**lights['verify']),
+                                       lights['policy'] and PolicyConfig(**lights['policy']))
+        self.loglevel = sections.get('logging', {}).get('loglevel')
+
+    def get(self, section, default=None):
+        return self.sections.get(section, default)
+
+
+def _number(value, where, kind=float, low=None, high=None):
+    if isinstance(value, bool):
+        raise ConfigError("%s: expected a number, got %r" % (where, value))
+    try:
+        number = kind(value)
+    except (TypeError, ValueError):
+        raise ConfigError("%s: expected %s, got %r" % (where, 'an integer' if kind is int else 'a number', value))
+    if (low is not None and number < low) or (high is not None and number > high):
+        raise ConfigError("%s: %r is out of range" % (where, value))
+    return number
+
+
+def _optional(section, key, where, kind=float, low=None, high=None, default=None):
+    value = section.get(key)
+    if value is None or value == '':
+        return default
+    return _number(value, '%s.%s' % (where, key), kind, low, high)
+
+
+def _normalize_channel(i, channel):
+    import channelstate
+    where = 'lights.channels[%d]' % i
+    if not isinstance(channel, dict):
+        raise ConfigError('%s: expected an object' % where)
+    normalized = {
+        'name': channelstate.channel_name(i, channel),
+        'on': _optional(channel, 'on', where, int, 0),
+        'off': _optional(channel, 'off', where, int, 0),
+        'manage': channel.get('manage') is True,
+        'rules': None,
+        'groups': channel.get('groups', []),
+    }
+    if isinstance(normalized['groups'], str):
+        normalized['groups'] = normalized['groups'].split()
+    rules = channel.get('rules')
+    if rules:
+        if not isinstance(rules, dict) or set(rules) - set(('on', 'off')):
+            raise ConfigError("%s.rules: expected an object with 'on' and/or 'off' rules" % where)
+        normalized['rules'] = dict((state, str(text)) for (state, text) in rules.items())
+    return normalized
+
+
+def normalize(obj):
+    '''
+    Validate a configuration in the JSON layout and fill in the defaults.
+    Returns plain dicts/lists/numbers only, so the result can be marshalled.
+    '''
+    # the modules that own the defaults are only needed when a file is
+    # compiled, not when its snapshot is loaded
+    import actuationqueue
+    import channelstate
+    import lightsplanner
+    import rfpolicy
+    import rfverify
+
+    if not isinstance(obj, dict):
+        raise ConfigError('configuration: expected an object')
+    sections = dict((key, value) for (key, value) in obj.items() if key not in ('location', 'lights'))
+
+    location = obj.get('location') or {}
+    sections['location'] = {
+        'latitude': _optional(location, 'latitude', 'location', float, -90.0, 90.0),
+        'longitude': _optional(location, 'longitude', 'location', float, -180.0, 180.0),
+        'timezone': location.get('timezone') or None,
+    }
+
+    lights = obj.get('lights')
+    if lights is None:
+        return sections
+    if not isinstance(lights, dict):
+        raise ConfigError('lights: expected an object')
+    pulse = lights.get('pulse') or {}
+    normalized = {
+        'txpin': _optional(lights, 'txpin', 'lights', int, 0),
+        'pulse': {
+            'start': _number(pulse.get('start'), 'lights.pulse.start', int, 1),
+            'end': _number(pulse.get('end'), 'lights.pulse.end', int, 1),
+            'spacing': _optional(pulse, 'spacing', 'lights.pulse', float, 0.0, default=0.0),
+            'retransmit': _optional(pulse, 'retransmit', 'lights.pulse', int, 1, default=1),
+            'gap': _optional(pulse, 'gap', 'lights.pulse', float, 0.0, default=lightsplanner.DEFAULT_GAP),
+        },
+        'deadline': _optional(lights, 'deadline', 'lights', float, 0.0),
+        'state_file': lights.get('state_file') or channelstate.DEFAULT_STATE_FILE,
+        'refresh': _optional(lights, 'refresh', 'lights', float, 0.0, default=channelstate.DEFAULT_REFRESH),
+        'debounce': _optional(lights, 'debounce', 'lights', float, 0.0, default=actuationqueue.DEFAULT_WINDOW),
+    }
+    if normalized['pulse']['end'] <= normalized['pulse']['start']:
+        raise ConfigError('lights.pulse: end (%d) must be greater than start (%d)'
+                          % (normalized['pulse']['end'], normalized['pulse']['start']))
+
+    verify = lights.get('verify')
+    normalized['verify'] = None
+    if verify is not None:
+        if not isinstance(verify, dict):
+            raise ConfigError('lights.verify: expected an object')
+        normalized['verify'] = {
+            'rxpin': _number(verify.get('rxpin'), 'lights.verify.rxpin', int, 0),
+            'confirmations': _optional(verify, 'confirmations', 'lights.verify', int, 1,
+                                       default=rfverify.DEFAULT_CONFIRMATIONS),
+            'listen': _optional(verify, 'listen', 'lights.verify', float, 0.0, default=rfverify.DEFAULT_LISTEN),
+            'stats_file': verify.get('stats_file') or rfverify.DEFAULT_STATS_FILE,
+        }
+        if normalized['verify']['rxpin'] == normalized['txpin']:
+            raise ConfigError('lights.verify.rxpin: must not be the transmitter pin')
+
+    policy = lights.get('policy')
+    normalized['policy'] = None
+    if policy is not None:
+        if not isinstance(policy, dict):
+            raise ConfigError('lights.policy: expected an object')
+        normalized['policy'] = {
+            'min_retransmit': _optional(policy, 'min_retransmit', 'lights.policy', int, 1,
+                                        default=rfpolicy.DEFAULT_MIN_RETRANSMIT),
+            'max_retransmit': _optional(policy, 'max_retransmit', 'lights.policy', int, 1),
+            'min_pulses': _optional(policy, 'min_pulses', 'lights.policy', int, 1, default=rfpolicy.DEFAULT_MIN_PULSES),
+            'target': _optional(policy, 'target', 'lights.policy', float, 0.0, 1.0, default=rfpolicy.DEFAULT_TARGET),
+            'alpha': _optional(policy, 'alpha', 'lights.policy', float, 0.0, 1.0, default=rfpolicy.DEFAULT_ALPHA),
+            'streak': _optional(policy, 'streak', 'lights.policy', int, 1, default=rfpolicy.DEFAULT_STREAK),
+            'state_file': policy.get('state_file') or rfpolicy.DEFAULT_STATE_FILE,
+        }
+        if (normalized['policy']['max_retransmit'] is not None
+                and normalized['policy']['max_retransmit'] < normalized['policy']['min_retransmit']):
+            raise ConfigError('lights.policy: max_retransmit (%d) must not be less than min_retransmit (%d)'
+                              % (normalized['policy']['max_retransmit'], normalized['policy']['min_retransmit']))
+
+    channels = lights.get('channels') or []
+    if not isinstance(channels, list):
+        raise ConfigError('lights.channels: expected a list')
+    normalized['channels'] = [_normalize_channel(i, channel) for (i, channel) in enumerate(channels)]
+    names = [channel['name'] for channel in normalized['channels']]
+    for name in set(names):
+        if names.count(name) > 1:
+            raise ConfigError("lights.channels: channel name '%s' is used %d times" % (name, names.count(name)))
+
+    groups = dict((group, list(members.split() if isinstance(members, str) else members))
+                  for (group, members) in (lights.get('groups') or {}).items())
+    for channel in normalized['channels']:
+        for group in channel['groups']:
+            groups.setdefault(group, [])
+            if channel['name'] not in groups[group]:
+                groups[group].append(channel['name'])
+    for (group, members) in groups.items():
+        for name in members:
+            if name not in names:
+                raise ConfigError("lights.groups.%s: unknown channel '%s'" % (group, name))
+    normalized['groups'] = groups
+    sections['lights'] = normalized
+    return sections
+
+
+def from_ini(parser):
+    '''
+    Translate an EnvironmentManager style ConfigParser into the JSON layout.
+    [channelN] sections become channels; the ones named in [lights] groups
+    are managed. Other sections are kept as dicts of strings.
+    '''
+    default = parser.defaults()
+    obj = dict((name, dict((key, value) for (key, value) in parser.items(name) if key not in default))
+               for name in parser.sections())
+    if default.get('loglevel'):
+        obj['logging'] = {'loglevel': default.get('loglevel')}
+
+    groups = dict((group, members.split()) for (group, members) in obj.pop('lights', {}).items())
+    managed = set(name for members in groups.values() for name in members)
+    channels = []
+    for name in parser.sections():
+        if not name.startswith('channel'):
+            continue
+        section = obj.pop(name)
+        channels.append({'name': name, 'on': section.get('code_on'), 'off': section.get('code_off'),
+                         'manage': name in managed})
+    if channels or groups:
+        pulse_len = _optional(default, 'pulse_len', 'default', int, 1)
+        if pulse_len is None:
+            raise ConfigError('default.pulse_len: required when channels are configured')
+        txpin = _optional(default, 'txpin', 'default', int, 0)
+        if txpin is None:
+            raise ConfigError('default.txpin: required when channels are configured')
+        obj['lights'] = {'txpin': txpin, 'pulse': {'start': pulse_len, 'end': pulse_len + 1}, 'channels': channels,
+                         'groups': groups}
+    return obj
+
+
+def is_ini(filename):
+    return os.path.splitext(filename)[1].lower() in INI_SUFFIXES
+
+
+def parse(filename):
+    '''
+    Normalized configuration of a JSON or INI file
+    '''
+    if is_ini(filename):
+        import configparser
+        # EnvironmentManager.cfg spells the defaults section [default]
+        parser = configparser.ConfigParser(default_section='default')
+        try:
+            with open(filename, 'r') as handle:
+                parser.read_file(handle)
+        except configparser.Error as err:
+            raise ConfigError('%s: %s' % (filename, err))
+        return normalize(from_ini(parser))
+    with open(filename, 'r') as handle:
+        try:
+            obj = json.load(handle)
+        except ValueError as err:
+            raise ConfigError('%s: %s' % (filename, err))
+    return normalize(obj)
+
+
+def file_stamp(filename):
+    stat = os.stat(filename)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def snapshot_name(filename):
+    (dirname, basename) = os.path.split(os.path.abspath(filename))
+    return os.path.join(dirname, '.' + basename + SNAPSHOT_SUFFIX)
+
+
+def read_snapshot(filename, stamp):
+    try:
+        with open(snapshot_name(filename), 'rb') as handle:
+            (version, source, saved_stamp, sections) = marshal.load(handle)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if version != SNAPSHOT_VERSION or source != os.path.abspath(filename) or tuple(saved_stamp) != stamp:
+        return None
+    return sections
+
+
+def write_snapshot(filename, stamp, sections):
+    '''
+    Best effort: a read-only configuration directory just means no snapshot
+    '''
+    import tempfile
+    target = snapshot_name(filename)
+    try:
+        (fd, tmpname) = tempfile.mkstemp(prefix='.lightsconfig', dir=os.path.dirname(target))
+        with os.fdopen(fd, 'wb') as handle:
+            marshal.dump((SNAPSHOT_VERSION, os.path.abspath(filename), stamp, sections), handle)
+        os.replace(tmpname, target)
+    except (OSError, ValueError) as err:
+        LOGGER.debug("Unable to write configuration snapshot '%s': %s", target, err)
+        return False
+    return True
+
+
+def compile_config(obj, source=None, stamp=None):
+    '''
+    Config from an already loaded configuration object (JSON layout)
+    '''
+    return Config(normalize(obj), source, stamp)
+
+
+def load(filename, snapshot=True):
+    '''
+    Compiled configuration of `filename`; an INI file comes from its
+    snapshot when it has not changed since the snapshot was written
+    '''
+    stamp = file_stamp(filename)
+    snapshot = snapshot and is_ini(filename)
+    sections = read_snapshot(filename, stamp) if snapshot else None
+    if sections is None:
+        sections = parse(filename)
+        if snapshot:
+            write_snapshot(filename, stamp, sections)
+    return Config(sections, filename, stamp)
+
+
+class ConfigWatcher():
+    '''
+    Keep the compiled configuration of `filename` current by polling its
+    mtime at most every `interval` seconds. A file that fails to load keeps
+    the last good configuration in place.
+    '''
+    def __init__(self, filename, interval=DEFAULT_POLL, snapshot=True):
+        self.filename = filename
+        self.interval = interval
+        self.snapshot = snapshot
+        self.config = load(filename, snapshot)
+        self.stamp = self.config.stamp
+        self.checked = time.monotonic()
+        self.reloads = 0
+
+    def reload(self):
+        '''
+        The new configuration if the file changed since the last load, else None
+        '''
+        self.checked = time.monotonic()
+        try:
+            stamp = file_stamp(self.filename)
+        except OSError as err:
+            LOGGER.error("Unable to stat configuration '%s': %s. Keeping the current one.", self.filename, err)
+            return None
+        if stamp == self.stamp:
+            return None
+        # do not retry a broken file until it changes again
+        self.stamp = stamp
+        try:
+            config = load(self.filename, self.snapshot)
+        except (OSError, ConfigError) as err:
+            LOGGER.error("Unable to reload configuration '%s': %s. Keeping the current one.", self.filename, err)
+            return None
+        LOGGER.warning("Reloaded configuration from '%s'", self.filename)
+        self.config = config
+        self.reloads += 1
+        return config
+
+    def current(self):
+        if time.monotonic() - self.checked >= self.interval:
+            self.reload()
+        return self.config
+
+
+def benchmark(filename, loops=10000):
+    start = time.perf_counter()
+    for n in range(loops):
+        parse(filename)
+    t_parse = (time.perf_counter() - start) / loops
+    stamp = file_stamp(filename)
+    write_snapshot(filename, stamp, parse(filename))
+    start = time.perf_counter()
+    for n in range(loops):
+        read_snapshot(filename, stamp)
+    t_load = (time.perf_counter() - start) / loops
+    if not is_ini(filename):
+        # load() never reads it back for JSON
+        os.unlink(snapshot_name(filename))
+    config = load(filename)
+    start = time.perf_counter()
+    for n in range(loops):
+        config.get('lights').get('pulse').get('start')
+    t_dict = (time.perf_counter() - start) / loops
+    start = time.perf_counter()
+    for n in range(loops):
+        config.lights.pulse.start
+    t_slots = (time.perf_counter() - start) / loops
+    sys.stdout.write('parse and validate: %.1f us\n' % (1e6 * t_parse))
+    sys.stdout.write('load from snapshot: %.1f us\n' % (1e6 * t_load))
+    sys.stdout.write('dict lookup chain: %.3f us\n' % (1e6 * t_dict))
+    sys.stdout.write('attribute lookup: %.3f us\n' % (1e6 * t_slots))
+
+
+def main():
+    parser = ArgumentParser(description='Validate a LightsManager or EnvironmentManager configuration')
+    parser.add_argument("-c","--config",dest="config",required=True,
+                        metavar="CONFIG",help="validate CONFIG (JSON, or INI with a .cfg/.ini suffix)")
+    parser.add_argument("-b","--benchmark",dest="benchmark",action="store_true",default=False,
+                        help="time parsing, snapshot loading and lookups")
+    options = parser.parse_args()
+
+    if options.benchmark:
+        benchmark(options.config)
+        return 0
+    try:
+        config = load(options.config, snapshot=False)
+    except (OSError, ConfigError) as err:
+        sys.stderr.write('%s\n' % err)
+        return 1
+    sys.stdout.write(json.dumps(config.sections, sort_keys=True, indent=4) + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+'''
+Switch lights through the running LightsManager daemon.
+
+Requests go over the daemon's control socket and are sent by its resident
+transmitter right away, next to whatever the schedule is doing:
+
+    lightsctl.py primary on
+    lightsctl.py daytime toggle
+    lightsctl.py --state
+    lightsctl.py --feedback missed porch
+    lightsctl.py --benchmark 50 --target 100 night on
+
+The daemon replies once the first frame is on the air and reports how long
+that took (latency_ms). --benchmark repeats a request and reports the round
+trip and first-frame latencies, exiting non-zero when the 95th percentile
+is over the target. --feedback tells the daemon's retransmit policy
+(lights.policy) whether the last sweep of the channels switched them.
+'''
+
+import json
+import sys
+import time
+from argparse import ArgumentParser
+
+import runlock
+
+SOCKET_NAME = 'LightsManager'  # LightsManager_v2.SOCKET_NAME
+DEFAULT_TARGET = 100.0  # milliseconds to the first frame on air
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def benchmark(request, count, target, timeout):
+    (round_trips, latencies, errors) = ([], [], 0)
+    for n in range(count):
+        start = time.perf_counter()
+        reply = runlock.send(SOCKET_NAME, request, timeout)
+        round_trips.append(1000 * (time.perf_counter() - start))
+        if reply is None or 'error' in reply:
+            errors += 1
+        elif 'latency_ms' in reply:
+            latencies.append(reply['latency_ms'])
+    for (name, values) in (('round trip', round_trips), ('first frame', latencies)):
+        if values:
+            sys.stdout.write('%-12s p50 %7.2f ms  p95 %7.2f ms  max %7.2f ms\n'
+                             % (name, percentile(values, 0.5), percentile(values, 0.95), max(values)))
+    if errors:
+        sys.stdout.write('%d of %d requests failed\n' % (errors, count))
+    worst = percentile(latencies or round_trips, 0.95)
+    if worst > target:
+        sys.stderr.write('95th percentile %.2f ms is over the %.2f ms target\n' % (worst, target))
+        return 1
+    return 1 if errors else 0
+
+
+def main():
+    parser = ArgumentParser(description='Switch lights through the running LightsManager')
+    parser.add_argument("channels", nargs='?', metavar="NAMES",
+                        help="comma separated channels or groups to switch")
+    parser.add_argument("state", nargs='?', choices=('on', 'off', 'toggle'), help="state to switch to")
+    parser.add_argument("-s","--state",dest="query",action="store_true",default=False,
+                        help="print the last commanded and scheduled state of every channel")
+    parser.add_argument("-f","--feedback",dest="feedback",choices=('worked', 'missed'),default=None,
+                        help="report whether the channels' last sweep switched them")
+    parser.add_argument("-b","--benchmark",dest="benchmark",type=int,default=0,
+                        metavar="COUNT",help="send the request COUNT times and report the latencies")
+    parser.add_argument("--target",dest="target",type=float,default=DEFAULT_TARGET,
+                        metavar="MS",help="fail the benchmark when the 95th percentile is over MS milliseconds")
+    parser.add_argument("-t","--timeout",dest="timeout",type=float,default=10.0,
+                        metavar="SECONDS",help="wait at most SECONDS for the daemon to answer")
+    options = parser.parse_args()
+
+    if options.feedback is not None:
+        if not options.channels:
+            parser.error('--feedback needs the channels it is about')
+        request = {'command': 'feedback', 'channels': options.channels.split(','),
+                   'worked': options.feedback == 'worked'}
+    elif options.query or not options.channels:
+        request = {'command': 'state'}
+    elif options.state is None:
+        parser.error('a state (on, off or toggle) is required')
+    else:
+        request = {'command': 'set', 'channels': options.channels.split(','), 'state': options.state}
+
+    if options.benchmark:
+        return benchmark(request, options.benchmark, options.target, options.timeout)
+    reply = runlock.send(SOCKET_NAME, request, options.timeout)
+    if reply is None:
+        sys.stderr.write('LightsManager is not running\n')
+        return 1
+    sys.stdout.write(json.dumps(reply, sort_keys=True, indent=4) + '\n')
+    return 1 if 'error' in reply else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
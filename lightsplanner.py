@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+'''
+Plan and run the RF transmissions for a single lights event.
+
+Rather than sweeping every pulse length for one channel before moving on to
+the next, all managed channels are interleaved into one airtime schedule:
+every channel gets its first frame in the first round, the per-channel
+"spacing" pause is filled with frames for the other channels, and consecutive
+frames are always at least "gap" seconds apart. The plan is executed by a
+single worker, so frames never overlap on the air, and anything that would
+not finish within the event deadline is dropped, except that every channel
+keeps at least one frame.
+'''
+
+import collections
+import heapq
+import logging
+import time
+
+LOGGER = logging.getLogger('LightsManager')
+
+DEFAULT_GAP = 0.05        # seconds between the end of one frame and the next
+DEFAULT_BITS = 24         # bit length of the codes sent by codesend
+DEFAULT_REPEATS = 10      # codesend/RCSwitch repeatTransmit default
+
+Frame = collections.namedtuple('Frame', ['offset', 'channel', 'code', 'pulse_len', 'airtime'])
+
+
+class TransmissionPlan():
+    def __init__(self, frames, dropped=0, deadline=None):
+        self.frames = frames
+        self.dropped = dropped
+        self.deadline = deadline
+        self.sent = collections.Counter()
+        self.skipped = collections.Counter()
+        self.late = collections.Counter()
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __iter__(self):
+        return iter(self.frames)
+
+    def duration(self):
+        if not self.frames:
+            return 0.0
+        last = self.frames[-1]
+        return last.offset + last.airtime
+
+    def channel_deadlines(self):
+        '''
+        Offset at which each channel has received its first frame
+        '''
+        first = {}
+        for frame in self.frames:
+            first.setdefault(frame.channel, frame.offset + frame.airtime)
+        return first
+
+    def unsent(self):
+        '''
+        Channels in the plan that had no frame sent and were not skipped
+        '''
+        return sorted(set(frame.channel for frame in self.frames) - set(self.sent) - set(self.skipped))
+
+
+def frame_airtime(pulse_len, bits=DEFAULT_BITS, repeats=DEFAULT_REPEATS):
+    '''
+    Seconds on air for one protocol 1 frame: 4 pulses per bit plus a 1:31 sync,
+    repeated `repeats` times.
+    '''
+    return (bits * 4 + 32) * pulse_len * repeats / 1000000.0
+
+
+def build_plan(channels, key, pulse_lengths, retransmit=1, gap=DEFAULT_GAP, spacing=0.0,
+               deadline=None, bits=DEFAULT_BITS, repeats=DEFAULT_REPEATS, only=None, managed_only=True,
+               overrides=None):
+    '''
+    Build an interleaved schedule sending each managed channel's `key` code at
+    every pulse length in `pulse_lengths`, `retransmit` times per length.
+
+    A channel waits `spacing` seconds between pulse lengths; other channels are
+    scheduled into that pause. Frames are placed greedily, earliest-ready
+    channel first with round-robin tie breaking, so the first round reaches
+    every channel before any channel gets a second frame. When `only` is
+    given, channels whose index is not in it are left out; unmanaged channels
+    are only included with `managed_only` False (manual control).
+    `overrides` maps a channel index to its own (pulse_lengths, retransmit),
+    sent in the order given, in place of the global ones. Frames that would
+    not finish by `deadline` are dropped, but a channel always keeps its
+    first frame.
+    '''
+    def sweep(pulse_lengths, retransmit):
+        retransmit = max(int(retransmit or 1), 1)
+        return [(pulse_len, xmt) for pulse_len in pulse_lengths for xmt in range(retransmit)]
+    steps = sweep(pulse_lengths, retransmit)
+    overrides = overrides or {}
+
+    pending = {}
+    ready = []
+    seq = 0
+    for i, channel in enumerate(channels):
+        if only is not None and i not in only:
+            continue
+        if managed_only and channel.get("manage") is not True:
+            LOGGER.info("Skipping unmanaged channel %d.", i+1)
+            continue
+        code = channel.get(key)
+        if not code:
+            LOGGER.warning('Skipping channel "%s" with no "%s" key', channel, key)
+            continue
+        todo = collections.deque(sweep(*overrides[i]) if i in overrides else steps)
+        if not todo:
+            continue
+        pending[i] = (code, todo)
+        heapq.heappush(ready, (0.0, seq, i))
+        seq += 1
+
+    frames = []
+    planned = set()
+    dropped = 0
+    cursor = 0.0
+    while ready:
+        (ready_at, _, i) = heapq.heappop(ready)
+        (code, todo) = pending[i]
+        (pulse_len, xmt) = todo.popleft()
+        airtime = frame_airtime(pulse_len, bits, repeats)
+        start = max(cursor, ready_at)
+        if deadline is not None and start + airtime > deadline:
+            dropped += len(todo)
+            todo.clear()
+            if i in planned:
+                dropped += 1
+                continue
+            LOGGER.warning('Channel %d: its only frame ends %.2f seconds past the deadline',
+                           i+1, start + airtime - deadline)
+        planned.add(i)
+        frames.append(Frame(start, i, code, pulse_len, airtime))
+        cursor = start + airtime + gap
+        if todo:
+            next_ready = start + airtime
+            if todo[0][0] != pulse_len:
+                next_ready += spacing
+            heapq.heappush(ready, (next_ready, seq, i))
+            seq += 1
+
+    if dropped:
+        LOGGER.warning('Dropped %d frames that would not finish within the %.2f second deadline',
+                       dropped, deadline)
+    return TransmissionPlan(frames, dropped, deadline)
+
+
+def execute_plan(plan, send, clock=None, sleep=None, done=None):
+    '''
+    Run every frame of `plan` from the calling thread, holding each one back
+    until its scheduled offset. `send(frame)` returns True on success, which
+    is counted per channel in `plan.sent`. When `done(channel)` is true the
+    channel needs nothing more (e.g. its code was heard), and its remaining
+    frames are skipped and counted in `plan.skipped`. Once the deadline has
+    passed, frames are counted in `plan.late` instead of being sent, except
+    a channel's last frame when none of its frames went out yet. Returns the
+    number of frames that failed to send.
+    '''
+    clock = clock or time.monotonic
+    sleep = sleep or time.sleep
+    last = dict((frame.channel, n) for (n, frame) in enumerate(plan.frames))
+    errors = 0
+    start = clock()
+    for n, frame in enumerate(plan.frames):
+        if done is not None and done(frame.channel):
+            plan.skipped[frame.channel] += 1
+            continue
+        elapsed = clock() - start
+        if plan.deadline is not None and elapsed > plan.deadline:
+            if plan.sent[frame.channel] or last[frame.channel] != n:
+                plan.late[frame.channel] += 1
+                continue
+        wait = frame.offset - elapsed
+        if wait > 0:
+            sleep(wait)
+        LOGGER.info("Channel %d: transmitting code '%s' with pulse length %d",
+                    frame.channel+1, frame.code, frame.pulse_len)
+        try:
+            if send(frame):
+                plan.sent[frame.channel] += 1
+            else:
+                errors += 1
+        except Exception as err:
+            LOGGER.error("Error sending code: %s", err)
+            errors += 1
+    if plan.late:
+        LOGGER.warning('Deadline of %.2f seconds passed; skipped %d frames',
+                       plan.deadline, sum(plan.late.values()))
+    return errors
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+'''
+Work out what the lights should be doing at any instant.
+
+A timeline is a sorted series of (epoch, state) transitions. The desired
+state at an instant is the state of the last transition at or before it,
+found with a binary search, so a late start can apply the correct state
+straight away and then wait only for the transitions still ahead.
+'''
+
+import bisect
+import datetime
+import logging
+
+LOGGER = logging.getLogger('LightsManager')
+
+SUN_TRANSITIONS = (('sunrise', 'on'), ('sunset', 'off'))
+# the event a polar day or night carries on from: the sun stays up or down
+POLAR_EVENTS = {'day': 'sunrise', 'night': 'sunset'}
+
+
+def parse_event(value):
+    '''
+    Epoch seconds for an ISO 8601 time as returned by the API with formatted=0
+    '''
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+
+class Timeline():
+    def __init__(self, transitions=(), initial='off'):
+        transitions = sorted(transitions)
+        self.epochs = [t[0] for t in transitions]
+        self.states = [t[1] for t in transitions]
+        self.initial = initial
+
+    def __len__(self):
+        return len(self.epochs)
+
+    def state_at(self, when):
+        i = bisect.bisect_right(self.epochs, when)
+        if i == 0:
+            return self.initial
+        return self.states[i-1]
+
+    def next_transition(self, when):
+        '''
+        First (epoch, state) strictly after `when`, or None
+        '''
+        i = bisect.bisect_right(self.epochs, when)
+        if i == len(self.epochs):
+            return None
+        return (self.epochs[i], self.states[i])
+
+    def transitions_after(self, when):
+        i = bisect.bisect_right(self.epochs, when)
+        return list(zip(self.epochs[i:], self.states[i:]))
+
+
+def sun_timeline(*days, transitions=SUN_TRANSITIONS, initial='off'):
+    '''
+    Timeline from one or more API 'results' objects. A polar day or night
+    (locally computed results with a 'polar' entry) has no transitions; it
+    keeps the state of the event it carries on from, which is the initial
+    state when it comes first.
+    '''
+    points = []
+    for data in days:
+        if not data:
+            continue
+        if data.get('polar') in POLAR_EVENTS:
+            if not points:
+                initial = dict(transitions).get(POLAR_EVENTS[data.get('polar')], initial)
+            continue
+        for (event, state) in transitions:
+            value = data.get(event)
+            if value is None:
+                LOGGER.warning("Results object has no '%s' key", event)
+                continue
+            points.append((parse_event(value), state))
+    return Timeline(points, initial)
+
+
+def desired_states(channels, timelines, when, default=None):
+    '''
+    Map each managed channel index to its desired state at `when`. `timelines`
+    maps channel indexes to their own Timeline; channels without one use
+    `default`.
+    '''
+    desired = {}
+    for i, channel in enumerate(channels):
+        if channel.get('manage') is not True:
+            continue
+        timeline = timelines.get(i, default)
+        if timeline is None:
+            continue
+        desired[i] = timeline.state_at(when)
+    return desired
+
+
+def next_change(timelines, when):
+    '''
+    Earliest transition epoch after `when` across several timelines
+    '''
+    upcoming = [t.next_transition(when) for t in timelines]
+    upcoming = [t[0] for t in upcoming if t is not None]
+    if not upcoming:
+        return None
+    return min(upcoming)
+
+
+def group_by_state(desired):
+    groups = {}
+    for i, state in desired.items():
+        groups.setdefault(state, []).append(i)
+    return groups
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+'''
+Fast-forward LightsManager schedules on a virtual clock.
+
+Runs the real LightsManager_v2.run_schedule once per simulated day, the way
+the daily cron job would, with time.time/time.monotonic/time.sleep replaced
+by a virtual clock and LightsManager_v2.send_code by a fake transmitter that
+records every code sent. Channels are actuated through the debounce queue, which
+the virtual clock flushes as its commands fall due. Sun times come from
+sunevents instead of the API, so years of schedules, DST changes and polar
+days replay in seconds. On a polar day or night the sun neither rises nor
+sets: channels following it stay on (day) or off (night) all day, channels
+with their own rules skip the events that do not happen, and the summary
+counts both kinds of days under 'polar'.
+
+    lightssim.py -c lights.json --days 1461 --timezone America/Los_Angeles --log actuations.csv
+    lightssim.py --latitude 78.2 --longitude 15.6 --timezone Arctic/Longyearbyen --days 366
+    lightssim.py --benchmark --budget 20
+
+The summary is written to stdout as JSON. With --benchmark, only the run
+time is reported and --budget makes the exit status non-zero when the run
+takes longer than BUDGET seconds, so scheduling-cost regressions show up.
+'''
+
+import collections
+import contextlib
+import datetime
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import LightsManager_v2
+import actuationqueue
+import channelstate
+import lightsconfig
+import lightsplanner
+import sunevents
+
+LOGGER = logging.getLogger('LightsManager')
+
+DEFAULT_CONFIG = {
+    "location": {"latitude": 39.63472221, "longitude": -119.89666667},
+    "lights": {
+        "txpin": 11,
+        "pulse": {"start": 184, "end": 187, "spacing": 1.0, "retransmit": 2},
+        "channels": [
+            {"name": "primary", "on": 87347, "off": 87356, "manage": True},
+            {"name": "secondary", "on": 87491, "off": 87500, "manage": True,
+             "rules": {"on": "sunrise + 30m, weekdays", "off": "sunset - 1h, but no later than 18:00"}},
+            {"name": "night", "on": 87811, "off": 87820, "manage": True,
+             "rules": {"on": "civil_twilight_end", "off": "23:00"}}
+        ]
+    }
+}
+
+
+class VirtualClock():
+    '''
+    Simulated time. With an actuationqueue.ActuationQueue attached, the
+    commands falling due while asleep are flushed at their due time.
+    '''
+    def __init__(self, now=0.0, queue=None):
+        self.now = now
+        self.slept = 0.0
+        self.queue = queue
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        if seconds <= 0:
+            return
+        end = self.now + seconds
+        # the frames a flush sends take time too: detach the queue meanwhile
+        (queue, self.queue) = (self.queue, None)
+        try:
+            while queue is not None:
+                due = queue.next_due()
+                if due is None or due > end:
+                    break
+                self.now = max(self.now, due)
+                queue.flush(self.now)
+        finally:
+            self.queue = queue
+        self.now = max(self.now, end)
+        self.slept += seconds
+
+    def advance_to(self, when):
+        if when > self.now:
+            self.sleep(when - self.now)
+
+
+class FakeTransmitter():
+    '''
+    Stands in for LightsManager_v2.send_code: records the code and pulse
+    length with the virtual time and takes the frame's airtime to "send".
+    '''
+    def __init__(self, clock, codes, airtime):
+        self.clock = clock
+        self.codes = codes
+        self.airtime = airtime
+        self.log = []
+
+    def send(self, config, frame, on_air=None):
+        (name, state) = self.codes.get(frame.code, ('unknown', str(frame.code)))
+        self.log.append((self.clock.now, name, state, frame.code, frame.pulse_len))
+        if on_air is not None:
+            on_air(True)
+        self.clock.sleep(self.airtime(frame.pulse_len))
+        return True
+
+
+@contextlib.contextmanager
+def patched(clock, transmitter):
+    saved = (time.time, time.monotonic, time.sleep, LightsManager_v2.send_code)
+    (time.time, time.monotonic, time.sleep, LightsManager_v2.send_code) = (clock.time, clock.time, clock.sleep,
+                                                                           transmitter.send)
+    try:
+        yield
+    finally:
+        (time.time, time.monotonic, time.sleep, LightsManager_v2.send_code) = saved
+
+
+def simulate(config, start, days, tz=None, start_time=datetime.time(0, 5)):
+    config = json.loads(json.dumps(config))
+    location = config.get("location")
+    (latitude, longitude) = (float(location.get("latitude")), float(location.get("longitude")))
+    channels = config.get("lights").get("channels")
+    codes = {}
+    for i, channel in enumerate(channels):
+        for state in ('on', 'off'):
+            if channel.get(state):
+                codes[int(channel.get(state))] = (channelstate.channel_name(i, channel), state)
+
+    # the state file and radio lock go away with the run, however it ends
+    with tempfile.TemporaryDirectory(prefix='lightssim') as statedir:
+        config["lights"]["state_file"] = os.path.join(statedir, 'state.json')
+        config["radio"] = {"lock": os.path.join(statedir, 'radio.lock')}
+        compiled = lightsconfig.compile_config(config)
+        clock = VirtualClock()
+        transmitter = FakeTransmitter(clock, codes, lightsplanner.frame_airtime)
+        # actuate through the debounce queue like the daemon, on the virtual clock
+        clock.queue = actuationqueue.ActuationQueue(
+            lambda state, indexes, priority: LightsManager_v2.actuate(compiled, dict((i, state) for i in indexes),
+                                                                      priority),
+            window=compiled.lights.debounce, clock=clock.time)
+        LightsManager_v2.SCHEDULE['queue'] = clock.queue
+        polar = collections.Counter()
+        try:
+            with patched(clock, transmitter):
+                for n in range(days):
+                    date = start + datetime.timedelta(days=n)
+                    clock.advance_to(datetime.datetime.combine(date, start_time, tz).timestamp())
+                    events = sunevents.compute_day(date, latitude, longitude)
+                    if events.get(sunevents.POLAR_KEY):
+                        polar[events.get(sunevents.POLAR_KEY)] += 1
+                    LightsManager_v2.run_schedule(compiled, location, sunevents.as_results(events))
+                clock.queue.flush(everything=True)
+        finally:
+            LightsManager_v2.SCHEDULE.pop('queue', None)
+    return (transmitter.log, polar, clock.queue.stats())
+
+
+def actuations(log):
+    '''
+    Collapse the frame log into one entry per channel state change
+    '''
+    changes = []
+    last = {}
+    for (when, name, state, code, pulse_len) in log:
+        if last.get(name) == state:
+            continue
+        last[name] = state
+        changes.append((when, name, state))
+    return changes
+
+
+def summarize(log, changes, days, polar, queue, tz, runtime):
+    local_minutes = collections.defaultdict(list)
+    counts = collections.Counter()
+    for (when, name, state) in changes:
+        counts['%s %s' % (name, state)] += 1
+        stamp = datetime.datetime.fromtimestamp(when, tz)
+        local_minutes['%s %s' % (name, state)].append(stamp.hour * 60 + stamp.minute)
+    airtime = sum(lightsplanner.frame_airtime(entry[4]) for entry in log)
+    summary = {
+        'days': days,
+        'polar_days': sum(polar.values()),
+        'polar': dict(polar),
+        'queue': queue,
+        'frames': len(log),
+        'airtime_seconds': round(airtime, 3),
+        'actuations': dict(counts),
+        'local_time_range': dict((k, ['%02d:%02d' % divmod(min(v), 60), '%02d:%02d' % divmod(max(v), 60)])
+                                 for (k, v) in local_minutes.items()),
+        'runtime_seconds': round(runtime, 3),
+    }
+    return summary
+
+
+def main():
+    parser = ArgumentParser(description='Replay LightsManager schedules on a virtual clock')
+    parser.add_argument("-c","--config",dest="config",default=None,
+                        metavar="CONFIG",help="use LightsManager configuration from CONFIG file (JSON serialized)")
+    parser.add_argument("-t","--latitude",dest="latitude",type=float,default=None,
+                        metavar="LATITUDE",help="simulate at latitude LATITUDE")
+    parser.add_argument("-g","--longitude",dest="longitude",type=float,default=None,
+                        metavar="LONGITUDE",help="simulate at longitude LONGITUDE")
+    parser.add_argument("-z","--timezone",dest="timezone",default=None,
+                        metavar="TZ",help="simulate in time zone TZ (e.g. America/Los_Angeles)")
+    parser.add_argument("-s","--start",dest="start",default=None,
+                        metavar="YYYY-MM-DD",help="first simulated day (default: January 1st this year)")
+    parser.add_argument("-n","--days",dest="days",type=int,default=4*365+1,
+                        metavar="DAYS",help="number of days to simulate")
+    parser.add_argument("-l","--log",dest="log",default=None,
+                        metavar="LOGFILE",help="write the actuation log to LOGFILE as CSV")
+    parser.add_argument("-b","--benchmark",dest="benchmark",action="store_true",default=False,
+                        help="only report the simulation run time")
+    parser.add_argument("--budget",dest="budget",type=float,default=None,
+                        metavar="BUDGET",help="exit non-zero if the run takes more than BUDGET seconds")
+    parser.add_argument("-v","--verbose",dest="verbose",action="store_true",default=False,
+                        help="output LightsManager log messages")
+    options = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s: %(message)s')
+    LOGGER.setLevel(logging.INFO if options.verbose else logging.ERROR)
+
+    config = DEFAULT_CONFIG
+    if options.config is not None:
+        with open(options.config, 'r') as handle:
+            config = json.load(handle)
+    config = json.loads(json.dumps(config))
+    if options.latitude is not None:
+        config.setdefault("location", {})["latitude"] = options.latitude
+    if options.longitude is not None:
+        config.setdefault("location", {})["longitude"] = options.longitude
+
+    tz = None
+    tzname = options.timezone or config.get("location", {}).get("timezone")
+    if tzname:
+        # keep naive local-time conversions consistent with the simulated zone
+        os.environ['TZ'] = tzname
+        time.tzset()
+        config["location"]["timezone"] = tzname
+        import zoneinfo
+        tz = zoneinfo.ZoneInfo(tzname)
+
+    start = datetime.date(datetime.date.today().year, 1, 1)
+    if options.start:
+        start = datetime.date.fromisoformat(options.start)
+
+    began = time.perf_counter()
+    (log, polar, queue) = simulate(config, start, options.days, tz)
+    runtime = time.perf_counter() - began
+    changes = actuations(log)
+
+    if options.benchmark:
+        sys.stdout.write('Simulated %d days (%d frames) in %.3f s: %.1f days/s\n'
+                         % (options.days, len(log), runtime, options.days / runtime))
+    else:
+        if options.log:
+            with open(options.log, 'w') as handle:
+                handle.write('time,channel,state\n')
+                for (when, name, state) in changes:
+                    handle.write('%s,%s,%s\n' % (datetime.datetime.fromtimestamp(when, tz).isoformat(), name, state))
+        summary = summarize(log, changes, options.days, polar, queue, tz, runtime)
+        sys.stdout.write(json.dumps(summary, sort_keys=True, indent=4) + '\n')
+
+    if options.budget is not None and runtime > options.budget:
+        sys.stderr.write('Simulation took %.3f s, over the %.3f s budget\n' % (runtime, options.budget))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
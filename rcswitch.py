@@ -1,56 +1,265 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
+import array
+import collections
+import functools
+import itertools
 import os, sys
+import threading
 import time
-from RPi import GPIO
+import types
+
+import gpiobackend
+from gpiobackend import HIGH, LOW
 
 RCSWITCH_MAX_CHANGES = 67
+RCSWITCH_SEPARATION_LIMIT = 4300   # microseconds; longer gaps are sync gaps between frames
+RCSWITCH_RING_SIZE = 4096   # edges buffered between the edge callback and the decoder
+RCSWITCH_DECODE_POLL = 0.002   # seconds the decoder sleeps when the ring is empty
+RCSWITCH_MAX_WAVEFORMS = 1024   # compiled waveforms kept per RCSwitch
+RCSWITCH_ENCODE_CACHE = 4096   # (code, length) encodings kept
+
+# Pulse shapes in multiples of the pulse length, as (high, low). An inverted
+# protocol idles high and sends every pair low first. Another vendor's
+# remote is one more row here; the decoder and the senders are generic.
+Protocol = collections.namedtuple('Protocol', ['pulseLength', 'sync', 'zero', 'one', 'inverted'])
+PROTOCOLS = {
+    1: Protocol(350, (1, 31), (1, 3), (3, 1), False),
+    2: Protocol(650, (1, 10), (1, 2), (2, 1), False),
+    3: Protocol(100, (30, 71), (4, 11), (9, 6), False),
+    4: Protocol(380, (1, 6), (1, 3), (3, 1), False),   # sync gap under the separation limit; send only
+    5: Protocol(500, (6, 14), (1, 2), (2, 1), False),
+    6: Protocol(450, (23, 1), (1, 2), (2, 1), True),   # HT6P20B
+}
+
+def decodeTimings(timings,changeCount,tolerance=60,protocols=PROTOCOLS):
+    '''
+    Match the frame in timings[:changeCount] against every protocol at
+    once. timings[0] is the sync gap before the frame and gives each
+    protocol's pulse length; the short half of the sync must fit too.
+    Pulse pairs are read once, and a protocol drops out at its first pair
+    that is neither a zero nor a one. Returns
+    (value, bitLength, delay, protocol) for the lowest matching protocol,
+    or None.
+    '''
+    # gap, pairs and the short half of the sync: always an even count
+    if changeCount % 2:
+        return None
+    pairs = (changeCount - 2) // 2
+    if pairs < 4:
+        return None
+    gap = timings[0]
+    candidates = []
+    for number in sorted(protocols):
+        protocol = protocols[number]
+        delay = gap / max(protocol.sync)
+        slack = delay * tolerance * 0.01
+        short = timings[1] if protocol.inverted else timings[changeCount - 1]
+        if abs(short - min(protocol.sync) * delay) >= slack:
+            continue
+        # (first timing, zero high/low window, one high/low window)
+        candidates.append([number, delay, 2 if protocol.inverted else 1,
+                           protocol.zero[0] * delay - slack, protocol.zero[0] * delay + slack,
+                           protocol.zero[1] * delay - slack, protocol.zero[1] * delay + slack,
+                           protocol.one[0] * delay - slack, protocol.one[0] * delay + slack,
+                           protocol.one[1] * delay - slack, protocol.one[1] * delay + slack,
+                           0])
+    for k in range(0, 2 * pairs, 2):
+        survivors = []
+        for candidate in candidates:
+            high = timings[candidate[2] + k]
+            low = timings[candidate[2] + k + 1]
+            if candidate[3] < high < candidate[4] and candidate[5] < low < candidate[6]:
+                candidate[11] <<= 1
+            elif candidate[7] < high < candidate[8] and candidate[9] < low < candidate[10]:
+                candidate[11] = (candidate[11] << 1) | 1
+            else:
+                continue
+            survivors.append(candidate)
+        if not survivors:
+            return None
+        candidates = survivors
+    for candidate in candidates:
+        if candidate[11] != 0:
+            return (candidate[11], pairs, candidate[1], candidate[0])
+    return None
+
+# the bits of every byte value, most significant first
+BYTE_BITS = tuple(tuple((byte >> (7 - i)) & 1 for i in range(8)) for byte in range(256))
+
+@functools.lru_cache(maxsize=RCSWITCH_ENCODE_CACHE)
+def encodeCode(code,length):
+    '''
+    The low `length` bits of integer `code`, most significant first, as a
+    tuple of 0 and 1
+    '''
+    if code < 0 or length < 0:
+        raise ValueError("Cannot encode code %d in %d bits"%(code,length))
+    size = (length + 7) // 8
+    bits = ()
+    for byte in (code & ((1 << length) - 1)).to_bytes(size, 'big'):
+        bits += BYTE_BITS[byte]
+    return bits[8 * size - length:]
+
+def encodeCodes(codes,length):
+    '''
+    encodeCode() for each of `codes`, encoding each distinct code once
+    '''
+    encoded = dict((code, encodeCode(code,length)) for code in set(codes))
+    return [encoded[code] for code in codes]
+
+# A tri-state symbol is two bits on the air: '0' = 00, '1' = 11, 'F' = 01
+TRISTATE_BITS = {'0': '00', '1': '11', 'F': '01'}
+CodeWord = collections.namedtuple('CodeWord', ['triState', 'code', 'length'])
+_codeWords = None
+
+def triStateCode(triState):
+    '''
+    (code, length) of a tri-state code word
+    '''
+    bits = ''.join(TRISTATE_BITS[symbol] for symbol in triState)
+    return (int(bits, 2) if bits else 0, len(bits))
+
+def buildCodeWords():
+    '''
+    Every valid type A, B and C code word, keyed by
+        ('A', groupName, switchNumber, status)    10 pole DIP switches
+        ('B', groupNumber, switchNumber, status)  two rotary/sliding switches
+        ('C', family, group, device, status)      Intertechno
+    The words are rc-switch's. Type C addresses go out least significant
+    bit first, as rc-switch and the outlets expect; the earlier version of
+    this module meant to send them most significant bit first (e.g. 'a' 1 2
+    as 000000F00FFF rather than 0000F0000FFF), though it failed before
+    sending anything.
+    '''
+    words = {}
+    switches = [ 'FFFFF', '0FFFF', 'F0FFF', 'FF0FF', 'FFF0F', 'FFFF0' ]
+    for dips in itertools.product('01', repeat=5):
+        groupName = ''.join(dips)
+        group = ''.join('F' if dip == '0' else '0' for dip in groupName)
+        for switchNumber in range(1, 6):
+            for status in (True, False):
+                words[('A', groupName, switchNumber, status)] = group + switches[switchNumber] + ('0F' if status else 'F0')
+    positions = [ 'FFFF', '0FFF', 'F0FF', 'FF0F', 'FFF0' ]
+    for groupNumber in range(1, 5):
+        for switchNumber in range(1, 5):
+            for status in (True, False):
+                words[('B', groupNumber, switchNumber, status)] = (positions[groupNumber] + positions[switchNumber]
+                                                                   + 'FFF' + ('F' if status else '0'))
+    families = [ '0000', 'F000', '0F00', 'FF00', '00F0', 'F0F0', '0FF0', 'FFF0', '000F', 'F00F', '0F0F', 'FF0F', '00FF', 'F0FF', '0FFF', 'FFFF' ]
+    for (n, family) in enumerate(families):
+        for group in range(1, 5):
+            for device in range(1, 5):
+                # device and group numbers go out least significant bit first
+                number = device - 1 + (group - 1) * 4
+                address = ''.join('F' if number >> bit & 1 else '0' for bit in range(4))
+                for status in (True, False):
+                    words[('C', chr(97 + n), group, device, status)] = family + address + '0FF' + ('F' if status else '0')
+    return types.MappingProxyType(dict((key, CodeWord(word, *triStateCode(word))) for (key, word) in words.items()))
+
+def codeWords():
+    '''
+    The code word table, built on first use
+    '''
+    global _codeWords
+    if _codeWords is None:
+        _codeWords = buildCodeWords()
+    return _codeWords
+
+class EdgeRing():
+    '''
+    Fixed-size ring of edge timestamps (ns) with one writer, the edge
+    callback, and one reader, the decoder thread. push() only stores a
+    number and moves the head, so nothing is allocated or decoded in
+    interrupt context; the reader notices when it has been lapped.
+    '''
+    def __init__(self,size=RCSWITCH_RING_SIZE):
+        if size & (size - 1):
+            raise ValueError("Ring size %d is not a power of two"%(size))
+        self.times = array.array('q', bytes(8 * size))
+        self.mask = size - 1
+        self.size = size
+        self.head = 0
+        self.tail = 0
+        self.lost = 0
+
+    def push(self,pin,level,stamp):
+        head = self.head
+        self.times[head & self.mask] = stamp
+        self.head = head + 1
+
+    def pending(self):
+        return self.head - self.tail
+
+    def drain(self):
+        '''
+        Yield the timestamps pushed since the last drain, oldest first;
+        returns early after counting the edges that were overwritten
+        '''
+        head = self.head
+        tail = self.tail
+        if head - tail > self.size:
+            self.lost += head - tail - self.size
+            tail = head - self.size
+            self.tail = tail
+            yield None
+        times = self.times
+        mask = self.mask
+        while tail < head:
+            yield times[tail & mask]
+            tail += 1
+            self.tail = tail
 
 class RCSwitch():
-    def __init__(self,receiverInterrupt=-1,transmitterPin=-1,pulseLength=350,repeatTransmit=10,
+    def __init__(self,receiverInterrupt=-1,transmitterPin=-1,pulseLength=-1,repeatTransmit=10,
                  protocol=1,receiveTolerance=60,receivedValue=None,receivedBitLength=0,
-                 receivedDelay=0,receivedProtocol=0,timings=[]):
-        #GPIO.cleanup()
-        GPIO.setmode(GPIO.BOARD)
+                 receivedDelay=0,receivedProtocol=0,timings=None,backend=None,ringSize=RCSWITCH_RING_SIZE):
+        '''
+        `backend` is a gpiobackend.GPIOBackend; by default RPi.GPIO, gpiochip
+        or whatever $RCSWITCH_BACKEND names
+        '''
+        self.backend = backend or gpiobackend.get_backend()
         self.receiverInterrupt = receiverInterrupt
         self.transmitterPin = transmitterPin
-        self.setPulseLength(pulseLength)
         self.setRepeatTransmit(repeatTransmit)
-        self.setProtocol(protocol)
+        # pulseLength -1 means the protocol's own (350 or 650)
+        self.setProtocol(protocol,pulseLength)
         self.setReceiveTolerance(receiveTolerance)
         self.receivedValue = receivedValue
         self.receivedBitLength = receivedBitLength
         self.receivedDelay = receivedDelay
         self.receivedProtocol = receivedProtocol
-        self.timings = timings
+        self.timings = timings or [0] * RCSWITCH_MAX_CHANGES
         self.changeCount = 0
         self.lastTime = 0
         self.repeatCount = 0
+        self.waveforms = {}
+        self.ring = EdgeRing(ringSize)
+        self.decoder = None
+        self.decoding = threading.Event()
+        self.receivedCount = 0
+        self.receiveCallback = None
 
     def __enter__(self):
         return self
 
     def __exit__(self,exc_type,exc_value,traceback):
-        GPIO.cleanup()
+        self.disableReceive()
+        self.backend.cleanup()
 
     #def __del__(self):
     #    GPIO.cleanup()
 
     #@public
     def switchOn(self,group=-1,groupNumber=-1,groupName=None,family=None,switchNumber=-1,device=-1):
-        if family >= 0 and group >= 0 and device >= 0:
-            self.sendTriState( self.getCodeWordC(family,group,device,True) )
-        elif groupNumber >= 0 and switchNumber >= 0:
-            self.sendTriState( self.getCodeWordB(groupNumber,switchNumber,True) )
-        elif group >= 0 and switchNumber >= 0:
-            self.sendTriState( self.getCodeWordA(group,switchNumber,True) )
+        self.sendCodeWord(self.codeWord(True,group,groupNumber,groupName,family,switchNumber,device))
         return None
 
     def switchOff(self,group=-1,groupNumber=-1,groupName=None,family=None,switchNumber=-1,device=-1):
         '''
-        Three ways to invoke this:
+        Three ways to invoke this (and switchOn):
         1. family, group, and device (type C Intertechno)
-          - family: FamilyCode (a..f)
+          - family: FamilyCode (a..p)
           - group: group number (1..4)
           - device: device number (1..4)
         2. groupNumber and switchNumber (type B with 2 rotary/sliding switches)
@@ -58,66 +267,176 @@ class RCSwitch():
           - switchNumber: number of the switch (1..4)
         3. groupName and switchNumber (type A with 10 pole DIP switches)
           - groupName: code of the switch group (position of DIP switches, 1 == on, 0 == off; so all on == '11111')
-          - switchNumber: number of the switch (1..4)
+          - switchNumber: number of the switch (1..5)
         '''
-        if family >= 0 and group >= 0 and device >= 0:
-            self.sendTriState( self.getCodeWordC(family,group,device,False) )
-        elif groupNumber >= 0 and switchNumber >= 0:
-            self.sendTriState( self.getCodeWordB(groupNumber,switchNumber,False) )
-        elif groupName is not None and switchNumber >= 0:
-            self.sendTriState( self.getCodeWordA(groupName,switchNumber,False) )
+        self.sendCodeWord(self.codeWord(False,group,groupNumber,groupName,family,switchNumber,device))
+        return None
+
+    def codeWord(self,status,group=-1,groupNumber=-1,groupName=None,family=None,switchNumber=-1,device=-1):
+        if family is not None:
+            if not isinstance(family, str):
+                family = chr(family)
+            key = ('C', family, group, device, status)
+        elif groupNumber >= 0:
+            key = ('B', groupNumber, switchNumber, status)
+        elif groupName is not None:
+            key = ('A', groupName, switchNumber, status)
+        else:
+            raise ValueError("Give family, group and device, groupNumber and switchNumber, or groupName and switchNumber")
+        word = codeWords().get(key)
+        if word is None:
+            raise ValueError("No type %s code word for %s"%(key[0], key[1:-1]))
+        return word
+
+    def sendCodeWord(self,word):
+        self.sendWaveform(self.waveform(word.code,word.length))
         return None
 
     def sendTriState(self,code=None):
-        for n in range(self.repeatTransmit):
-            for i in range(len(code)):
-                if code[i] == '0':
-                    self.send0()
-                elif code[i] == 'F':
-                    self.sendF()
-                elif code[i] == '1':
-                    self.send1()
-            self.sendSync()
+        '''
+        Send a tri-state code word such as '0FFF0FFFFFF0'
+        '''
+        self.sendWaveform(self.waveform(*triStateCode(code)))
         return None
 
     def send(self,code=None,length=0):
-        if type(code) == type(0):
-            sys.stdout.write("Converting integer code '%d' to string\n"%(code))
-            if length == 0:
-                length = len(code)
-            code = dec2binWzerofill(code,length)
-            sys.stdout.write("Code is now string '%s'\n"%(code))
-        if type(code) == type('s'):
-            for n in range(self.repeatTransmit):
-                #sys.stdout.write("Loop '%d' of '%d' (repeatTransmit)\n"%(n,self.repeatTransmit))
-                for i in range(len(code)):
-                    #sys.stdout.write("Looping through code: %d of %d. Character is '%s'.\n"%(i,len(code),repr(code[i])))
-                    if code[i] == '0':
-                        #sys.stdout.write("Sending '0'...\n")
-                        self.send0()
-                    elif code[i] == '1':
-                        #sys.stdout.write("Sending '1'...\n")
-                        self.send1()
-                self.sendSync()
+        '''
+        Send integer `code` as `length` bits (by default as many as it
+        has), or a string of '0' and '1'
+        '''
+        if isinstance(code, str):
+            (code, length) = (int(code, 2) if code else 0, len(code))
+        elif length == 0:
+            length = code.bit_length()
+        self.sendWaveform(self.waveform(code,length))
+        return None
+
+    def waveform(self,code,length,pulseLength=None):
+        '''
+        The (first, second) pulse durations in microseconds of one frame of
+        `code` in `length` bits with the current protocol and pulse length
+        (or `pulseLength`), compiled once
+        '''
+        if pulseLength is None:
+            pulseLength = self.pulseLength
+        key = (code, length, self.protocol, pulseLength)
+        waveform = self.waveforms.get(key)
+        if waveform is None:
+            protocol = PROTOCOLS[self.protocol]
+            pulses = ((pulseLength * protocol.zero[0], pulseLength * protocol.zero[1]),
+                      (pulseLength * protocol.one[0], pulseLength * protocol.one[1]))
+            waveform = tuple(pulses[bit] for bit in encodeCode(code,length))
+            waveform += ((pulseLength * protocol.sync[0], pulseLength * protocol.sync[1]),)
+            if len(self.waveforms) >= RCSWITCH_MAX_WAVEFORMS:
+                self.waveforms.clear()
+            self.waveforms[key] = waveform
+        return waveform
+
+    def sendWaveform(self,waveform):
+        receiverInterrupt = self.pauseReceive()
+        self.transmitWaveform(waveform,self.repeatTransmit)
+        self.resumeReceive(receiverInterrupt)
+        return None
+
+    def transmitWaveform(self,waveform,repeats,onAir=None):
+        '''
+        Send `waveform` `repeats` times; `onAir()` is called as soon as
+        the first edge has gone out
+        '''
+        output = self.backend.output
+        delay = self.backend.delay_us
+        pin = self.transmitterPin
+        (first, second) = (LOW, HIGH) if PROTOCOLS[self.protocol].inverted else (HIGH, LOW)
+        for n in range(repeats):
+            for (high, low) in waveform:
+                output(pin, first)
+                if onAir is not None:
+                    (onAir, started) = (None, onAir)
+                    started()
+                delay(high)
+                output(pin, second)
+                delay(low)
         return None
 
-    def enableReceived(self,interrupt=-1):
+    def session(self,transmitterPin=-1,gap=0.0):
         '''
-        Methods to discover: wiringPiISR()
+        A TransmitSession holding the transmitter on `transmitterPin`
+        (default: the one enabled now) for a run of frames
+        '''
+        return TransmitSession(self,transmitterPin,gap)
+
+    def enableReceive(self,interrupt=-1):
+        '''
+        Listen for codes on pin `interrupt`. Edges are pushed into the ring
+        by the backend's callback and decoded by a separate thread.
         '''
         if interrupt >= 0:
             self.receiverInterrupt = interrupt
             self.receivedValue = None
             self.receivedBitLength = 0
-            #wiringPiISR(self.receiverInterrupt, INT_EDGE_BOTH, self.handleInterrupt)
-            GPIO.add_event_detect(self.transmitterPin, GPIO.BOTH, self.handleInterrupt)
+            self.backend.setup_input(self.receiverInterrupt)
+            self.backend.add_edge_callback(self.receiverInterrupt, self.ring.push)
+            if self.decoder is None:
+                self.decoding.set()
+                self.decoder = threading.Thread(target=self.decodeLoop, name='rcswitch-decoder', daemon=True)
+                self.decoder.start()
         return None
 
     def disableReceive(self):
+        '''
+        Stop listening; edges already in the ring are still decoded
+        '''
+        if self.receiverInterrupt != -1:
+            self.backend.remove_edge_callback(self.receiverInterrupt)
         self.receiverInterrupt = -1
-        GPIO.remove_event_detect(self.transmitterPin)
+        if self.decoder is not None:
+            self.decoding.clear()
+            self.decoder.join()
+            self.decoder = None
+        self.decodeEdges()
         return None
 
+    def pauseReceive(self):
+        '''
+        Stop taking edges while we transmit ourselves; returns the pin
+        to give to resumeReceive()
+        '''
+        receiverInterrupt = self.receiverInterrupt
+        if receiverInterrupt != -1:
+            self.backend.remove_edge_callback(receiverInterrupt)
+        return receiverInterrupt
+
+    def resumeReceive(self,receiverInterrupt=-1):
+        if receiverInterrupt != -1:
+            self.backend.add_edge_callback(receiverInterrupt, self.ring.push)
+        return None
+
+    def decodeLoop(self):
+        while self.decoding.is_set():
+            if not self.decodeEdges():
+                time.sleep(RCSWITCH_DECODE_POLL)
+        return None
+
+    def decodeEdges(self):
+        '''
+        Run every edge waiting in the ring through handleInterrupt();
+        returns how many were handled
+        '''
+        count = 0
+        for stamp in self.ring.drain():
+            if stamp is None:
+                # edges were lost, the frame in progress cannot be trusted
+                self.changeCount = 0
+                self.repeatCount = 0
+                self.lastTime = 0
+                continue
+            self.handleInterrupt(stamp)
+            count += 1
+        return count
+
+    def getLostEdges(self):
+        return self.ring.lost
+
     def available(self):
         return self.receivedValue != None
 
@@ -146,8 +465,7 @@ class RCSwitch():
         '''
         if transmitterPin >= 0:
             self.transmitterPin = transmitterPin
-            #pinMode(self.transmitterPin,GPIO.OUT)
-            GPIO.setup(self.transmitterPin,GPIO.OUT)
+            self.backend.setup_output(self.transmitterPin)
         return None
 
     def disableTransmit(self):
@@ -164,273 +482,200 @@ class RCSwitch():
             self.repeatTransmit = repeatTransmit
         return None
 
+    def setReceiveCallback(self,callback=None):
+        '''
+        Call `callback(value, bitLength, delay, protocol)` on the decoder
+        thread for every code received; None to stop
+        '''
+        self.receiveCallback = callback
+        return None
+
     def setReceiveTolerance(self,receiveTolerance=-1):
         if receiveTolerance >= 0:
             self.receiveTolerance = receiveTolerance
         return None
 
     def setProtocol(self,protocol=0,pulseLength=-1):
+        if protocol not in PROTOCOLS:
+            raise ValueError("Unknown protocol %s (choose from %s)"%(protocol, sorted(PROTOCOLS)))
         self.protocol = protocol
-        if protocol == 1:
-            if pulseLength >= 0:
-                self.setPulseLength(pulseLength)
-            else:
-                self.setPulseLength(350)
-        elif protocol == 2:
-            if pulseLength >= 0:
-                self.setPulseLength(pulseLength)
-            else:
-                self.setPulseLength(650)
+        if pulseLength >= 0:
+            self.setPulseLength(pulseLength)
+        else:
+            self.setPulseLength(PROTOCOLS[protocol].pulseLength)
         return None
 
     #@private
-    def getCodeWordB(self,groupNumber=0,switchNumber=0,status=False):
-        returnPos = 0
-        returnVal = ""
-        code = [ 'FFFF', '0FFF', 'F0FF', 'FF0F', 'FFF0' ]
-        if groupNumber < 1 or groupNumber > 4 or switchNumber < 1 or switchNumber > 4:
-            return chr(0)
-        for i in range(4):
-            returnVal[returnPos] = code[groupNumber][i]
-            returnPos += 1
-        for i in range(4):
-            returnVal[returnPos] = code[switchNumber][i]
-            returnPos += 1
-        for i in range(3):
-            returnVal[returnPos] = 'F'
-            returnPos += 1
-        if status == True:
-            returnVal[returnPos] = 'F'
-        else:
-            returnVal[returnPos] = '0'
-        returnPos += 1
-        returnVal[returnPos] = chr(0)
-        return returnVal
-
     def getCodeWordA(self,groupName=None,switchNumber=0,status=False):
-        returnPos = 0
-        returnVal = ""
-        code = [ 'FFFFF', '0FFFFF', 'F0FFF', 'FF0FF', 'FFF0F', 'FFFF0' ]
-        if switchNumber < 1 or switchNumber > 5:
-            return chr(0)
-        for i in range(5):
-            if groupName[i] == '0':
-                returnVal[returnPos] = 'F'
-                returnPos += 1
-            elif groupName[i] == '1':
-                returnVal[returnPos] = '0'
-                returnPos += 1
-            else:
-                return chr(0)
-        for i in range(5):
-            returnVal[returnPos] = code[switchNumber][i]
-            returnPos += 1
-        if status == True:
-            returnVal[returnPos] = '0'
-            returnPos += 1
-            returnVal[returnPos] = 'F'
-            returnPos += 1
-        else:
-            returnVal[returnPos] = 'F'
-            returnPos += 1
-            returnVal[returnPos] = '0'
-            returnPos += 1
-        returnVal[returnPos] = chr(0)
-        return returnVal
+        word = codeWords().get(('A', groupName, switchNumber, status))
+        return None if word is None else word.triState
+
+    def getCodeWordB(self,groupNumber=0,switchNumber=0,status=False):
+        word = codeWords().get(('B', groupNumber, switchNumber, status))
+        return None if word is None else word.triState
 
     def getCodeWordC(self,family=None,group=0,device=0,status=False):
-        returnPos = 0
-        returnVal = ""
-        if family < 97 or family > 112 or group < 1 or group > 4 or device < 1 or device > 4:
-            return chr(0)
-        deviceGroupCode = dec2binWzerofill( device - 1 + (group - 1) * 4, 4)
-        code = [ '0000', 'F000', '0F00', 'FF00', '00F0', 'F0F0', '0FF0', 'FFF0', '000F', 'F00F', '0F0F', 'FF0F', '00FF', 'F0FF', '0FFF', 'FFFF' ]
-        for i in range(4):
-            returnVal[returnPos] = code[family-97][i]
-            returnPos += 1
-        for i in range(4):
-            if deviceGroupCode[i] == '1':
-                returnVal[returnPos] = 'F'
-            else:
-                returnVal[returnPos] = '0'
-            returnPos += 1
-        returnVal[returnPos] = '0'
-        returnPos += 1
-        returnVal[returnPos] = 'F'
-        returnPos += 1
-        returnVal[returnPos] = 'F'
-        returnPos += 1
-        if status == True:
-            returnVal[returnPos] = 'F'
-        else:
-            returnVal[returnPos] = '0'
-        returnPos += 1
-        returnVal[returnPos] = chr(0)
-        return returnVal
+        if family is not None and not isinstance(family, str):
+            family = chr(family)
+        word = codeWords().get(('C', family, group, device, status))
+        return None if word is None else word.triState
 
     def sendT0(self):
-        self.transmit(1,3)
-        self.transmit(1,3)
+        self.send0()
+        self.send0()
         return None
 
     def sendT1(self):
-        self.transmit(3,1)
-        self.transmit(3,1)
+        self.send1()
+        self.send1()
         return None
 
     def sendTF(self):
-        self.transmit(1,3)
-        self.transmit(3,1)
+        self.send0()
+        self.send1()
         return None
 
     def send0(self):
-        if self.protocol == 1:
-            self.transmit(1,3)
-        elif self.protocol == 2:
-            self.transmit(1,2)
+        self.transmit(*PROTOCOLS[self.protocol].zero)
         return None
 
     def send1(self):
-        if self.protocol == 1:
-            self.transmit(3,1)
-        elif self.protocol == 2:
-            self.transmit(2,1)
+        self.transmit(*PROTOCOLS[self.protocol].one)
         return None
 
     def sendSync(self):
-        if self.protocol == 1:
-            self.transmit(1,31)
-        elif self.protocol == 2:
-            self.transmit(1,10)
+        self.transmit(*PROTOCOLS[self.protocol].sync)
         return None
 
     def transmit(self,highPulses=0,lowPulses=0):
         '''
-        Methods to discover: digitalWrite(), delayMicroseconds()
+        One high/low pulse pair; codes are sent as compiled waveforms by
+        sendWaveform(), which pauses the receiver once per code
         '''
-        disabledReceive = False
-        receiverInterrupt_backup = self.receiverInterrupt
-        if self.receiverInterrupt != -1:
-            self.disableReceive()
-            disabledReceive = True
-        #digitalWrite(self.transmitterPin, GPIO.HIGH)
-        GPIO.output(self.transmitterPin, GPIO.HIGH)
-        delayMicroseconds(self.pulseLength * highPulses)
-        #digitalWrite(self.transmitterPin, GPIO.LOW)
-        GPIO.output(self.transmitterPin, GPIO.LOW)
-        delayMicroseconds(self.pulseLength * lowPulses)
-        if disabledReceive == True:
-            self.enableReceive(receiverInterrup_backup)
+        (first, second) = (LOW, HIGH) if PROTOCOLS[self.protocol].inverted else (HIGH, LOW)
+        self.backend.output(self.transmitterPin, first)
+        self.backend.delay_us(self.pulseLength * highPulses)
+        self.backend.output(self.transmitterPin, second)
+        self.backend.delay_us(self.pulseLength * lowPulses)
         return None
 
-    def handleInterrupt(self):
+    def handleInterrupt(self,stamp=0):
         '''
-        Methods to discover: micros()
+        Account for the edge at `stamp` (ns); runs on the decoder thread.
+        As in rc-switch, a gap over the separation limit may be the sync
+        between two frames: the first one starts counting, and a second of
+        about the same length hands the frame in between to the protocol
+        decoder. A gap of another length starts counting over from itself.
         '''
-        t = micros()
-        duration = time - lastTime
-        if duration > 5000 and duration > self.timings[0] - 200 and duration < self.timings[0] + 200:
-            self.repeatCount += 1
-            self.changeCount -= 1
-            if self.repeatCount == 2:
-                if self.receiveProtocol1(self.changeCount) == False:
-                    if self.receiveProtocol2(self.changeCount) == False:
-                        # Failed
-                        pass
-                self.repeatCount = 0
-            self.changeCount = 0
-        elif duration > 5000:
+        duration = (stamp - self.lastTime) // 1000
+        self.lastTime = stamp
+        if duration > RCSWITCH_SEPARATION_LIMIT:
+            if self.repeatCount == 0 or abs(duration - self.timings[0]) < 200:
+                self.repeatCount += 1
+                if self.repeatCount == 2:
+                    if self.receiveProtocol(self.changeCount):
+                        self.receivedCount += 1
+                        if self.receiveCallback is not None:
+                            self.receiveCallback(self.receivedValue,self.receivedBitLength,
+                                                 self.receivedDelay,self.receivedProtocol)
+                    self.repeatCount = 0
+            else:
+                self.repeatCount = 1
             self.changeCount = 0
-        if self.changeCount >= RCSWITCH_MAX_SWITCHES:
+        if self.changeCount >= RCSWITCH_MAX_CHANGES:
             self.changeCount = 0
             self.repeatCount = 0
-        self.changeCount += 1
         self.timings[self.changeCount] = duration
-        self.lastTime = time
+        self.changeCount += 1
         return None
 
-    def receiveProtocol1(self,changeCount=0):
-        code = 0
-        delay = self.timings[0] / 31
-        delayTolerance = delay * self.receiveTolerance * 0.01
-        for i in range(0,changeCount,2):
-            if self.timings[i] > delay - delayTolerance and self.timings[i] < delay + delayTolerance and self.timings[i+1] > delay * 3 - delayTolerance and self.timings[i+1] < delay * 3 + delayTolerance:
-                code = code << 1
-            elif self.timings[i] > delay * 3 - delayTolerance and self.timings[i] < delay * 3 + delayTolerance and self.timings[i+1] > delay - delayTolerance and self.timings[i+1] < delay + delayTolerance:
-                code += 1
-                code = code << 1
-            else:
-                # Failed
-                i = changeCount
-                code = 0
-        code = code >> 1
-        if changeCount > 6:
-            self.receivedValue = code
-            self.receivedBitLength = changeCount / 2
-            self.receivedDelay = delay
-            self.receivedProtocol = 1
-        if code == 0:
-            return False
-        elif code != 0:
-            return True
-
-    def receiveProtocol2(self,changeCount=0):
-        code = 0
-        delay = self.timings[0] / 10
-        delayTolerance = delay * self.receiveTolerance * 0.01
-        for i in range(0,changeCount,2):
-            if self.timings[i] > delay - delayTolerance and self.timings[i] < delay + delayTolerance and self.timings[i+1] > delay * 2 - delayTolerance and self.timings[i+1] < delay * 2 + delayTolerance:
-                code = code << 1
-            elif self.timings[i] > delay * 2 - delayTolerance and self.timings[i] < delay * 2 + delayTolerance and self.timings[i+1] > delay - delayTolerance and self.timings[i+1] < delay + delayTolerance:
-                code += 1
-                code = code << 1
-            else:
-                # Failed
-                i = changeCount
-                code = 0
-        code = code >> 1
-        if changeCount > 6:
-            self.receivedValue = code
-            self.receivedBitLength = changeCount / 2
-            self.receivedDelay = delay
-            self.receivedProtocol = 2
-        if code == 0:
+    def receiveProtocol(self,changeCount=0):
+        '''
+        Decode timings[:changeCount] with every known protocol
+        '''
+        received = decodeTimings(self.timings,changeCount,self.receiveTolerance)
+        if received is None:
             return False
-        elif code != 0:
-            return True
+        (self.receivedValue, self.receivedBitLength, self.receivedDelay, self.receivedProtocol) = received
+        return True
+
+Transmission = collections.namedtuple('Transmission', ['code', 'length', 'pulseLength', 'repeats'])
+
+class TransmitSession():
+    '''
+    The transmitter set up once for any number of frames. Frames are
+    (code, length, pulseLength, repeats) tuples; None in any but the code
+    means the RCSwitch setting. They go out back to back, `gap` seconds
+    apart, with the receiver paused throughout, and the pin is left low and
+    the RCSwitch's own transmitter setting restored once at the end:
+
+        with rcswitch.session(17, gap=0.05) as session:
+            session.sendFrames([(87347, 24, 185, 10), (87491, 24, 185, 10)])
+    '''
+    def __init__(self,rcswitch,transmitterPin=-1,gap=0.0):
+        self.rcswitch = rcswitch
+        self.transmitterPin = transmitterPin if transmitterPin >= 0 else rcswitch.transmitterPin
+        self.gap = gap
+        self.frames = 0
+        self.receiverInterrupt = -1
+        self.previousPin = -1
+
+    def __enter__(self):
+        if self.transmitterPin < 0:
+            raise ValueError("No transmitter pin to open a session on")
+        self.previousPin = self.rcswitch.transmitterPin
+        self.rcswitch.enableTransmit(self.transmitterPin)
+        self.receiverInterrupt = self.rcswitch.pauseReceive()
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.rcswitch.backend.output(self.transmitterPin, LOW)
+        self.rcswitch.transmitterPin = self.previousPin
+        self.rcswitch.resumeReceive(self.receiverInterrupt)
+
+    def send(self,code,length=24,pulseLength=None,repeats=None,onAir=None):
+        rcswitch = self.rcswitch
+        if self.frames and self.gap > 0:
+            rcswitch.backend.delay_us(self.gap * 1000000)
+        if repeats is None:
+            repeats = rcswitch.repeatTransmit
+        rcswitch.transmitWaveform(rcswitch.waveform(code,length,pulseLength),repeats,onAir)
+        self.frames += 1
+        return None
+
+    def sendFrames(self,frames):
+        for frame in frames:
+            self.send(*frame)
+        return self.frames
+
+_backend = None
+
+def defaultBackend():
+    global _backend
+    if _backend is None:
+        _backend = gpiobackend.get_backend()
+    return _backend
 
 def pinMode(pin,mode):
-    GPIO.setup(pin,mode)
+    if mode == 'out':
+        defaultBackend().setup_output(pin)
+    else:
+        defaultBackend().setup_input(pin)
 
 def digitalWrite(pin,value):
-    GPIO.output(pin,value)
+    defaultBackend().output(pin,value)
 
 def delayMicroseconds(duration):
-    time.sleep( float(duration) / 1000000.0)
+    gpiobackend.spin_until(time.perf_counter_ns() + int(duration * 1000))
 
 def wiringPiISR(pin,edge,callback):
-    GPIO.add_event_detect(pin,edge,callback)
+    defaultBackend().add_edge_callback(pin,callback)
 
 def micros():
     return time.time() * 1000000
 
 def dec2binWzerofill(dec=0,length=0):
-    binVal = bytearray(64)
-    i = 0
-    while dec > 0:
-        if dec & 1 > 0:
-            binVal[32+i] = '1'
-        else:
-            binVal[32+i] = '0'
-        i += 1
-        dec = dec >> 1
-    for j in range(length):
-        if j >= length - i:
-            binVal[j] = binVal[ 31 + i - (j - (length - i)) ]
-        else:
-            binVal[j] = '0'
-    binVal[length] = chr(0)
-    return str(binVal)
+    return ''.join(map(str, encodeCode(dec,length)))
 
 def map_gpio_val(val):
     '''Map values for RPi.GPIO DATA
@@ -487,63 +732,124 @@ def map_gpio_val(val):
     else:
         return None
 
+def benchmark(pulse_len=185, repeats=10):
+    '''
+    Time what rcswitch adds on top of the backend, in the simulator:
+    transmitter sessions, code encoding and code word lookups
+    '''
+    # a three channel scene swept over five pulse lengths: set up per frame, or once
+    scene = [(code, 24, pulse, repeats) for pulse in range(pulse_len - 2, pulse_len + 3)
+             for code in (87347, 87491, 87811)]
+    backend = gpiobackend.SimulatedBackend(capacity=len(scene) * repeats * 50 + 16)
+    rcswitch = RCSwitch(backend=backend)
+    setups = []
+    backend.setup_output = lambda pin, setup=backend.setup_output: setups.append(pin) or setup(pin)
+    start = time.perf_counter()
+    for (code, length, pulse, count) in scene:
+        rcswitch.setPulseLength(pulse)
+        rcswitch.setRepeatTransmit(count)
+        rcswitch.enableTransmit(11)
+        rcswitch.send(code, length)
+        rcswitch.disableTransmit()
+    separate = (time.perf_counter() - start, len(setups), backend.count)
+    (backend.count, setups[:]) = (0, [])
+    start = time.perf_counter()
+    with rcswitch.session(11) as session:
+        session.sendFrames(scene)
+    batched = (time.perf_counter() - start, len(setups), backend.count)
+    # the session adds one edge: it leaves the pin low at the end
+    same = separate[2] + 1 == batched[2]
+    sys.stdout.write('session: %d frames, %d pin setups in %.1f ms one by one, %d in %.1f ms batched, %s\n'
+                     % (len(scene), separate[1], 1000 * separate[0], batched[1], 1000 * batched[0],
+                        'same edges' if same else 'DIFFERENT edges'))
+
+    # a thousand channels' worth of codes, each sent ten times
+    codes = [(87347 + 9 * n) & 0xffffff for n in range(1000)] * 10
+    timings = {}
+    for (name, encode) in (('reference', lambda code, length: tuple(map(int, format(code, '0%db' % length)))),
+                           ('encoded', encodeCode.__wrapped__),
+                           ('cached', encodeCode)):
+        start = time.perf_counter()
+        for code in codes:
+            encode(code, 24)
+        timings[name] = 1e9 * (time.perf_counter() - start) / len(codes)
+    start = time.perf_counter()
+    encodeCodes(codes, 24)
+    timings['batch'] = 1e9 * (time.perf_counter() - start) / len(codes)
+    sys.stdout.write('encoding: per code %.0f ns with format(), %.0f ns encoded, %.0f ns cached, '
+                     '%.0f ns in a batch\n'
+                     % (timings['reference'], timings['encoded'], timings['cached'], timings['batch']))
+
+    start = time.perf_counter()
+    table = buildCodeWords()
+    built = time.perf_counter() - start
+    keys = list(table) * 10
+    lookup = codeWords().get
+    start = time.perf_counter()
+    for key in keys:
+        lookup(key)
+    looked_up = time.perf_counter() - start
+    sys.stdout.write('code words: %d built in %.1f ms, %.0f ns per lookup\n'
+                     % (len(table), 1000 * built, 1e9 * looked_up / len(keys)))
+    return 0 if same else 1
+
 if __name__ == "__main__":
     from optparse import OptionParser
 
     parser = OptionParser()
     parser.add_option("-c", "--code", dest="code", type='str',
-                      help="send code CODE", metavar="CODE")
+                      help="send code CODE (comma separated for several)", metavar="CODE")
+    parser.add_option("-l", "--length", dest="length", type='int', default=24,
+                      help="send codes as LENGTH bits", metavar="LENGTH")
     parser.add_option("-p", "--pulse", dest="pulse", type='int',
-                      help="use pulse length of PULSE", metavar="PULSE")
+                      help="sweep pulse lengths around PULSE", metavar="PULSE")
     parser.add_option("-t", "--txpin", dest="txpin", type='int',
                       help="use pin TXPIN for transmit", metavar="TXPIN")
+    parser.add_option("-g", "--gap", dest="gap", type='float', default=0.0,
+                      help="wait GAP seconds between frames", metavar="GAP")
+    parser.add_option("-b", "--backend", dest="backend", type='str', default=None,
+                      help="use GPIO backend BACKEND (rpi, gpiochip or sim)", metavar="BACKEND")
+    parser.add_option("-B", "--benchmark", dest="benchmark", action="store_true", default=False,
+                      help="time sessions, code encoding and code word lookups in the simulator")
     (options, args) = parser.parse_args()
-    rcswitch = None
-
-    sys.stdout.write("Current mode: %s\n"%(map_gpio_val(GPIO.getmode())))
-
-    with RCSwitch() as rcswitch:
-        rcswitch = RCSwitch()
-        rcswitch.setRepeatTransmit(6)
-
-        sys.stdout.write("Now mode is: %s\n"%(map_gpio_val(GPIO.getmode())))
-        sys.stdout.write("Current channel function: %s\n"%(map_gpio_val(GPIO.gpio_function(options.txpin))))
-
-        for pulse in range(options.pulse - 2, options.pulse + 3):
-            sys.stdout.write("Setting pulse length to %d\n" % (pulse))
-            try:
-                rcswitch.setPulseLength(pulse)
-            except Exception as e:
-                sys.stderr.write("Error setting pulse length to %d: %s\n"%(pulse,e))
-                GPIO.cleanup()
-                sys.exit(1)
-
-            sys.stdout.write("Enabling transmit on %d\n"%(options.txpin))
-            try:
-                rcswitch.enableTransmit(options.txpin)
-            except Exception as e:
-                sys.stderr.write("Error enabling transmit: %s\n"%(e))
-                GPIO.cleanup()
-                sys.exit(1)
-            sys.stdout.write("Now channel function is: %s\n"%(map_gpio_val(GPIO.gpio_function(options.txpin))))
-
-            sys.stdout.write("Attempting to transmit code %s...\n"%(options.code))
-            try:
-                rcswitch.send(options.code,24)
-            except Exception as e:
-                sys.stderr.write("Error sending channel on code: %s\n"%(e))
-                GPIO.cleanup()
-                sys.exit(1)
-
-            sys.stdout.write("Disabling transmit\n")
-            try:
-               rcswitch.disableTransmit()
-            except Exception as e:
-                sys.stderr.write("Error disabling transmit: %s\n"%(e))
-                GPIO.cleanup()
-                sys.exit(1)
-            sys.stdout.write("Now channel function is: %s\n"%(map_gpio_val(GPIO.gpio_function(options.txpin))))
+
+    if options.benchmark:
+        sys.exit(benchmark())
+
+    codes = []
+    for code in options.code.split(','):
+        # a string of exactly LENGTH zeros and ones is the bits themselves
+        if len(code) == options.length and not code.strip('01'):
+            codes.append(int(code, 2))
+        else:
+            codes.append(int(code))
+
+    try:
+        backend = gpiobackend.get_backend(options.backend)
+    except (RuntimeError, ValueError) as e:
+        sys.stderr.write("%s\n"%(e))
+        sys.exit(1)
+    sys.stdout.write("Using GPIO backend: %s\n"%(backend.name))
+
+    import rfarbiter
+    radio = rfarbiter.get_arbiter()
+    frames = [Transmission(code, options.length, pulse, 6)
+              for pulse in range(options.pulse - 2, options.pulse + 3) for code in codes]
+    with RCSwitch(backend=backend) as rcswitch:
+        sys.stdout.write("Sending %d frames on %d: codes %s at pulse lengths %d..%d\n"
+                         %(len(frames), options.txpin, options.code, options.pulse - 2, options.pulse + 2))
+        start = time.perf_counter()
+        try:
+            # one grant of the shared radio per frame, like LightsManager
+            with rcswitch.session(options.txpin, options.gap) as session:
+                for frame in frames:
+                    with radio.grant(rfarbiter.NORMAL):
+                        session.send(*frame)
+        except Exception as e:
+            sys.stderr.write("Error transmitting: %s\n"%(e))
+            sys.exit(1)
+        sys.stdout.write("Sent in %.3f seconds\n"%(time.perf_counter() - start))
+        radio.save()
 
     sys.stdout.write("All done. Cleaning up and exiting.\n")
-    #GPIO.cleanup()
     sys.exit(0)
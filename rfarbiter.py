@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+'''
+Time-sliced, prioritized access to the 433 MHz transmitter.
+
+Every process that keys the transmitter (LightsManager sweeps,
+EnvironmentManager's humidifier, manual runs) asks an AirtimeArbiter for a
+grant before each frame and gives it back right after, so a frame is the
+time slice and a long sweep yields the radio between frames.
+
+The arbiter needs no daemon; it is built on flock:
+
+- the grant is an exclusive flock on the radio lock file, so it also
+  excludes older code holding a plain flock on the same file
+- a client waiting at priority P holds a shared flock on `<lockfile>.P`
+  while it waits. Before taking the grant, a client first checks that
+  nobody is waiting at a higher priority (an exclusive probe of the higher
+  files fails), and backs off for `poll` seconds if someone is.
+
+So a HIGH request (humidity control) gets the radio after at most the
+frame on air plus one poll, however many LOW frames (a lights sweep) are
+queued. Each arbiter keeps wait time and airtime per priority for its
+client; save() merges them into `<lockfile>.stats.json`, which
+`rfarbiter.py` prints for all clients.
+'''
+
+import fcntl
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+
+LOGGER = logging.getLogger('LightsManager')
+
+DEFAULT_LOCKFILE = '/tmp/rfradio.lock'
+DEFAULT_POLL = 0.005
+(LOW, NORMAL, HIGH) = (0, 1, 2)
+PRIORITY_NAMES = ('low', 'normal', 'high')
+ARBITERS = {}
+ARBITERS_LOCK = threading.Lock()
+
+
+def client_name():
+    return os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0]
+
+
+class ArbiterStats():
+    '''
+    Grants, wait time and airtime per priority for one client
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.grants = [0] * len(PRIORITY_NAMES)
+        self.waited = [0.0] * len(PRIORITY_NAMES)
+        self.max_wait = [0.0] * len(PRIORITY_NAMES)
+        self.airtime = [0.0] * len(PRIORITY_NAMES)
+        self.yielded = [0] * len(PRIORITY_NAMES)
+
+    def record(self, priority, waited, airtime, yielded):
+        with self.lock:
+            self.grants[priority] += 1
+            self.waited[priority] += waited
+            self.max_wait[priority] = max(self.max_wait[priority], waited)
+            self.airtime[priority] += airtime
+            self.yielded[priority] += yielded
+
+    def as_dict(self):
+        with self.lock:
+            return dict((name, {'grants': self.grants[p],
+                                'wait_seconds': round(self.waited[p], 6),
+                                'max_wait_seconds': round(self.max_wait[p], 6),
+                                'airtime_seconds': round(self.airtime[p], 6),
+                                'yielded': self.yielded[p]})
+                        for (p, name) in enumerate(PRIORITY_NAMES) if self.grants[p])
+
+
+def merge_stats(total, stats):
+    for (name, counters) in stats.items():
+        merged = total.setdefault(name, dict((key, 0) for key in counters))
+        for (key, value) in counters.items():
+            if key.startswith('max_'):
+                merged[key] = max(merged.get(key, 0), value)
+            else:
+                merged[key] = merged.get(key, 0) + value
+    return total
+
+
+class Grant():
+    def __init__(self, arbiter, priority):
+        self.arbiter = arbiter
+        self.priority = priority
+        self.fd = None
+        self.granted = None
+
+    def __enter__(self):
+        self.arbiter.acquire(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.arbiter.release(self)
+
+
+class AirtimeArbiter():
+    def __init__(self, lockfile=DEFAULT_LOCKFILE, client=None, poll=DEFAULT_POLL):
+        self.lockfile = lockfile
+        self.client = client or client_name()
+        self.poll = poll
+        self.stats = ArbiterStats()
+        self.saved = {}
+
+    def _open(self, name):
+        return os.open(name, os.O_RDWR | os.O_CREAT, 0o666)
+
+    def waiting_above(self, priority):
+        '''
+        Whether some client is waiting at a priority above `priority`
+        '''
+        for level in range(priority + 1, len(PRIORITY_NAMES)):
+            try:
+                fd = self._open('%s.%d' % (self.lockfile, level))
+            except OSError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return True
+            finally:
+                os.close(fd)
+        return False
+
+    def grant(self, priority=NORMAL):
+        '''
+        Context manager holding the transmitter for one time slice
+        '''
+        return Grant(self, priority)
+
+    def acquire(self, grant):
+        # every grant has its own open file descriptions, so threads of one
+        # process exclude each other exactly like separate processes do
+        start = time.monotonic()
+        grant.fd = self._open(self.lockfile)
+        waiting = self._open('%s.%d' % (self.lockfile, grant.priority))
+        yielded = 0
+        try:
+            fcntl.flock(waiting, fcntl.LOCK_SH)
+            while True:
+                if not self.waiting_above(grant.priority):
+                    try:
+                        fcntl.flock(grant.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except OSError:
+                        pass
+                else:
+                    yielded += 1
+                time.sleep(self.poll)
+        except BaseException:
+            os.close(grant.fd)
+            grant.fd = None
+            raise
+        finally:
+            os.close(waiting)
+        grant.granted = time.monotonic()
+        grant.waited = grant.granted - start
+        grant.yielded = yielded
+
+    def release(self, grant):
+        if grant.fd is None:
+            return
+        airtime = time.monotonic() - grant.granted
+        os.close(grant.fd)  # closing the descriptor drops the flock
+        grant.fd = None
+        self.stats.record(grant.priority, grant.waited, airtime, grant.yielded)
+
+    def wrap(self, send, priority=NORMAL):
+        '''
+        `send` holding a grant at `priority` for each call
+        '''
+        def granted(*args, **kwargs):
+            with self.grant(priority):
+                return send(*args, **kwargs)
+        return granted
+
+    def save(self):
+        '''
+        Add what this client used since the last save to the shared stats file
+        '''
+        current = self.stats.as_dict()
+        delta = {}
+        for (name, counters) in current.items():
+            before = self.saved.get(name, {})
+            if counters.get('grants') == before.get('grants'):
+                continue
+            delta[name] = dict((key, value if key.startswith('max_') else value - before.get(key, 0))
+                               for (key, value) in counters.items())
+        if not delta:
+            return True
+        statsfile = self.lockfile + '.stats.json'
+        try:
+            fd = self._open(statsfile)
+            with os.fdopen(fd, 'r+') as handle:
+                fcntl.flock(handle, fcntl.LOCK_EX)
+                try:
+                    stats = json.loads(handle.read() or '{}')
+                except ValueError:
+                    stats = {}
+                merge_stats(stats.setdefault(self.client, {}), delta)
+                handle.seek(0)
+                handle.truncate()
+                handle.write(json.dumps(stats, sort_keys=True))
+        except OSError as err:
+            LOGGER.error("Unable to save radio statistics to '%s': %s", statsfile, err)
+            return False
+        self.saved = current
+        return True
+
+
+def get_arbiter(lockfile=DEFAULT_LOCKFILE):
+    '''
+    The process-wide arbiter for the radio behind `lockfile`
+    '''
+    with ARBITERS_LOCK:
+        arbiter = ARBITERS.get(lockfile)
+        if arbiter is None:
+            arbiter = ARBITERS[lockfile] = AirtimeArbiter(lockfile)
+        return arbiter
+
+
+def read_stats(lockfile=DEFAULT_LOCKFILE):
+    try:
+        with open(lockfile + '.stats.json', 'r') as handle:
+            return json.loads(handle.read() or '{}')
+    except (OSError, ValueError):
+        return {}
+
+
+def contend(lockfile, clients=3, frames=20, airtime=0.01):
+    '''
+    Run one thread per priority, each sending `frames` frames of `airtime`
+    seconds at once; returns the stats and the order the frames went out in
+    '''
+    arbiter = AirtimeArbiter(lockfile, 'contend')
+    order = []
+
+    def send(priority):
+        order.append(priority)
+        time.sleep(airtime)
+        return True
+
+    def client(priority):
+        for n in range(frames):
+            arbiter.wrap(send, priority)(priority)
+
+    threads = [threading.Thread(target=client, args=(p % len(PRIORITY_NAMES),)) for p in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return (arbiter.stats.as_dict(), order)
+
+
+def main():
+    parser = ArgumentParser(description='Print the wait time and airtime of every client of the RF transmitter')
+    parser.add_argument("-l","--lockfile",dest="lockfile",default=DEFAULT_LOCKFILE,
+                        metavar="LOCKFILE",help="radio lock file shared by all transmitting processes")
+    parser.add_argument("-b","--benchmark",dest="benchmark",action="store_true",default=False,
+                        help="contend for the radio from one thread per priority and report the waits")
+    parser.add_argument("-n","--frames",dest="frames",type=int,default=20,
+                        metavar="FRAMES",help="frames per benchmark client")
+    options = parser.parse_args()
+
+    if options.benchmark:
+        (stats, order) = contend(options.lockfile + '.bench', frames=options.frames)
+        sys.stdout.write(json.dumps(stats, sort_keys=True, indent=4) + '\n')
+        sys.stdout.write('order: %s\n' % ''.join(PRIORITY_NAMES[p][0] for p in order))
+        return 0
+    sys.stdout.write(json.dumps(read_stats(options.lockfile), sort_keys=True, indent=4) + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+'''
+Record and decode long captures of 433 MHz receiver edges.
+
+A capture file is the raw sequence of edge-to-edge durations in
+microseconds, little-endian uint32, exactly what rcswitch's receiver sees.
+Decoding memory-maps the file, cuts it at sync gaps (durations over
+rcswitch.RCSWITCH_SEPARATION_LIMIT) and matches every frame against every
+protocol in rcswitch.PROTOCOLS with whole-array NumPy passes, one pass per
+frame length and protocol, so an hour of edges decodes in seconds:
+
+    rfcapture.py --record 13 --seconds 3600 capture.u32
+    rfcapture.py capture.u32 -c lights.json
+    rfcapture.py --benchmark --seconds 3600
+
+Consecutive frames with the same code are reported as one transmission
+with its repeat count, followed by per-protocol statistics.
+'''
+
+import json
+import os
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import numpy
+
+import rcswitch
+
+DTYPE = numpy.dtype('<u4')
+MAX_BITS = 64  # codes are packed into uint64
+CHUNK_FRAMES = 1 << 16  # frames matched per array pass, bounds memory use
+RECORD_INTERVAL = 0.01  # seconds between drains of the edge ring while recording
+FRAME = numpy.dtype([('segment', '<i8'), ('time', '<i8'), ('protocol', '<i2'), ('bits', '<i2'),
+                     ('value', '<u8'), ('delay', '<f8')])
+
+
+def load(filename):
+    '''
+    The durations in capture `filename`, memory-mapped read-only
+    '''
+    if os.path.getsize(filename) < DTYPE.itemsize:
+        return numpy.zeros(0, dtype=DTYPE)
+    return numpy.memmap(filename, dtype=DTYPE, mode='r')
+
+
+def segment(durations, limit=rcswitch.RCSWITCH_SEPARATION_LIMIT):
+    '''
+    (starts, counts, times) of the complete segments of `durations`: each
+    starts at a sync gap and runs up to the next one. `times` is when the
+    gap ended, in microseconds from the start of the capture.
+    '''
+    gaps = numpy.flatnonzero(durations > limit)
+    if len(gaps) < 2:
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return (empty, empty, empty)
+    first = int(gaps[0])
+    sums = numpy.add.reduceat(durations[first:], gaps - first, dtype=numpy.int64)
+    times = numpy.empty(len(gaps), dtype=numpy.int64)
+    times[0] = 0
+    numpy.cumsum(sums[:-1], out=times[1:])
+    times += int(durations[:first].sum(dtype=numpy.int64))
+    times += durations[gaps]
+    # the segment after the last gap has no end yet
+    return (gaps[:-1].astype(numpy.int64), numpy.diff(gaps).astype(numpy.int64), times[:-1])
+
+
+def match(timings, protocol, tolerance):
+    '''
+    Match the frames in the rows of `timings` (one frame length) against
+    `protocol`; returns (valid, values, delays)
+    '''
+    (rows, count) = timings.shape
+    pairs = (count - 2) // 2
+    first = 2 if protocol.inverted else 1
+    delay = timings[:, 0] / max(protocol.sync)
+    slack = (delay * (tolerance * 0.01))[:, None]
+    short = timings[:, 1] if protocol.inverted else timings[:, count - 1]
+    valid = numpy.abs(short - min(protocol.sync) * delay) < slack[:, 0]
+    delay2 = delay[:, None]
+    high = timings[:, first:first + 2 * pairs:2]
+    low = timings[:, first + 1:first + 2 * pairs:2]
+    ones = (numpy.abs(high - protocol.one[0] * delay2) < slack) & (numpy.abs(low - protocol.one[1] * delay2) < slack)
+    zeros = (numpy.abs(high - protocol.zero[0] * delay2) < slack) & (numpy.abs(low - protocol.zero[1] * delay2) < slack)
+    valid &= (ones | zeros).all(axis=1)
+    shifts = numpy.arange(pairs - 1, -1, -1, dtype=numpy.uint64)
+    values = (ones.astype(numpy.uint64) << shifts).sum(axis=1, dtype=numpy.uint64)
+    valid &= values != 0
+    return (valid, values, delay)
+
+
+def decode(durations, tolerance=60, protocols=rcswitch.PROTOCOLS):
+    '''
+    Every frame in `durations` that a protocol of `protocols` decodes, as a
+    FRAME array in capture order. Like rcswitch.decodeTimings, the lowest
+    numbered matching protocol wins.
+    '''
+    (starts, counts, times) = segment(durations)
+    decoded = []
+    for count in numpy.unique(counts):
+        pairs = (int(count) - 2) // 2
+        if count % 2 or pairs < 4 or pairs > MAX_BITS:
+            continue
+        segments = numpy.flatnonzero(counts == count)
+        offsets = numpy.arange(count)
+        for chunk in range(0, len(segments), CHUNK_FRAMES):
+            which = segments[chunk:chunk + CHUNK_FRAMES]
+            timings = durations[starts[which][:, None] + offsets].astype(numpy.float64)
+            left = numpy.ones(len(which), dtype=bool)
+            for number in sorted(protocols):
+                (valid, values, delays) = match(timings, protocols[number], tolerance)
+                valid &= left
+                if not valid.any():
+                    continue
+                left &= ~valid
+                frames = numpy.zeros(int(valid.sum()), dtype=FRAME)
+                frames['segment'] = which[valid]
+                frames['time'] = times[which[valid]]
+                frames['protocol'] = number
+                frames['bits'] = pairs
+                frames['value'] = values[valid]
+                frames['delay'] = delays[valid]
+                decoded.append(frames)
+                if not left.any():
+                    break
+    if not decoded:
+        return numpy.zeros(0, dtype=FRAME)
+    frames = numpy.concatenate(decoded)
+    return frames[numpy.argsort(frames['segment'], kind='stable')]
+
+
+def transmissions(frames):
+    '''
+    Collapse runs of back-to-back frames carrying the same code; returns
+    (first frame of each run, repeat counts)
+    '''
+    if len(frames) == 0:
+        return (frames, numpy.zeros(0, dtype=numpy.int64))
+    new = numpy.ones(len(frames), dtype=bool)
+    new[1:] = ((numpy.diff(frames['segment']) != 1)
+               | (frames['value'][1:] != frames['value'][:-1])
+               | (frames['protocol'][1:] != frames['protocol'][:-1])
+               | (frames['bits'][1:] != frames['bits'][:-1]))
+    firsts = numpy.flatnonzero(new)
+    return (frames[firsts], numpy.diff(numpy.append(firsts, len(frames))))
+
+
+def statistics(durations, frames, firsts, repeats):
+    (starts, counts, times) = segment(durations)
+    stats = {'edges': int(len(durations)),
+             'seconds': round(float(durations.sum(dtype=numpy.int64)) / 1e6, 3),
+             'segments': int(len(starts)),
+             'frames': int(len(frames)),
+             'transmissions': int(len(firsts)),
+             'protocols': {}}
+    for number in numpy.unique(frames['protocol']):
+        mine = frames['protocol'] == number
+        delays = frames['delay'][mine]
+        stats['protocols'][str(number)] = {
+            'frames': int(mine.sum()),
+            'transmissions': int((firsts['protocol'] == number).sum()),
+            'mean_repeats': round(float(repeats[firsts['protocol'] == number].mean()), 2),
+            'codes': int(len(numpy.unique(frames['value'][mine]))),
+            'pulse_mean': round(float(delays.mean()), 1),
+            'pulse_min': round(float(delays.min()), 1),
+            'pulse_max': round(float(delays.max()), 1)}
+    return stats
+
+
+def record(filename, pin, seconds, backend=None):
+    '''
+    Write the edges seen on `pin` for `seconds` to capture `filename`;
+    returns (edges written, edges lost)
+    '''
+    backend = backend or rcswitch.defaultBackend()
+    ring = rcswitch.EdgeRing(1 << 16)
+    backend.setup_input(pin)
+    backend.add_edge_callback(pin, ring.push)
+    written = 0
+    last = None
+    end = time.monotonic() + seconds
+    try:
+        with open(filename, 'wb') as handle:
+            while True:
+                # drain once more after the end so the last edges are written
+                finished = time.monotonic() >= end
+                stamps = [stamp for stamp in ring.drain() if stamp is not None]
+                if stamps:
+                    stamps = numpy.array(stamps, dtype=numpy.int64)
+                    if last is None:
+                        (last, stamps) = (stamps[0], stamps[1:])
+                    durations = numpy.diff(stamps, prepend=last) // 1000
+                    last = stamps[-1] if len(stamps) else last
+                    handle.write(numpy.clip(durations, 0, 0xffffffff).astype(DTYPE).tobytes())
+                    written += len(durations)
+                if finished:
+                    break
+                time.sleep(RECORD_INTERVAL)
+    finally:
+        backend.remove_edge_callback(pin)
+    return (written, ring.lost)
+
+
+def generate(filename, seconds, codes=(87347, 87356, 87491, 87500), noise=8000, seed=1,
+             protocol=1, pulse=185, bits=24):
+    '''
+    Write a synthetic capture of `seconds`: receiver noise at about `noise`
+    edges per second with bursts of 10 frames of `codes` every few seconds,
+    every timing off by up to 15% of the pulse length
+    '''
+    rng = numpy.random.default_rng(seed)
+    protocol = rcswitch.PROTOCOLS[protocol]
+    # the capture starts with the long half of the first sync
+    skip = 1 if protocol.sync[0] < protocol.sync[1] else 0
+    with open(filename, 'wb') as handle:
+        elapsed = 0
+        while elapsed < seconds * 1e6:
+            gap = rng.uniform(1.0, 6.0) * 1e6
+            count = int(gap * noise / 1e6)
+            chunk = rng.integers(40, 2 * 1e6 // max(noise, 1), size=count)
+            chunk[rng.random(count) < 0.02] = 6000
+            code = codes[rng.integers(len(codes))]
+            units = []
+            for n in range(10):
+                units.extend(protocol.sync)
+                for bit in format(code, '0%db' % bits):
+                    units.extend(protocol.one if bit == '1' else protocol.zero)
+            units.extend(protocol.sync)
+            frames = numpy.array(units, dtype=numpy.float64) * pulse
+            frames += rng.uniform(-0.15, 0.15, size=len(frames)) * pulse
+            burst = numpy.concatenate((chunk, frames[skip:])).astype(DTYPE)
+            handle.write(burst.tobytes())
+            elapsed += int(burst.sum(dtype=numpy.int64))
+    return load(filename)
+
+
+def main():
+    parser = ArgumentParser(description='Record or decode captures of 433 MHz receiver edges')
+    parser.add_argument("capture", nargs='?', metavar="CAPTURE", help="capture file of uint32 microsecond durations")
+    parser.add_argument("-c","--config",dest="config",default=None,
+                        metavar="CONFIG",help="name codes after the channels in CONFIG")
+    parser.add_argument("-r","--record",dest="record",type=int,default=None,
+                        metavar="RXPIN",help="record the receiver on RXPIN into CAPTURE instead of decoding")
+    parser.add_argument("-s","--seconds",dest="seconds",type=float,default=60.0,
+                        metavar="SECONDS",help="record (or with --benchmark, generate) SECONDS of edges")
+    parser.add_argument("--tolerance",dest="tolerance",type=int,default=60,
+                        metavar="PERCENT",help="pulse width tolerance in percent of the pulse length")
+    parser.add_argument("-j","--json",dest="json",action="store_true",default=False,
+                        help="print statistics as JSON, with the transmissions listed under 'events'")
+    parser.add_argument("-b","--benchmark",dest="benchmark",action="store_true",default=False,
+                        help="decode a generated capture of SECONDS and report the decode time")
+    options = parser.parse_args()
+
+    if options.benchmark:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            durations = generate(os.path.join(tmpdir, 'capture.u32'), options.seconds)
+            start = time.perf_counter()
+            frames = decode(durations, options.tolerance)
+            (firsts, repeats) = transmissions(frames)
+            elapsed = time.perf_counter() - start
+            sys.stdout.write('%d edges (%.0f s of capture, %.1f MB) decoded in %.2f s: %d frames, %d transmissions\n'
+                             % (len(durations), durations.sum(dtype=numpy.int64) / 1e6, durations.nbytes / 1e6,
+                                elapsed, len(frames), len(firsts)))
+            del durations
+        return 0
+    if options.capture is None:
+        parser.error('a capture file is required')
+    if options.record is not None:
+        (written, lost) = record(options.capture, options.record, options.seconds)
+        sys.stdout.write('%d edges written to %s, %d lost\n' % (written, options.capture, lost))
+        return 1 if lost else 0
+
+    names = {}
+    if options.config:
+        import channelregistry
+        import lightsconfig
+        registry = channelregistry.ChannelRegistry.from_config(lightsconfig.load(options.config, snapshot=False))
+        names = dict((code, '%s %s' % (channel.name, state)) for (code, (channel, state)) in registry.by_code.items())
+    try:
+        durations = load(options.capture)
+    except OSError as err:
+        sys.stderr.write('%s\n' % err)
+        return 1
+    frames = decode(durations, options.tolerance)
+    (firsts, repeats) = transmissions(frames)
+    stats = statistics(durations, frames, firsts, repeats)
+    if options.json:
+        stats['events'] = [{'time': round(int(frame['time']) / 1e6, 6), 'protocol': int(frame['protocol']),
+                            'bits': int(frame['bits']), 'code': int(frame['value']),
+                            'pulse': round(float(frame['delay']), 1), 'repeats': int(count),
+                            'channel': names.get(int(frame['value']))}
+                           for (frame, count) in zip(firsts, repeats)]
+        sys.stdout.write(json.dumps(stats, sort_keys=True, indent=4) + '\n')
+        return 0
+    for (frame, count) in zip(firsts, repeats):
+        sys.stdout.write('%12.6f  protocol %d  %2d bits  %10d  pulse %5.1f  x%-3d %s\n'
+                         % (int(frame['time']) / 1e6, frame['protocol'], frame['bits'], frame['value'],
+                            frame['delay'], count, names.get(int(frame['value']), '')))
+    sys.stdout.write(json.dumps(stats, sort_keys=True, indent=4) + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
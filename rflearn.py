@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+'''
+Learn a remote's protocol, pulse length and codes from what it sends.
+
+Instead of sweeping pulsestart..pulsestop around a guess, record the remote
+through rcswitch's receiver (press and hold ON, then OFF) and let the
+timings tell:
+
+    rflearn.py --record 13 --name porch
+    rflearn.py --on porch-on.u32 --off porch-off.u32 --name channel6 --format ini
+    rflearn.py --benchmark
+
+The frames the remote repeated are back-to-back segments between sync gaps
+of the same length, which gives the bit length. Every rcswitch.PROTOCOLS
+row is matched against them at once; the row decoding the most frames
+wins, with ties going to the row whose pulse shapes fit closest. The
+pulse length is the mean bit duration over the bit's length in pulses, and
+the most common decoded value is the code. The result is printed as a
+channel entry for lights.json (or an INI [channelN] section) with the
+pulse length to configure. For a remote no row decodes, the pulse widths
+are clustered into short and long (1-D k-means) and a row for the table
+is suggested from the long/short and sync/short ratios.
+'''
+
+import json
+import os
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import numpy
+
+import rcswitch
+import rfcapture
+
+class LearnError(ValueError):
+    pass
+
+
+def kmeans(values, k=2, iterations=20):
+    '''
+    1-D k-means; returns (sorted centers, labels)
+    '''
+    centers = numpy.quantile(values, numpy.linspace(0.1, 0.9, k))
+    for n in range(iterations):
+        labels = numpy.abs(values[:, None] - centers[None, :]).argmin(axis=1)
+        moved = numpy.array([values[labels == i].mean() if (labels == i).any() else centers[i] for i in range(k)])
+        if numpy.allclose(moved, centers):
+            break
+        centers = moved
+    order = numpy.argsort(centers)
+    return (centers[order], numpy.argsort(order)[labels])
+
+
+def frames(durations):
+    '''
+    Timings of the frames the remote repeated, one per row: back-to-back
+    segments of the same length after sync gaps within 20% of each other,
+    taking the most common such length
+    '''
+    (starts, counts, times) = rfcapture.segment(durations)
+    gaps = durations[starts].astype(numpy.float64)
+    repeated = numpy.zeros(len(starts), dtype=bool)
+    again = (counts[1:] == counts[:-1]) & (numpy.abs(gaps[1:] - gaps[:-1]) < 0.2 * gaps[:-1])
+    repeated[1:] |= again
+    repeated[:-1] |= again
+    repeated &= (counts % 2 == 0) & (counts >= 10) & (counts <= 2 * rfcapture.MAX_BITS + 2)
+    if not repeated.any():
+        raise LearnError('No repeated frames found; hold the button down while recording')
+    (lengths, seen) = numpy.unique(counts[repeated], return_counts=True)
+    count = int(lengths[seen.argmax()])
+    rows = starts[repeated & (counts == count)]
+    return durations[rows[:, None] + numpy.arange(count)].astype(numpy.float64)
+
+
+def residual(timings, protocol, values, delays):
+    '''
+    Mean distance, in pulses, of the bits in `timings` from the shapes
+    `protocol` gives the decoded `values`
+    '''
+    (rows, count) = timings.shape
+    pairs = (count - 2) // 2
+    first = 2 if protocol.inverted else 1
+    ones = ((values[:, None] >> numpy.arange(pairs - 1, -1, -1, dtype=numpy.uint64)) & 1).astype(bool)
+    expected = numpy.empty((rows, 2 * pairs))
+    expected[:, 0::2] = numpy.where(ones, protocol.one[0], protocol.zero[0])
+    expected[:, 1::2] = numpy.where(ones, protocol.one[1], protocol.zero[1])
+    measured = timings[:, first:first + 2 * pairs] / delays[:, None]
+    return float(numpy.abs(measured - expected).mean())
+
+
+def suggest(timings):
+    '''
+    A protocol row for a remote the table does not know: the pulse widths
+    clustered into short and long, sync gap and short half in short pulses
+    '''
+    (rows, count) = timings.shape
+    ((short, long), labels) = kmeans(timings[:, 1:count - 1].ravel())
+    ratio = int(round(long / short))
+    gap = int(round(numpy.median(timings[:, 0]) / short))
+    tail = max(1, int(round(numpy.median(timings[:, count - 1]) / short)))
+    return rcswitch.Protocol(int(round(short)), (tail, gap), (1, ratio), (ratio, 1), False)
+
+
+def classify(timings, tolerance=60):
+    '''
+    (protocol number or None, Protocol row, valid, values, delays) for
+    frames `timings`: the table row decoding the most frames, the closer
+    fit on a tie. The suggested row is used instead when it decodes as
+    many frames and fits at least twice as closely.
+    '''
+    best = None
+    for (number, protocol) in sorted(rcswitch.PROTOCOLS.items()):
+        matched = rfcapture.match(timings, protocol, tolerance)
+        key = fit(timings, protocol, *matched)
+        if key is not None and (best is None or key < best[0]):
+            best = (key, (number, protocol) + matched)
+    protocol = suggest(timings)
+    matched = rfcapture.match(timings, protocol, tolerance)
+    key = fit(timings, protocol, *matched)
+    if best is None or (key is not None and key[0] <= best[0][0] and 2 * key[1] <= best[0][1]):
+        return (None, protocol) + matched
+    return best[1]
+
+
+def fit(timings, protocol, valid, values, delays):
+    '''
+    Sort key for how well `protocol` explains the frames: most frames
+    decoded first, then the smallest residual; None if none decode
+    '''
+    if not valid.any():
+        return None
+    return (-int(valid.sum()), residual(timings[valid], protocol, values[valid], delays[valid]))
+
+
+def learn(durations, tolerance=60):
+    '''
+    What the remote in capture `durations` sends, as a dict with protocol,
+    pulse, bits, code, frames and agreement (fraction of frames decoding
+    to that code), plus the protocol row when it is not in the table
+    '''
+    timings = frames(durations)
+    (number, protocol, valid, values, delays) = classify(timings, tolerance)
+    if not valid.any():
+        raise LearnError('Frames do not decode with any protocol, not even %s' % (protocol,))
+    (codes, seen) = numpy.unique(values[valid], return_counts=True)
+    code = int(codes[seen.argmax()])
+    mine = valid & (values == code)
+    # every bit is the same number of pulses long, whichever its value
+    first = 2 if protocol.inverted else 1
+    (rows, count) = timings.shape
+    bits = timings[mine, first:first + 2 * ((count - 2) // 2)]
+    pulse = bits.sum(axis=1).mean() / (bits.shape[1] // 2) / sum(protocol.zero)
+    learned = {'protocol': number, 'pulse': round(float(pulse), 1), 'bits': (count - 2) // 2, 'code': code,
+               'frames': int(len(timings)), 'agreement': round(float(mine.sum()) / len(timings), 3)}
+    if number is None:
+        learned['row'] = protocol._replace(pulseLength=int(round(pulse)))
+    return learned
+
+
+def channel_entry(name, on, off, format='json'):
+    pulse = int(round(on['pulse'] if off is None else (on['pulse'] + off['pulse']) / 2))
+    if format == 'ini':
+        return ('[%s]\n# protocol %s, pulse_len = %d\ncode_on = %d\n%s'
+                % (name, on['protocol'], pulse, on['code'], '' if off is None else 'code_off = %d\n' % off['code']))
+    entry = {'name': name, 'on': on['code'], 'manage': False}
+    if off is not None:
+        entry['off'] = off['code']
+    return json.dumps({'channel': entry, 'pulse': {'start': pulse, 'end': pulse + 1}}, sort_keys=True, indent=4) + '\n'
+
+
+def capture(pin, seconds, prompt):
+    (handle, filename) = tempfile.mkstemp(suffix='.u32')
+    os.close(handle)
+    sys.stderr.write('%s, hold it for %g seconds...\n' % (prompt, seconds))
+    (written, lost) = rfcapture.record(filename, pin, seconds)
+    sys.stderr.write('%d edges recorded%s\n' % (written, ', %d lost' % lost if lost else ''))
+    return filename
+
+
+def benchmark(seconds=10):
+    '''
+    Learn generated captures of every receivable protocol at a few pulse
+    lengths; returns the number of wrong results
+    '''
+    wrong = 0
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for number in sorted(rcswitch.PROTOCOLS):
+            if max(rcswitch.PROTOCOLS[number].sync) * rcswitch.PROTOCOLS[number].pulseLength < rcswitch.RCSWITCH_SEPARATION_LIMIT:
+                continue
+            for scale in (0.9, 1.0, 1.1):
+                pulse = int(rcswitch.PROTOCOLS[number].pulseLength * scale)
+                durations = rfcapture.generate(os.path.join(tmpdir, 'capture.u32'), seconds, codes=(5592405,),
+                                               seed=number, protocol=number, pulse=pulse)
+                start = time.perf_counter()
+                learned = learn(durations)
+                elapsed = time.perf_counter() - start
+                ok = (learned['protocol'] == number and learned['code'] == 5592405
+                      and abs(learned['pulse'] - pulse) < 0.05 * pulse)
+                wrong += not ok
+                sys.stdout.write('protocol %d pulse %4d: learned protocol %s pulse %6.1f code %d in %.1f ms %s\n'
+                                 % (number, pulse, learned['protocol'], learned['pulse'], learned['code'],
+                                    1000 * elapsed, 'ok' if ok else 'WRONG'))
+                del durations
+    return wrong
+
+
+def learn_channel(options):
+    '''
+    Print the channel entry for the --on/--off captures; returns the exit status
+    '''
+    learned = []
+    for filename in (options.on, options.off):
+        if filename is None:
+            learned.append(None)
+            continue
+        try:
+            result = learn(rfcapture.load(filename), options.tolerance)
+        except (OSError, LearnError) as err:
+            sys.stderr.write('%s: %s\n' % (filename, err))
+            return 1
+        sys.stderr.write('%s: %s\n' % (filename, json.dumps(result, sort_keys=True)))
+        if result['protocol'] is None:
+            sys.stderr.write('No protocol in rcswitch.PROTOCOLS fits; add %s\n' % (result['row'],))
+        learned.append(result)
+    (on, off) = learned
+    if off is not None and (on['protocol'], on['bits']) != (off['protocol'], off['bits']):
+        sys.stderr.write('On and off codes disagree on protocol or bit length; recorded two different remotes?\n')
+        return 1
+    sys.stdout.write(channel_entry(options.name, on, off, options.format))
+    return 0
+
+
+def main():
+    parser = ArgumentParser(description="Learn a remote's protocol, pulse length and codes from its transmissions")
+    parser.add_argument("-n","--name",dest="name",default='channel',
+                        metavar="NAME",help="name of the channel entry to print")
+    parser.add_argument("-r","--record",dest="record",type=int,default=None,
+                        metavar="RXPIN",help="record the remote with the receiver on RXPIN")
+    parser.add_argument("-s","--seconds",dest="seconds",type=float,default=3.0,
+                        metavar="SECONDS",help="record each button for SECONDS")
+    parser.add_argument("--on",dest="on",default=None,
+                        metavar="CAPTURE",help="learn the on code from CAPTURE (see rfcapture.py)")
+    parser.add_argument("--off",dest="off",default=None,
+                        metavar="CAPTURE",help="learn the off code from CAPTURE")
+    parser.add_argument("-f","--format",dest="format",choices=('json', 'ini'),default='json',
+                        help="print a lights.json channel entry or an EnvironmentManager [channelN] section")
+    parser.add_argument("--tolerance",dest="tolerance",type=int,default=60,
+                        metavar="PERCENT",help="pulse width tolerance in percent of the pulse length")
+    parser.add_argument("-b","--benchmark",dest="benchmark",action="store_true",default=False,
+                        help="learn generated captures of every protocol and report the results")
+    options = parser.parse_args()
+
+    if options.benchmark:
+        return 1 if benchmark() else 0
+    if options.record is not None:
+        (options.on, options.off) = (capture(options.record, options.seconds, 'Press ON on the remote'),
+                                     capture(options.record, options.seconds, 'Press OFF on the remote'))
+        try:
+            return learn_channel(options)
+        finally:
+            os.unlink(options.on)
+            os.unlink(options.off)
+    if options.on is None:
+        parser.error('record with --record RXPIN or give captures with --on/--off')
+    return learn_channel(options)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
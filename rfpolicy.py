@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+'''
+Per channel retransmit counts and pulse lengths, learned from outcomes.
+
+lights.pulse gives one retransmit count and one pulse range for every
+channel, so the outlet that is hardest to reach sets the airtime of all
+of them. With a lights.policy section each channel keeps rolling
+(exponentially weighted) statistics instead:
+
+  * a success rate over its sweeps, from the verification receiver
+    (rfverify) or from manual feedback (lightsctl.py --feedback),
+  * a hit rate per pulse length, from the verification receiver.
+
+After `streak` successful sweeps in a row with the success rate at or
+over `target`, the channel is sent one repeat less, down to
+min_retransmit. A failed sweep puts it back at max_retransmit (default:
+the global retransmit), widens it to the full pulse range again, and
+keeps it at least one repeat over the count that failed until it has
+gone FLOOR_STREAK sweeps without a miss. Pulse lengths that hit are sent
+first. Without verification, only those and at least min_pulses are
+sent; with it the rest still follow, since a confirmed channel skips
+them anyway.
+
+The statistics and the frames they save per sweep are in the daemon's
+status reply and printed by:
+
+    rfpolicy.py -c lights.json
+    rfpolicy.py --benchmark
+'''
+
+import json
+import logging
+import os
+import sys
+import threading
+from argparse import ArgumentParser
+
+LOGGER = logging.getLogger('LightsManager')
+
+DEFAULT_STATE_FILE = '/var/tmp/LightsManager.policy.json'
+DEFAULT_MIN_RETRANSMIT = 1
+DEFAULT_MIN_PULSES = 1
+DEFAULT_TARGET = 0.9  # rolling success rate a channel has to hold before it is sent less
+DEFAULT_ALPHA = 0.2   # weight of the newest outcome in the rolling rates
+DEFAULT_STREAK = 3    # successful sweeps in a row before a repeat is dropped
+FLOOR_STREAK = 50     # successful sweeps in a row before a repeat count that failed is tried again
+PULSE_KEEP = 0.5      # rolling hit rate a pulse length needs to stay a candidate
+
+
+class ChannelPolicy():
+    __slots__ = ('rate', 'sweeps', 'streak', 'retransmit', 'floor', 'wide', 'pulses')
+
+    def __init__(self, rate=None, sweeps=0, streak=0, retransmit=None, floor=None, wide=False, pulses=None):
+        self.rate = rate
+        self.sweeps = sweeps
+        self.streak = streak
+        self.retransmit = retransmit
+        self.floor = floor
+        self.wide = wide
+        self.pulses = pulses or {}
+
+    def as_dict(self):
+        return dict((key, getattr(self, key)) for key in self.__slots__)
+
+
+def rolling(rate, value, alpha):
+    return float(value) if rate is None else (1.0 - alpha) * rate + alpha * value
+
+
+class RetransmitPolicy():
+    def __init__(self, state_file=DEFAULT_STATE_FILE, min_retransmit=DEFAULT_MIN_RETRANSMIT, max_retransmit=None,
+                 min_pulses=DEFAULT_MIN_PULSES, target=DEFAULT_TARGET, alpha=DEFAULT_ALPHA, streak=DEFAULT_STREAK):
+        self.state_file = state_file
+        self.min_retransmit = min_retransmit
+        self.max_retransmit = max_retransmit
+        self.min_pulses = min_pulses
+        self.target = target
+        self.alpha = alpha
+        self.streak = streak
+        self.lock = threading.Lock()
+        self.channels = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        if self.state_file is None or not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file, 'r') as handle:
+                channels = json.load(handle)
+            channels = dict((name, ChannelPolicy(**state)) for (name, state) in channels.items())
+        except (IOError, ValueError, TypeError) as err:
+            LOGGER.error("Unable to read retransmit policy from '%s': %s. Starting over.", self.state_file, err)
+            return
+        with self.lock:
+            self.channels = channels
+
+    def save(self):
+        if self.state_file is None or not self.dirty:
+            return True
+        import tempfile
+        with self.lock:
+            channels = dict((name, state.as_dict()) for (name, state) in self.channels.items())
+            self.dirty = False
+        dirname = os.path.dirname(os.path.abspath(self.state_file))
+        try:
+            (fd, tmpname) = tempfile.mkstemp(prefix='.rfpolicy', dir=dirname)
+            with os.fdopen(fd, 'w') as handle:
+                json.dump(channels, handle, sort_keys=True)
+            os.replace(tmpname, self.state_file)
+        except (IOError, OSError) as err:
+            LOGGER.error("Unable to save retransmit policy to '%s': %s", self.state_file, err)
+            self.dirty = True
+            return False
+        return True
+
+    def bounds(self, retransmit):
+        return (self.min_retransmit, max(self.min_retransmit, self.max_retransmit or retransmit))
+
+    def repeats(self, state, retransmit):
+        (low, high) = self.bounds(retransmit)
+        return min(max(retransmit if state is None or state.retransmit is None else state.retransmit, low), high)
+
+    def outcome(self, name, success, retransmit):
+        '''
+        Account for one sweep of channel `name`, sent with the global
+        `retransmit` setting, that did or did not switch it
+        '''
+        with self.lock:
+            state = self.channels.setdefault(name, ChannelPolicy())
+            repeats = self.repeats(state, retransmit)
+            (low, high) = self.bounds(retransmit)
+            state.rate = rolling(state.rate, success, self.alpha)
+            state.sweeps += 1
+            if success:
+                state.streak += 1
+                state.wide = False
+                if state.floor is not None and state.streak >= FLOOR_STREAK:
+                    state.floor = None if state.floor - 1 <= low else state.floor - 1
+                if (state.streak % self.streak == 0 and state.rate >= self.target
+                        and repeats > max(low, state.floor or low)):
+                    repeats -= 1
+                    LOGGER.info("Channel '%s' holds a %.2f success rate; down to %d repeats.",
+                                name, state.rate, repeats)
+            else:
+                state.streak = 0
+                state.wide = True
+                state.floor = min(repeats + 1, high)
+                repeats = high
+                LOGGER.info("Channel '%s' missed; back to the full pulse range at %d repeats.", name, repeats)
+            state.retransmit = repeats
+            self.dirty = True
+
+    def observe(self, name, pulse_len, heard):
+        '''
+        Account for one frame of channel `name` at `pulse_len` that the
+        verification receiver did or did not hear
+        '''
+        with self.lock:
+            state = self.channels.setdefault(name, ChannelPolicy())
+            key = str(pulse_len)
+            state.pulses[key] = round(rolling(state.pulses.get(key), heard, self.alpha), 4)
+            self.dirty = True
+
+    def record_sweep(self, names, results, confirmed, retransmit):
+        '''
+        Take the (channel, pulse length, heard) `results` of a verified
+        sweep; channels in `confirmed` were switched. `names` maps channel
+        indexes to names.
+        '''
+        for (i, pulse_len, heard) in results:
+            self.observe(names[i], pulse_len, heard)
+        for i in set(i for (i, pulse_len, heard) in results):
+            self.outcome(names[i], i in confirmed, retransmit)
+
+    def feedback(self, name, worked, retransmit):
+        '''
+        Someone saw whether the last sweep of `name` switched it
+        '''
+        self.outcome(name, worked, retransmit)
+
+    def candidates(self, name, pulse_lengths, retransmit, verified=False):
+        '''
+        (pulse lengths in the order to send them, retransmit) for `name`
+        '''
+        pulse_lengths = list(pulse_lengths)
+        with self.lock:
+            state = self.channels.get(name)
+            repeats = self.repeats(state, retransmit)
+            if state is None or state.wide or not state.pulses:
+                return (pulse_lengths, repeats)
+            scores = dict((pulse_len, state.pulses.get(str(pulse_len))) for pulse_len in pulse_lengths)
+        hits = sorted((pulse_len for pulse_len in pulse_lengths
+                       if scores[pulse_len] is not None and scores[pulse_len] >= PULSE_KEEP),
+                      key=lambda pulse_len: -scores[pulse_len])
+        # untried pulse lengths before the ones that missed
+        rest = ([pulse_len for pulse_len in pulse_lengths if scores[pulse_len] is None]
+                + [pulse_len for pulse_len in pulse_lengths if pulse_len not in hits and scores[pulse_len] is not None])
+        if verified:
+            return (hits + rest, repeats)
+        return (hits + rest[:max(self.min_pulses - len(hits), 0)], repeats)
+
+    def overrides(self, names, indexes, pulse_lengths, retransmit, verified=False):
+        '''
+        lightsplanner.build_plan overrides for the channels in `indexes`
+        '''
+        return dict((i, self.candidates(names[i], pulse_lengths, retransmit, verified)) for i in indexes)
+
+    def as_dict(self, names, pulse_lengths, retransmit, verified=False):
+        '''
+        Rolling statistics and current plan of every channel in `names`,
+        with the frames a sweep of all of them takes with and without the
+        policy
+        '''
+        pulse_lengths = list(pulse_lengths)
+        channels = {}
+        frames = 0
+        for name in names:
+            (pulses, repeats) = self.candidates(name, pulse_lengths, retransmit, verified)
+            with self.lock:
+                state = (self.channels.get(name) or ChannelPolicy()).as_dict()
+            state.update(retransmit=repeats, candidates=pulses, frames=len(pulses) * repeats)
+            if state['rate'] is not None:
+                state['rate'] = round(state['rate'], 3)
+            channels[name] = state
+            frames += state['frames']
+        return {'channels': channels, 'frames': frames,
+                'frames_global': len(names) * len(pulse_lengths) * max(int(retransmit or 1), 1)}
+
+
+def from_config(config):
+    '''
+    RetransmitPolicy for lights.policy of compiled `config`, or None
+    '''
+    settings = config.lights.policy
+    if settings is None:
+        return None
+    return RetransmitPolicy(settings.state_file, settings.min_retransmit, settings.max_retransmit,
+                            settings.min_pulses, settings.target, settings.alpha, settings.streak)
+
+
+def benchmark(sweeps=100, seed=1):
+    '''
+    Sweep four simulated outlets `sweeps` times with the global settings
+    and with the policy learning from feedback, then both again with the
+    verification receiver skipping confirmed channels. Each outlet only
+    reacts to pulse lengths within 1 us of its own, and then not to every
+    frame: the garden outlet catches only half of them. Returns the number
+    of policy runs that did not save frames over the same run with the
+    global settings or missed more than one channel sweep in twenty.
+    '''
+    import random
+    (pulse_lengths, retransmit) = (range(180, 190), 3)
+    outlets = {'porch': (181, 0.9), 'hall': (184, 0.95), 'garden': (188, 0.5), 'attic': (185, 0.8)}
+    names = sorted(outlets)
+    def reaches(name, pulse_len):
+        (center, chance) = outlets[name]
+        return abs(pulse_len - center) <= 1 and rng.random() < chance
+    failed = 0
+    for mode in ('global', 'feedback', 'verified global', 'verified'):
+        verified = mode.startswith('verified')
+        policy = RetransmitPolicy(state_file=None)
+        rng = random.Random(seed)
+        (sent, missed) = (0, 0)
+        for sweep in range(sweeps):
+            (results, confirmed) = ([], set())
+            for (i, name) in enumerate(names):
+                (pulses, repeats) = (list(pulse_lengths), retransmit)
+                if not mode.endswith('global'):
+                    (pulses, repeats) = policy.candidates(name, pulse_lengths, retransmit, verified)
+                for (pulse_len, n) in ((pulse_len, n) for pulse_len in pulses for n in range(repeats)):
+                    if verified and i in confirmed:
+                        break
+                    heard = reaches(name, pulse_len)
+                    results.append((i, pulse_len, heard))
+                    if heard:
+                        confirmed.add(i)
+                    sent += 1
+                if mode == 'feedback':
+                    policy.feedback(name, i in confirmed, retransmit)
+            if verified:
+                policy.record_sweep(names, results, confirmed, retransmit)
+            missed += len(names) - len(confirmed)
+        if mode.endswith('global'):
+            budget = sent
+        else:
+            failed += sent >= budget or 20 * missed > sweeps * len(names)
+        stats = policy.as_dict(names, pulse_lengths, retransmit, verified)
+        sys.stdout.write('%-15s %5.1f frames per sweep, %2d of %d channel sweeps missed%s\n'
+                         % (mode, float(sent) / sweeps, missed, sweeps * len(names), '' if mode.endswith('global') else
+                            '; now %s' % ', '.join('%s %d x %s' % (name, state['retransmit'], state['candidates'][0]
+                                                                    if verified else len(state['candidates']))
+                                                   for (name, state) in sorted(stats['channels'].items()))))
+    return failed
+
+
+def main():
+    parser = ArgumentParser(description='Show the per channel retransmit policy and the frames it saves')
+    parser.add_argument("-c","--config",dest="config",default=None,
+                        metavar="CONFIG",help="LightsManager configuration with a lights.policy section")
+    parser.add_argument("-b","--benchmark",dest="benchmark",action="store_true",default=False,
+                        help="run simulated outlets through the policy and report the frames per sweep")
+    options = parser.parse_args()
+
+    if options.benchmark:
+        return 1 if benchmark() else 0
+    if options.config is None:
+        parser.error('a configuration is required')
+    import lightsconfig
+    try:
+        config = lightsconfig.load(options.config)
+    except (IOError, lightsconfig.ConfigError) as err:
+        sys.stderr.write('%s\n' % err)
+        return 1
+    policy = from_config(config) if config.lights is not None else None
+    if policy is None:
+        sys.stderr.write("No lights.policy section in '%s'\n" % options.config)
+        return 1
+    lights = config.lights
+    stats = policy.as_dict([channel.name for channel in lights.channels], lights.pulse.lengths,
+                           lights.pulse.retransmit, lights.verify is not None)
+    sys.stdout.write(json.dumps(stats, sort_keys=True, indent=4) + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
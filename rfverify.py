@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+'''
+Confirm our own transmissions with a receiver on another GPIO pin.
+
+The outlets give no feedback, so LightsManager sends every code
+`retransmit` times at every pulse length in case one of them is missed.
+With a 433 MHz receiver wired to a spare pin (lights.verify.rxpin) the
+sweep is closed-loop instead: rcswitch decodes what goes out, and once a
+channel's code has been heard cleanly `confirmations` times its remaining
+frames are skipped. A frame that is not heard within `listen` seconds
+counts as a failed attempt and the sweep carries on as before, so a deaf
+receiver costs a little time but never a missed channel.
+
+Attempts and successes are kept per channel in a JSON file, so the
+success/attempt ratio shows which outlets are hard to reach:
+
+    rfverify.py
+    rfverify.py --stats /var/tmp/LightsManager.verify.json
+    rfverify.py --benchmark
+'''
+
+import collections
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+
+LOGGER = logging.getLogger('LightsManager')
+
+DEFAULT_CONFIRMATIONS = 2
+DEFAULT_LISTEN = 0.1  # seconds to wait after a frame for the receiver to decode it
+DEFAULT_STATS_FILE = '/var/tmp/LightsManager.verify.json'
+COUNTERS = ('cycles', 'confirmed', 'attempts', 'successes', 'skipped')
+
+
+class VerifyStats():
+    '''
+    Per channel totals: sweeps (cycles) and how many were confirmed, frames
+    sent while listening (attempts) and heard (successes), frames skipped
+    '''
+    def __init__(self, filename=DEFAULT_STATS_FILE):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.channels = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        if self.filename is None or not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename, 'r') as handle:
+                channels = json.load(handle)
+        except (IOError, ValueError) as err:
+            LOGGER.error("Unable to read verification statistics from '%s': %s. Starting empty.",
+                         self.filename, err)
+            return
+        with self.lock:
+            self.channels = dict((name, dict((key, int(counters.get(key, 0))) for key in COUNTERS))
+                                 for (name, counters) in channels.items())
+
+    def record(self, name, **counts):
+        with self.lock:
+            counters = self.channels.setdefault(name, dict.fromkeys(COUNTERS, 0))
+            for (key, value) in counts.items():
+                counters[key] += value
+            self.dirty = True
+
+    def as_dict(self):
+        with self.lock:
+            stats = dict((name, dict(counters)) for (name, counters) in self.channels.items())
+        for counters in stats.values():
+            counters['success_ratio'] = round(counters['successes'] / counters['attempts'], 3) \
+                if counters['attempts'] else None
+            counters['confirm_ratio'] = round(counters['confirmed'] / counters['cycles'], 3) \
+                if counters['cycles'] else None
+        return stats
+
+    def save(self):
+        if self.filename is None or not self.dirty:
+            return True
+        import tempfile
+        stats = self.as_dict()
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        try:
+            (fd, tmpname) = tempfile.mkstemp(prefix='.rfverify', dir=dirname)
+            with os.fdopen(fd, 'w') as handle:
+                json.dump(stats, handle, sort_keys=True)
+            os.replace(tmpname, self.filename)
+        except (IOError, OSError) as err:
+            LOGGER.error("Unable to save verification statistics to '%s': %s", self.filename, err)
+            return False
+        self.dirty = False
+        return True
+
+
+class TransmitVerifier():
+    '''
+    An rcswitch receiver on `rxpin` counting how often the code we expect
+    is decoded. The receiver keeps running between sweeps; stop() it when
+    done.
+    '''
+    def __init__(self, rxpin, confirmations=DEFAULT_CONFIRMATIONS, listen=DEFAULT_LISTEN,
+                 stats_file=DEFAULT_STATS_FILE, backend=None):
+        import rcswitch
+        self.rxpin = rxpin
+        self.confirmations = confirmations
+        self.listen = listen
+        self.stats = VerifyStats(stats_file)
+        self.cond = threading.Condition()
+        # (expectation, code): times heard, one counter per frame listened for
+        self.heard = {}
+        self.expectations = itertools.count()
+        self.receiver = rcswitch.RCSwitch(backend=backend)
+        self.receiver.setReceiveCallback(self.received)
+
+    def start(self):
+        self.receiver.enableReceive(self.rxpin)
+        return self
+
+    def stop(self):
+        self.receiver.setReceiveCallback(None)
+        self.receiver.disableReceive()
+
+    def received(self, value, bitLength, delay, protocol):
+        with self.cond:
+            confirmed = False
+            for key in self.heard:
+                if key[1] == value:
+                    self.heard[key] += 1
+                    confirmed = confirmed or self.heard[key] >= self.confirmations
+            if confirmed:
+                self.cond.notify_all()
+
+    def expect(self, code):
+        '''
+        Start counting `code` from zero and return the key to wait() on.
+        Sweeps running side by side (a manual switch during a scheduled one)
+        each get their own counter, even for the same code.
+        '''
+        with self.cond:
+            key = (next(self.expectations), code)
+            self.heard[key] = 0
+            return key
+
+    def wait(self, key, timeout=None):
+        '''
+        True once the code expect() returned `key` for has been heard
+        `confirmations` times, False if that did not happen within
+        `timeout` seconds
+        '''
+        with self.cond:
+            try:
+                return self.cond.wait_for(lambda: self.heard.get(key, 0) >= self.confirmations,
+                                          self.listen if timeout is None else timeout)
+            finally:
+                self.heard.pop(key, None)
+
+    def forget(self, key):
+        '''
+        Stop counting for `key`, e.g. when its frame never went out
+        '''
+        with self.cond:
+            self.heard.pop(key, None)
+
+    def sweep(self, channels):
+        return VerifiedSweep(self, channels)
+
+
+class VerifiedSweep():
+    '''
+    Verification state of one plan: wrap() the send function handed to
+    lightsplanner.execute_plan and pass done() as its skip test, then
+    finish() to record the statistics. `results` lists (channel, pulse
+    length, heard) for every frame sent.
+    '''
+    def __init__(self, verifier, channels):
+        self.verifier = verifier
+        self.channels = channels
+        self.confirmed = set()
+        self.attempts = collections.Counter()
+        self.successes = collections.Counter()
+        self.results = []
+
+    def done(self, channel):
+        return channel in self.confirmed
+
+    def wrap(self, send):
+        '''
+        `send` listening for each frame after it has gone out, so the
+        listening happens outside whatever `send` holds (e.g. the radio)
+        '''
+        def send_verified(frame):
+            key = self.verifier.expect(frame.code)
+            try:
+                if not send(frame):
+                    return False
+                self.attempts[frame.channel] += 1
+                heard = self.verifier.wait(key)
+            finally:
+                self.verifier.forget(key)
+            self.results.append((frame.channel, frame.pulse_len, heard))
+            if heard:
+                self.successes[frame.channel] += 1
+                self.confirmed.add(frame.channel)
+                LOGGER.info("Channel %d: code '%s' heard at pulse length %d; skipping the rest of its sweep.",
+                            frame.channel+1, frame.code, frame.pulse_len)
+            return True
+        return send_verified
+
+    def finish(self, plan):
+        import channelstate
+        for i in set(self.attempts) | set(plan.skipped):
+            self.verifier.stats.record(channelstate.channel_name(i, self.channels[i]), cycles=1,
+                                       confirmed=int(i in self.confirmed), attempts=self.attempts[i],
+                                       successes=self.successes[i], skipped=plan.skipped[i])
+        self.verifier.stats.save()
+        return self.confirmed
+
+
+def benchmark(channels=4, deaf=(3,), pulses=range(180, 190), retransmit=2):
+    '''
+    Sweep `channels` blind and verified through the simulator, with the
+    receiver looped back to the transmitter except for the `deaf` channels
+    '''
+    import gpiobackend
+    import lightsplanner
+    import rcswitch
+    (txpin, rxpin, nowhere) = (17, 27, 22)
+    backend = gpiobackend.SimulatedBackend(capacity=2000000)
+    backend.connect(txpin, rxpin)
+    config = [{'name': 'channel%d' % (i + 1), 'on': 87347 + 144 * i, 'manage': True} for i in range(channels)]
+    (heard, unheard) = (rcswitch.RCSwitch(backend=backend), rcswitch.RCSwitch(backend=backend))
+    verifier = TransmitVerifier(rxpin, listen=0.05, stats_file=None, backend=backend).start()
+    results = {}
+    try:
+        for verified in (False, True):
+            plan = lightsplanner.build_plan(config, 'on', pulses, retransmit)
+            airtime = []
+            with heard.session(txpin) as loud, unheard.session(nowhere) as quiet:
+                def send(frame):
+                    # a deaf channel's frames go out where the receiver cannot hear them
+                    session = quiet if frame.channel in deaf else loud
+                    session.send(frame.code, lightsplanner.DEFAULT_BITS, frame.pulse_len)
+                    airtime.append(frame.airtime)
+                    return True
+                sweep = verifier.sweep(config)
+                start = time.perf_counter()
+                lightsplanner.execute_plan(plan, sweep.wrap(send) if verified else send, sleep=lambda wait: None,
+                                           done=sweep.done if verified else None)
+                elapsed = time.perf_counter() - start
+            if verified:
+                sweep.finish(plan)
+            results[verified] = (len(airtime), sweep.confirmed)
+            sys.stdout.write('%-8s %3d of %3d frames sent, %.2f s airtime, %d channels confirmed, %.0f ms\n'
+                             % ('verified' if verified else 'blind', len(airtime), len(plan), sum(airtime),
+                                len(sweep.confirmed), 1000 * elapsed))
+    finally:
+        verifier.stop()
+    for (name, counters) in sorted(verifier.stats.as_dict().items()):
+        sys.stdout.write('%-10s %s\n' % (name, json.dumps(counters, sort_keys=True)))
+    expected = set(range(channels)) - set(deaf)
+    return 0 if results[True][1] == expected and results[True][0] < results[False][0] else 1
+
+
+def main():
+    parser = ArgumentParser(description='Show per channel transmit verification statistics')
+    parser.add_argument("-s","--stats",dest="stats",default=DEFAULT_STATS_FILE,
+                        metavar="FILE",help="statistics file written by LightsManager (lights.verify.stats_file)")
+    parser.add_argument("-b","--benchmark",dest="benchmark",action="store_true",default=False,
+                        help="compare blind and verified sweeps through the simulated radio")
+    options = parser.parse_args()
+
+    if options.benchmark:
+        return benchmark()
+    if not os.path.exists(options.stats):
+        sys.stderr.write("No statistics in '%s' yet\n" % options.stats)
+        return 1
+    sys.stdout.write(json.dumps(VerifyStats(options.stats).as_dict(), sort_keys=True, indent=4) + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+'''
+Single-instance locking with fcntl advisory locks.
+
+The lock is an exclusive flock on the lock file, so it disappears with the
+process that held it and there is never a stale PID to chase. The holder's
+PID is written into the lock file with a single fixed-width pwrite, so a
+reader sees either the old or the new PID, never a torn one.
+
+Optionally the holder also listens on an abstract Unix socket (no file on
+disk, gone when the process exits). A second instance can use it to tell
+that a daemon is running and to hand it a request instead of starting.
+An abstract socket has no file permissions, so only connections from
+the holder's own user (or root) are answered, going by SO_PEERCRED.
+'''
+
+import errno
+import fcntl
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+
+LOGGER = logging.getLogger('LightsManager')
+
+PID_FORMAT = b'%-10d\n'
+PEERCRED = struct.Struct('3i')  # struct ucred: pid, uid, gid
+MAX_REQUEST = 65536  # bytes read from a refused peer
+
+
+class RunLock():
+    def __init__(self, lockfile, socket_name=None):
+        self.lockfile = lockfile
+        self.socket_name = socket_name
+        self.fd = None
+        self.server = None
+        self.thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def acquire(self):
+        try:
+            fd = os.open(self.lockfile, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError as err:
+            LOGGER.error('Unable to open lockfile %s: %s', self.lockfile, err)
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as err:
+            os.close(fd)
+            if err.errno not in (errno.EAGAIN, errno.EACCES):
+                LOGGER.error('Unable to lock %s: %s', self.lockfile, err)
+            return False
+        record = PID_FORMAT % os.getpid()
+        os.pwrite(fd, record, 0)
+        os.ftruncate(fd, len(record))
+        self.fd = fd
+        return True
+
+    def holder(self):
+        '''
+        PID recorded by the current (or last) holder, or None
+        '''
+        try:
+            with open(self.lockfile, 'rb') as handle:
+                return int(handle.read(11).strip() or 0) or None
+        except (OSError, ValueError):
+            return None
+
+    def serve(self, handler):
+        '''
+        Answer requests from other instances on the abstract socket from a
+        daemon thread. `handler(request)` gets the decoded request and returns
+        a JSON-serializable reply.
+        '''
+        if self.socket_name is None or self.fd is None:
+            return False
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.server.bind('\0' + self.socket_name)
+        except OSError as err:
+            LOGGER.error('Unable to bind control socket @%s: %s', self.socket_name, err)
+            self.server.close()
+            self.server = None
+            return False
+        self.server.listen(4)
+        self.thread = threading.Thread(target=self._serve, args=(handler,), name='runlock', daemon=True)
+        self.thread.start()
+        return True
+
+    def _serve(self, handler):
+        while self.server is not None:
+            try:
+                (conn, _) = self.server.accept()
+            except OSError:
+                break
+            with conn:
+                uid = peer_uid(conn)
+                if uid not in (os.geteuid(), 0):
+                    LOGGER.warning('Refusing control request from uid %s', uid)
+                    try:
+                        # take the request off the socket first: closing on it
+                        # unread resets the connection before the refusal arrives
+                        conn.settimeout(5.0)
+                        conn.makefile('rb').readline(MAX_REQUEST)
+                        conn.sendall(json.dumps({'error': 'permission denied'}).encode('utf-8') + b'\n')
+                    except OSError:
+                        pass
+                    continue
+                try:
+                    conn.settimeout(5.0)
+                    request = json.loads(conn.makefile('r').readline() or '{}')
+                    reply = handler(request)
+                except Exception as err:
+                    LOGGER.error('Error handling control request: %s', err)
+                    reply = {'error': str(err)}
+                try:
+                    conn.sendall(json.dumps(reply).encode('utf-8') + b'\n')
+                except OSError:
+                    pass
+
+    def release(self):
+        if self.server is not None:
+            server = self.server
+            self.server = None
+            try:
+                # wakes the accept() blocked in the serving thread
+                server.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            server.close()
+        if self.fd is None:
+            return 0
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        except OSError as err:
+            LOGGER.error('Exception releasing lock on %s: %s', self.lockfile, err)
+            return 255
+        finally:
+            os.close(self.fd)
+            self.fd = None
+        return 0
+
+
+def peer_uid(conn):
+    '''
+    uid of the process at the other end of Unix socket `conn`, or None
+    '''
+    try:
+        (pid, uid, gid) = PEERCRED.unpack(conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, PEERCRED.size))
+    except OSError:
+        return None
+    return uid
+
+
+def send(socket_name, request, timeout=2.0):
+    '''
+    Hand `request` to the instance listening on @socket_name and return its
+    reply, or None if nothing is listening
+    '''
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect('\0' + socket_name)
+        client.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        return json.loads(client.makefile('r').readline() or 'null')
+    except (OSError, ValueError):
+        return None
+    finally:
+        client.close()
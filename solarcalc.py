@@ -5,15 +5,7 @@ import time
 import math
 import logging
 
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-
-ch = logging.StreamHandler()
-ch.setLevel(logging.INFO)
-
-fh = logging.Formatter("[%(asctime)s] %(levelname)s: %(filename)s:%(funcName)s:%(lineno)d - %(message)s")
-ch.setFormatter(fh)
-logger.addHandler(ch)
+logger = logging.getLogger('solarcalc')
 
 '''
 Adapted from JavaScript code from NOAA:
@@ -545,6 +537,13 @@ def calcSunriseSet(rise, julianday, latitude, longitude, timezone, dst):
 
 
 if __name__ == "__main__":
+    logger.setLevel(logging.INFO)
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.INFO)
+    fh = logging.Formatter("[%(asctime)s] %(levelname)s: %(filename)s:%(funcName)s:%(lineno)d - %(message)s")
+    ch.setFormatter(fh)
+    logger.addHandler(ch)
+
     timestamp = time.localtime()
     julianday = getJulianDay(timestamp[0],timestamp[1],timestamp[2])
     tzoffset = time.timezone / (60*60) * -1
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+'''
+Check how long it takes to import the LightsManager entry point.
+
+LightsManager_v2 is started from cron and systemd timers, so everything it
+imports at module level is paid on every run. This imports it in a fresh
+interpreter several times with -X importtime, reports the best cumulative
+time and the slowest modules underneath it, and fails if the time is over
+the budget or if one of the modules that must only be loaded on demand
+(requests and friends are only needed when the sun times are not cached)
+shows up:
+
+    startup_budget.py
+    startup_budget.py --budget 40 --runs 10 --top 15
+'''
+
+import subprocess
+import sys
+from argparse import ArgumentParser
+
+DEFAULT_MODULE = 'LightsManager_v2'
+DEFAULT_BUDGET = 60.0  # milliseconds
+DEFAULT_RUNS = 5
+LAZY_MODULES = ('requests', 'urllib3', 'psutil', 'pytz', 'concurrent.futures', 'subprocess', 'zoneinfo')
+
+
+def import_times(module):
+    '''
+    (name, self_us, cumulative_us, depth) for every module imported by a
+    fresh `import module`, leaving out what the interpreter loads at startup
+    '''
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True, check=True).stderr
+    entries = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            (self_us, cumulative_us) = (int(fields[0]), int(fields[1]))
+        except ValueError:
+            continue  # the header line
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        entries.append((name.strip(), self_us, cumulative_us, depth))
+    # -X importtime prints a module after its imports, so the subtree of
+    # `module` is everything from the end of the previous top-level entry
+    end = max(i for (i, entry) in enumerate(entries) if entry[0] == module and entry[3] == 0)
+    start = end
+    while start > 0 and entries[start-1][3] > 0:
+        start -= 1
+    return entries[start:end+1]
+
+
+def main():
+    parser = ArgumentParser(description='Check the import time of the LightsManager entry point against a budget')
+    parser.add_argument("-m","--module",dest="module",default=DEFAULT_MODULE,
+                        metavar="MODULE",help="time importing MODULE")
+    parser.add_argument("-b","--budget",dest="budget",type=float,default=DEFAULT_BUDGET,
+                        metavar="MS",help="fail if the import takes longer than MS milliseconds")
+    parser.add_argument("-r","--runs",dest="runs",type=int,default=DEFAULT_RUNS,
+                        metavar="RUNS",help="import RUNS times and keep the fastest")
+    parser.add_argument("-n","--top",dest="top",type=int,default=10,
+                        metavar="N",help="list the N modules with the highest self time")
+    options = parser.parse_args()
+
+    best = None
+    for n in range(max(options.runs, 1)):
+        entries = import_times(options.module)
+        if best is None or entries[-1][2] < best[-1][2]:
+            best = entries
+
+    total = best[-1][2] / 1000.0
+    sys.stdout.write('import %s: %.1f ms (budget %.1f ms, best of %d)\n'
+                     % (options.module, total, options.budget, options.runs))
+    for (name, self_us, cumulative_us, depth) in sorted(best, key=lambda e: e[1], reverse=True)[:options.top]:
+        sys.stdout.write('  %8.2f ms %8.2f ms  %s\n' % (self_us / 1000.0, cumulative_us / 1000.0, name))
+
+    status = 0
+    loaded = set(entry[0] for entry in best)
+    for name in LAZY_MODULES:
+        if name in loaded:
+            sys.stderr.write('%s is imported at startup; it should only be imported when needed\n' % name)
+            status = 1
+    if total > options.budget:
+        sys.stderr.write('import %s took %.1f ms, over the %.1f ms budget\n' % (options.module, total, options.budget))
+        status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
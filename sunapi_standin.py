@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+'''
+Local stand-in for the Sunrise-Sunset.org API.
+
+Answers GET /json?lat=..&lng=..&date=YYYY-MM-DD&formatted=0 with times from
+sunevents, in the same shape as the real API. It can be made slow, flaky or
+wrong to exercise the provider's timeouts, retries, cross-checks and local
+fallback:
+
+    sunapi_standin.py --port 8089 --delay 2 --fail-rate 0.3 --skew 900 &
+    sunprovider.py -t 39.63 -g -119.9 -u http://127.0.0.1:8089/json -v
+'''
+
+import datetime
+import json
+import random
+import sys
+import threading
+import time
+import urllib.parse
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import sunevents
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        server.requests += 1
+        if server.delay:
+            time.sleep(server.delay)
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path != '/json':
+            return self.reply(404, {'status': 'NOT_FOUND'})
+        if server.fail_rate and random.random() < server.fail_rate:
+            return self.reply(503, {'status': 'UNKNOWN_ERROR'})
+        try:
+            latitude = float(query['lat'][0])
+            longitude = float(query['lng'][0])
+            date = datetime.date.today()
+            if query.get('date'):
+                date = datetime.date.fromisoformat(query['date'][0])
+        except (KeyError, ValueError):
+            return self.reply(400, {'status': 'INVALID_REQUEST'})
+        events = sunevents.compute_day(date, latitude, longitude)
+        if server.skew:
+            events = dict((e, t + server.skew if isinstance(t, float) else t) for (e, t) in events.items())
+        results = sunevents.as_results(events)
+        self.reply(200, {'results': results, 'status': 'OK'})
+
+    def reply(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), delay=0.0, fail_rate=0.0, skew=0.0, verbose=False):
+        ThreadingHTTPServer.__init__(self, address, StandInHandler)
+        self.delay = delay
+        self.fail_rate = fail_rate
+        self.skew = skew
+        self.verbose = verbose
+        self.requests = 0
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d/json' % self.server_address[:2]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name='sunapi-standin', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = ArgumentParser(description='Serve a local stand-in for the Sunrise-Sunset.org API')
+    parser.add_argument("-p","--port",dest="port",type=int,default=8089,
+                        metavar="PORT",help="listen on PORT")
+    parser.add_argument("-d","--delay",dest="delay",type=float,default=0.0,
+                        metavar="SECONDS",help="wait SECONDS before answering each request")
+    parser.add_argument("-f","--fail-rate",dest="fail_rate",type=float,default=0.0,
+                        metavar="RATE",help="answer a fraction RATE of requests with HTTP 503")
+    parser.add_argument("-s","--skew",dest="skew",type=float,default=0.0,
+                        metavar="SECONDS",help="shift every returned time by SECONDS")
+    parser.add_argument("-v","--verbose",dest="verbose",action="store_true",default=False,
+                        help="log every request")
+    options = parser.parse_args()
+
+    server = StandInServer(('127.0.0.1', options.port), options.delay, options.fail_rate,
+                           options.skew, options.verbose)
+    sys.stdout.write('Serving on %s\n' % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+'''
+Shared store for sun times, keyed by (location, date).
+
+Replaces the single-day SunRiseSetTimes.json that every run overwrote. Rows
+live in an SQLite database in WAL mode, so several controllers and sites can
+read and write the same file without clobbering each other, and each row
+expires `ttl` seconds after it was stored. Ranges of prefetched days go in
+with one transaction, and rows already looked up are memoized in memory so
+repeated lookups are a dict hit.
+'''
+
+import json
+import logging
+import sqlite3
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+
+LOGGER = logging.getLogger('LightsManager')
+
+DEFAULT_CACHE_FILE = 'SunRiseSetTimes.db'
+DEFAULT_TTL = 7 * 24 * 60 * 60
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS suntimes (
+    location TEXT NOT NULL,
+    date TEXT NOT NULL,
+    results TEXT NOT NULL,
+    expires REAL NOT NULL,
+    PRIMARY KEY (location, date)
+) WITHOUT ROWID
+'''
+
+
+class SunCacheStore():
+    def __init__(self, filename=DEFAULT_CACHE_FILE, ttl=DEFAULT_TTL):
+        self.filename = filename
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.memo = {}
+        self.db = sqlite3.connect(filename, timeout=10.0, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def get(self, location, date):
+        key = (location, date.isoformat())
+        now = time.time()
+        with self.lock:
+            entry = self.memo.get(key)
+            if entry is None:
+                row = self.db.execute('SELECT results, expires FROM suntimes WHERE location = ? AND date = ?',
+                                      key).fetchone()
+                if row is None:
+                    return None
+                entry = (json.loads(row[0]), row[1])
+                self.memo[key] = entry
+        if entry[1] < now:
+            return None
+        return entry[0]
+
+    def put(self, location, date, results):
+        return self.put_many(location, [(date, results)])
+
+    def put_many(self, location, items):
+        expires = time.time() + self.ttl
+        rows = [(location, date.isoformat(), json.dumps(results, separators=(',', ':')), expires)
+                for (date, results) in items]
+        with self.lock:
+            try:
+                self.db.execute('BEGIN IMMEDIATE')
+                self.db.executemany('INSERT OR REPLACE INTO suntimes VALUES (?, ?, ?, ?)', rows)
+                self.db.execute('COMMIT')
+            except sqlite3.Error as err:
+                LOGGER.error("Unable to store sun times in '%s': %s", self.filename, err)
+                if self.db.in_transaction:
+                    self.db.execute('ROLLBACK')
+                return False
+            for (date, results) in items:
+                self.memo[(location, date.isoformat())] = (results, expires)
+        return True
+
+    def purge(self):
+        '''
+        Remove expired rows; returns how many went
+        '''
+        with self.lock:
+            cursor = self.db.execute('DELETE FROM suntimes WHERE expires < ?', (time.time(),))
+            self.memo.clear()
+            return cursor.rowcount
+
+    def locations(self):
+        with self.lock:
+            return [row[0] for row in self.db.execute('SELECT DISTINCT location FROM suntimes')]
+
+
+def main():
+    parser = ArgumentParser(description='Inspect or purge the shared sun times store')
+    parser.add_argument("-f","--cache-file",dest="cache_file",default=DEFAULT_CACHE_FILE,
+                        metavar="CACHEFILE",help="use the store in CACHEFILE")
+    parser.add_argument("-p","--purge",dest="purge",action="store_true",default=False,
+                        help="remove expired rows")
+    options = parser.parse_args()
+
+    store = SunCacheStore(options.cache_file)
+    if options.purge:
+        sys.stdout.write('Purged %d expired rows\n' % store.purge())
+    for (location, days, first, last) in store.db.execute(
+            'SELECT location, COUNT(*), MIN(date), MAX(date) FROM suntimes GROUP BY location'):
+        sys.stdout.write('%s: %d days, %s .. %s\n' % (location, days, first, last))
+    store.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+'''
+Compute sun event times locally, for any number of days.
+
+Uses the NOAA equations from solarcalc to produce the same events the
+Sunrise-Sunset.org API returns (twilights, sunrise, solar noon, sunset) as
+UTC epoch seconds. Events that do not happen on a given day (polar day or
+night) are None, and on days the sun neither rises nor sets the 'polar'
+entry says whether it stays up ('day') or down ('night').
+'''
+
+import datetime
+import logging
+import math
+
+import solarcalc
+
+LOGGER = logging.getLogger('LightsManager')
+
+SUNRISE_ZENITH = 90.833
+
+# Event names as used by the API, with the zenith angle defining each one
+EVENT_ZENITHS = (
+    ('astronomical_twilight_begin', 108.0, True),
+    ('nautical_twilight_begin', 102.0, True),
+    ('civil_twilight_begin', 96.0, True),
+    ('sunrise', SUNRISE_ZENITH, True),
+    ('sunset', SUNRISE_ZENITH, False),
+    ('civil_twilight_end', 96.0, False),
+    ('nautical_twilight_end', 102.0, False),
+    ('astronomical_twilight_end', 108.0, False),
+)
+EVENT_KEYS = (
+    'astronomical_twilight_begin',
+    'nautical_twilight_begin',
+    'civil_twilight_begin',
+    'sunrise',
+    'solar_noon',
+    'sunset',
+    'civil_twilight_end',
+    'nautical_twilight_end',
+    'astronomical_twilight_end'
+)
+
+POLAR_KEY = 'polar'
+
+UNIX_EPOCH_JD = 2440587.5
+
+
+def julian_day(date):
+    return date.toordinal() + 1721424.5
+
+
+def _hour_angle_cos(julianday, latitude, zenith):
+    '''
+    Cosine of the hour angle at which the sun crosses `zenith` on
+    `julianday`: below -1 it stays above that zenith all day, above 1 it
+    never reaches it
+    '''
+    t = solarcalc.calcTimeJulianCent(julianday)
+    solarDec = solarcalc.calcSunDeclination(t)
+    latRad = math.radians(latitude)
+    sdRad = math.radians(solarDec)
+    return (math.cos(math.radians(zenith)) / (math.cos(latRad) * math.cos(sdRad))
+            - math.tan(latRad) * math.tan(sdRad))
+
+
+def _event_minutes(rise, julianday, latitude, longitude, zenith):
+    '''
+    Minutes after 0h UTC of `julianday` at which the sun crosses `zenith`, or
+    None if it never does that day
+    '''
+    eqTime = solarcalc.calcEquationOfTime(solarcalc.calcTimeJulianCent(julianday))
+    haArg = _hour_angle_cos(julianday, latitude, zenith)
+    if haArg < -1.0 or haArg > 1.0:
+        return None
+    hourAngle = math.acos(haArg)
+    if not rise:
+        hourAngle = -hourAngle
+    return 720 - 4.0 * (longitude + math.degrees(hourAngle)) - eqTime
+
+
+def _noon_minutes(julianday, longitude):
+    tnoon = solarcalc.calcTimeJulianCent(julianday - longitude / 360.0)
+    eqTime = solarcalc.calcEquationOfTime(tnoon)
+    offset = 720.0 - longitude * 4 - eqTime
+    t = solarcalc.calcTimeJulianCent(julianday + offset / 1440.0)
+    return 720.0 - longitude * 4 - solarcalc.calcEquationOfTime(t)
+
+
+def compute_day(date, latitude, longitude):
+    '''
+    Dict of event name to UTC epoch seconds for `date` at the given location,
+    plus POLAR_KEY on polar days and nights
+    '''
+    jd = julian_day(date)
+    midnight = (jd - UNIX_EPOCH_JD) * 86400.0
+    events = {'solar_noon': midnight + _noon_minutes(jd, longitude) * 60.0}
+    for (event, zenith, rise) in EVENT_ZENITHS:
+        minutes = _event_minutes(rise, jd, latitude, longitude, zenith)
+        if minutes is not None:
+            # second pass evaluates the sun position at the event itself
+            minutes = _event_minutes(rise, jd + minutes / 1440.0, latitude, longitude, zenith)
+        events[event] = None if minutes is None else midnight + minutes * 60.0
+    if events['sunrise'] is None:
+        events[POLAR_KEY] = 'day' if _hour_angle_cos(jd, latitude, SUNRISE_ZENITH) < -1.0 else 'night'
+    return events
+
+
+def as_results(events):
+    '''
+    Results object shaped like the API's formatted=0 response
+    '''
+    results = {}
+    for (event, when) in events.items():
+        if event == POLAR_KEY:
+            results[event] = when
+        elif when is not None:
+            results[event] = datetime.datetime.fromtimestamp(when, datetime.timezone.utc).isoformat()
+    return results
+
+
+class SunSeries():
+    '''
+    Sun events for a run of consecutive local dates, stored column-wise so a
+    whole event can be read for every day at once
+    '''
+    def __init__(self, start, days, latitude, longitude, tz=None):
+        self.start = start
+        self.latitude = latitude
+        self.longitude = longitude
+        self.tz = tz
+        self.dates = [start + datetime.timedelta(days=n) for n in range(days)]
+        self.columns = dict((event, []) for event in EVENT_KEYS)
+        self.polar = []
+        for date in self.dates:
+            events = compute_day(date, latitude, longitude)
+            for event in EVENT_KEYS:
+                self.columns[event].append(events[event])
+            self.polar.append(events.get(POLAR_KEY))
+        self.weekdays = [date.weekday() for date in self.dates]
+        self._clock_columns = {}
+
+    def __len__(self):
+        return len(self.dates)
+
+    def column(self, event):
+        return self.columns[event]
+
+    def day(self, index):
+        events = dict((event, self.columns[event][index]) for event in EVENT_KEYS)
+        if self.polar[index] is not None:
+            events[POLAR_KEY] = self.polar[index]
+        return events
+
+    def clock_column(self, clock):
+        '''
+        Epoch of local wall-clock time `clock` (a datetime.time) on every day
+        '''
+        column = self._clock_columns.get(clock)
+        if column is None:
+            column = [datetime.datetime.combine(date, clock, self.tz).timestamp() for date in self.dates]
+            self._clock_columns[clock] = column
+        return column
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+'''
+Sunrise/sunset times for several days ahead, without blocking on the network.
+
+Days are fetched from the Sunrise-Sunset.org API over one keep-alive session
+with a bounded pool of workers, per-request timeouts and retries, and kept in
+the shared suncache store. Asking for a day that is cached returns immediately and
+tops up the days ahead in the background; asking for one that is not waits at
+most `deadline` seconds for the API before falling back to computing the
+times locally with sunevents.
+
+Every API answer is checked against a locally computed table before it is
+cached. Events further than `tolerance` seconds from the local value are
+flagged, and with on_deviation='replace' the whole day is replaced by the
+local times. The deviations seen are kept in DeviationStats.
+'''
+
+import datetime
+import json
+import logging
+import sys
+import threading
+from argparse import ArgumentParser
+
+import lightsschedule
+import suncache
+
+LOGGER = logging.getLogger('LightsManager')
+
+API_URL = 'https://api.sunrise-sunset.org/json'
+DEFAULT_TIMEOUT = (3.05, 5.0)  # connect, read
+DEFAULT_RETRIES = 2
+DEFAULT_WORKERS = 4
+DEFAULT_DEADLINE = 5.0
+DEFAULT_PREFETCH_DAYS = 7
+DEFAULT_TOLERANCE = 300.0  # seconds
+CHECKED_EVENTS = ('civil_twilight_begin', 'sunrise', 'solar_noon', 'sunset', 'civil_twilight_end')
+
+
+def location_key(latitude, longitude):
+    return '%.4f,%.4f' % (float(latitude), float(longitude))
+
+
+class LocalTable():
+    '''
+    Locally computed events, filled a range of days at a time
+    '''
+    def __init__(self, latitude, longitude, days=DEFAULT_PREFETCH_DAYS):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.days = max(days, 1)
+        self.table = {}
+        self.lock = threading.Lock()
+
+    def get(self, date):
+        with self.lock:
+            events = self.table.get(date)
+            if events is None:
+                import sunevents
+                series = sunevents.SunSeries(date, self.days, self.latitude, self.longitude)
+                for n, day in enumerate(series.dates):
+                    self.table[day] = series.day(n)
+                events = self.table[date]
+            return events
+
+
+class DeviationStats():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checked = 0
+        self.flagged = 0
+        self.replaced = 0
+        self.total = dict((event, 0.0) for event in CHECKED_EVENTS)
+        self.count = dict((event, 0) for event in CHECKED_EVENTS)
+        self.worst = dict((event, 0.0) for event in CHECKED_EVENTS)
+
+    def record(self, deviations, flagged, replaced):
+        with self.lock:
+            self.checked += 1
+            self.flagged += int(flagged)
+            self.replaced += int(replaced)
+            for (event, deviation) in deviations.items():
+                self.total[event] += abs(deviation)
+                self.count[event] += 1
+                self.worst[event] = max(self.worst[event], abs(deviation))
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'checked': self.checked,
+                'flagged': self.flagged,
+                'replaced': self.replaced,
+                'mean_seconds': dict((e, round(self.total[e] / self.count[e], 1))
+                                     for e in CHECKED_EVENTS if self.count[e]),
+                'max_seconds': dict((e, round(self.worst[e], 1)) for e in CHECKED_EVENTS if self.count[e]),
+            }
+
+
+class SunTimesProvider():
+    def __init__(self, latitude, longitude, cache, url=API_URL, timeout=DEFAULT_TIMEOUT,
+                 retries=DEFAULT_RETRIES, workers=DEFAULT_WORKERS, deadline=DEFAULT_DEADLINE,
+                 prefetch_days=DEFAULT_PREFETCH_DAYS, tolerance=DEFAULT_TOLERANCE, on_deviation='replace'):
+        self.latitude = float(latitude)
+        self.longitude = float(longitude)
+        self.location = location_key(latitude, longitude)
+        self.cache = cache
+        self.url = url
+        self.timeout = timeout
+        self.deadline = deadline
+        self.prefetch_days = prefetch_days
+        self.tolerance = tolerance
+        self.on_deviation = on_deviation
+        self.local_table = LocalTable(self.latitude, self.longitude, prefetch_days + 1)
+        self.stats = DeviationStats()
+        self.retries = retries
+        self.workers = workers
+        self.session = None
+        self.executor = None
+        self.inflight = {}
+        self.closing = None
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _start(self):
+        '''
+        Create the HTTP session and worker pool on first use, so a run served
+        entirely from the cache never imports requests
+        '''
+        import concurrent.futures
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        self.session = requests.Session()
+        retry = Retry(total=self.retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=('GET',))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers,
+                                                              thread_name_prefix='sunprovider')
+
+    def close(self, wait=True):
+        '''
+        Release the session and the cache. Without `wait` this returns at
+        once, and the `closing` thread releases them after the fetches still
+        in flight are done with them.
+        '''
+        if wait:
+            self._release()
+        else:
+            self.closing = threading.Thread(target=self._release, name='sunprovider-close')
+            self.closing.start()
+
+    def _release(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.session.close()
+        self.cache.close()
+
+    def fetch(self, date, store=True):
+        '''
+        Results object for `date` from the API
+        '''
+        params = {
+            'formatted': 0,
+            'lat': self.latitude,
+            'lng': self.longitude,
+            'date': date.isoformat()
+        }
+        response = self.session.get(self.url, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        obj = response.json()
+        if obj.get('status', 'OK') != 'OK' or not obj.get('results'):
+            raise ValueError("API returned status '%s' for %s" % (obj.get('status'), date))
+        results = self.validate(date, obj.get('results'))
+        if store:
+            self.cache.put(self.location, date, results)
+        LOGGER.debug("Fetched sun times for %s: %s", date, results)
+        return results
+
+    def _submit(self, date, batch=None):
+        with self.lock:
+            if self.executor is None:
+                self._start()
+            future = self.inflight.get(date)
+            if future is None:
+                future = self.executor.submit(self.fetch, date, batch is None)
+                self.inflight[date] = future
+                future.add_done_callback(lambda f, date=date: self._done(date, f, batch))
+            elif batch is not None:
+                batch['pending'] -= 1
+            return future
+
+    def _done(self, date, future, batch):
+        with self.lock:
+            self.inflight.pop(date, None)
+        if future.exception() is not None:
+            LOGGER.warning("Unable to fetch sun times for %s: %s", date, future.exception())
+        if batch is None:
+            return
+        with self.lock:
+            if future.exception() is None:
+                batch['items'].append((date, future.result()))
+            batch['pending'] -= 1
+            finished = batch['pending'] == 0
+        if finished and batch['items']:
+            self.cache.put_many(self.location, batch['items'])
+
+    def prefetch(self, start, days=None):
+        '''
+        Queue fetches for the uncached days from `start`; returns their futures.
+        The fetched days are stored together once the last one completes.
+        '''
+        if days is None:
+            days = self.prefetch_days
+        dates = [start + datetime.timedelta(days=n) for n in range(days)]
+        dates = [date for date in dates if self.cache.get(self.location, date) is None]
+        batch = {'pending': len(dates), 'items': []}
+        return [self._submit(date, batch) for date in dates]
+
+    def validate(self, date, results):
+        '''
+        Compare API results with the local table; returns the results to use
+        '''
+        local = self.local_table.get(date)
+        deviations = {}
+        for event in CHECKED_EVENTS:
+            if local.get(event) is None or not results.get(event):
+                continue
+            try:
+                deviations[event] = lightsschedule.parse_event(results.get(event)) - local.get(event)
+            except ValueError:
+                LOGGER.warning("Unparseable '%s' value '%s' for %s", event, results.get(event), date)
+        outliers = dict((e, d) for (e, d) in deviations.items() if abs(d) > self.tolerance)
+        replace = bool(outliers) and self.on_deviation == 'replace'
+        self.stats.record(deviations, bool(outliers), replace)
+        if not outliers:
+            return results
+        LOGGER.warning("API sun times for %s deviate from local calculation by %s seconds%s",
+                       date, dict((e, round(d)) for (e, d) in outliers.items()),
+                       '; using local times' if replace else '')
+        if replace:
+            return self.local(date)
+        results = dict(results)
+        results['deviation'] = outliers
+        return results
+
+    def local(self, date):
+        import sunevents
+        results = sunevents.as_results(self.local_table.get(date))
+        results['source'] = 'local'
+        return results
+
+    def get(self, date=None):
+        '''
+        Results object for `date` (default today) from the cache, the API or,
+        failing both within the deadline, local computation
+        '''
+        if date is None:
+            date = datetime.date.today()
+        results = self.cache.get(self.location, date)
+        if results is None:
+            import concurrent.futures
+            try:
+                results = self._submit(date).result(timeout=self.deadline)
+            except concurrent.futures.TimeoutError:
+                LOGGER.warning("Sun times API did not answer within %.1f seconds. Using local calculation.",
+                               self.deadline)
+            except Exception as err:
+                LOGGER.warning("Error fetching sun times: %s. Using local calculation.", err)
+        if results is None:
+            results = self.local(date)
+        self.prefetch(date + datetime.timedelta(days=1))
+        return results
+
+
+def get_provider(location, config=None):
+    api = (config or {}).get('api', {})
+    timeout = api.get('timeout', DEFAULT_TIMEOUT)
+    if isinstance(timeout, list):
+        timeout = tuple(timeout)
+    return SunTimesProvider(location.get('latitude'), location.get('longitude'),
+                            suncache.SunCacheStore(api.get('cache_file', suncache.DEFAULT_CACHE_FILE),
+                                                   api.get('cache_ttl', suncache.DEFAULT_TTL)),
+                            url=api.get('url', API_URL),
+                            timeout=timeout,
+                            retries=api.get('retries', DEFAULT_RETRIES),
+                            workers=api.get('workers', DEFAULT_WORKERS),
+                            deadline=api.get('deadline', DEFAULT_DEADLINE),
+                            prefetch_days=api.get('prefetch_days', DEFAULT_PREFETCH_DAYS),
+                            tolerance=api.get('tolerance', DEFAULT_TOLERANCE),
+                            on_deviation=api.get('on_deviation', 'replace'))
+
+
+def main():
+    parser = ArgumentParser(description='Prefetch sunrise/sunset times into the local cache')
+    parser.add_argument("-t","--latitude",dest="latitude",type=float,required=True,
+                        metavar="LATITUDE",help="query using latitude LATITUDE")
+    parser.add_argument("-g","--longitude",dest="longitude",type=float,required=True,
+                        metavar="LONGITUDE",help="query using longitude LONGITUDE")
+    parser.add_argument("-n","--days",dest="days",type=int,default=DEFAULT_PREFETCH_DAYS,
+                        metavar="DAYS",help="prefetch DAYS days starting today")
+    parser.add_argument("-u","--url",dest="url",default=API_URL,
+                        metavar="URL",help="use the API at URL")
+    parser.add_argument("-f","--cache-file",dest="cache_file",default=suncache.DEFAULT_CACHE_FILE,
+                        metavar="CACHEFILE",help="store results in CACHEFILE")
+    parser.add_argument("-v","--verbose",dest="verbose",action="store_true",default=False,
+                        help="output verbose log messages")
+    options = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s')
+    LOGGER.setLevel(logging.INFO if options.verbose else logging.WARN)
+
+    location = {'latitude': options.latitude, 'longitude': options.longitude}
+    config = {'api': {'url': options.url, 'cache_file': options.cache_file}}
+    errors = 0
+    with get_provider(location, config) as provider:
+        for future in provider.prefetch(datetime.date.today(), options.days):
+            if future.exception() is not None:
+                errors += 1
+        sys.stdout.write(json.dumps(provider.stats.as_dict(), sort_keys=True, indent=4) + '\n')
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
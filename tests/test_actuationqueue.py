@@ -0,0 +1,124 @@
+import threading
+
+import pytest
+
+import actuationqueue
+
+
+class Recorder():
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, state, indexes, priority):
+        self.calls.append((state, sorted(indexes), priority))
+        return 0
+
+
+@pytest.fixture
+def sent():
+    return Recorder()
+
+
+@pytest.fixture
+def queue(sent):
+    return actuationqueue.ActuationQueue(sent, window=2.0, clock=lambda: 0.0)
+
+
+def test_command_waits_for_the_window(queue, sent):
+    assert queue.submit({0: 'on'}, now=10.0) == 12.0
+    assert queue.flush(now=11.9) == 0
+    assert sent.calls == []
+    queue.flush(now=12.0)
+    assert sent.calls == [('on', [0], 0)]
+
+
+def test_newer_command_replaces_the_pending_one(queue, sent):
+    queue.submit({0: 'on'}, now=10.0)
+    # and restarts the window
+    assert queue.submit({0: 'off'}, now=11.0) == 13.0
+    queue.flush(now=12.5)
+    assert sent.calls == []
+    queue.flush(now=13.0)
+    assert sent.calls == [('off', [0], 0)]
+    assert queue.stats()['superseded'] == 1
+
+
+def test_repeat_keeps_the_original_due_time(queue, sent):
+    queue.submit({0: 'on'}, now=10.0)
+    queue.submit({0: 'on'}, priority=2, now=11.5)
+    assert queue.next_due() == 12.0
+    queue.flush(now=12.0)
+    assert sent.calls == [('on', [0], 2)]
+    assert queue.stats()['duplicates'] == 1
+
+
+def test_channels_going_the_same_way_are_batched(queue, sent):
+    queue.submit({0: 'on', 1: 'on', 2: 'off'}, now=10.0)
+    queue.submit({3: 'on'}, now=10.5)
+    queue.flush(now=13.0)
+    assert sorted(sent.calls) == [('off', [2], 0), ('on', [0, 1, 3], 0)]
+    assert queue.stats()['batches'] == 2
+
+
+def test_higher_priority_goes_first(queue, sent):
+    queue.submit({0: 'on'}, priority=0, now=10.0)
+    queue.submit({1: 'off'}, priority=2, now=10.0)
+    queue.flush(now=12.0)
+    assert [priority for (state, indexes, priority) in sent.calls] == [2, 0]
+
+
+def test_reverting_to_the_last_state_sends_nothing(queue, sent):
+    queue.submit({0: 'on'}, now=0.0)
+    queue.flush(now=2.0)
+    queue.submit({0: 'off'}, now=10.0)
+    queue.submit({0: 'on'}, now=10.5)
+    queue.flush(now=20.0)
+    assert sent.calls == [('on', [0], 0)]
+    stats = queue.stats()
+    assert (stats['reverted'], stats['actuated'], stats['pending']) == (1, 1, 0)
+
+
+def test_flapping_channel_with_no_last_state_is_sent(queue, sent):
+    queue.submit({0: 'on'}, now=10.0)
+    queue.submit({0: 'off'}, now=10.5)
+    queue.submit({0: 'on'}, now=11.0)
+    queue.flush(now=20.0)
+    assert sent.calls == [('on', [0], 0)]
+
+
+def test_override_cancels_and_sets_the_last_state(queue, sent):
+    queue.submit({0: 'on', 1: 'on'}, now=10.0)
+    queue.override({0: 'off'})
+    queue.flush(now=20.0)
+    assert sent.calls == [('on', [1], 0)]
+    # channel 0 was switched off by hand: off -> on -> off is a revert
+    queue.submit({0: 'on'}, now=30.0)
+    queue.submit({0: 'off'}, now=30.5)
+    queue.flush(now=40.0)
+    assert sent.calls == [('on', [1], 0)]
+
+
+def test_failing_actuate_counts_as_an_error(sent):
+    def broken(state, indexes, priority):
+        raise OSError('radio gone')
+    queue = actuationqueue.ActuationQueue(broken, window=0.0, clock=lambda: 0.0)
+    queue.submit({0: 'on'}, now=0.0)
+    assert queue.flush(now=0.0) == 1
+
+
+def test_worker_sends_when_due_and_stop_flushes():
+    done = threading.Event()
+    calls = []
+
+    def actuate(state, indexes, priority):
+        calls.append((state, indexes))
+        done.set()
+    queue = actuationqueue.ActuationQueue(actuate, window=0.05).start()
+    try:
+        queue.submit({0: 'on'})
+        assert done.wait(5.0)
+        queue.window = 60.0
+        queue.submit({1: 'off'})
+    finally:
+        queue.stop()
+    assert calls == [('on', [0]), ('off', [1])]
@@ -0,0 +1,86 @@
+import json
+import threading
+
+import pytest
+
+import channelstate
+
+CHANNELS = [
+    {'name': 'porch', 'on': 87347, 'manage': True},
+    {'on': 87491, 'manage': True},
+    {'name': 'garage', 'on': 87811, 'manage': False},
+]
+NOW = 1718900000.0
+
+
+@pytest.fixture
+def statefile(tmp_path):
+    return str(tmp_path / 'state.json')
+
+
+def reconciler(statefile, refresh=3600):
+    return channelstate.Reconciler(channelstate.ChannelStateStore(statefile), refresh)
+
+
+def test_unknown_channels_are_sent(statefile):
+    assert reconciler(statefile).pending(CHANNELS, 'on', NOW) == [0, 1]
+
+
+def test_recorded_state_is_not_sent_again(statefile):
+    first = reconciler(statefile)
+    assert first.commit(CHANNELS, 'on', [0, 1], NOW)
+    second = reconciler(statefile)
+    assert second.pending(CHANNELS, 'on', NOW + 60) == []
+    assert second.pending(CHANNELS, 'off', NOW + 60) == [0, 1]
+
+
+def test_refresh_interval_resends_the_same_state(statefile):
+    reconciler(statefile).commit(CHANNELS, 'on', [0, 1], NOW)
+    refreshing = reconciler(statefile, refresh=3600)
+    assert refreshing.pending(CHANNELS, 'on', NOW + 3599) == []
+    assert refreshing.pending(CHANNELS, 'on', NOW + 3600) == [0, 1]
+    assert reconciler(statefile, refresh=None).pending(CHANNELS, 'on', NOW + 10 * 86400) == []
+
+
+def test_unnamed_channels_are_recorded_by_position(statefile):
+    reconciler(statefile).commit(CHANNELS, 'off', [1], NOW, confirmed=True)
+    with open(statefile) as handle:
+        assert json.load(handle) == {'channel2': {'state': 'off', 'timestamp': NOW, 'confirmed': True}}
+
+
+def test_commit_keeps_what_another_cycle_committed(statefile):
+    # both loaded before either committed, like a manual switch during a sweep
+    (scheduled, manual) = (reconciler(statefile), reconciler(statefile))
+    scheduled.commit(CHANNELS, 'on', [0], NOW)
+    manual.commit(CHANNELS, 'off', [1], NOW + 1)
+    states = channelstate.ChannelStateStore(statefile).states
+    assert (states['porch']['state'], states['channel2']['state']) == ('on', 'off')
+
+
+def test_commit_waits_for_the_commit_lock(statefile):
+    committed = threading.Event()
+    worker = threading.Thread(target=lambda: reconciler(statefile).commit(CHANNELS, 'on', [0], NOW)
+                              and committed.set())
+    with channelstate.COMMIT_LOCK:
+        worker.start()
+        assert not committed.wait(0.1)
+    worker.join(5.0)
+    assert committed.is_set()
+    assert channelstate.ChannelStateStore(statefile).get('porch')['state'] == 'on'
+
+
+def test_concurrent_commits_lose_nothing(statefile):
+    channels = [{'name': 'channel%d' % n, 'manage': True} for n in range(16)]
+    threads = [threading.Thread(target=reconciler(statefile).commit, args=(channels, 'on', [n], NOW))
+               for n in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5.0)
+    assert len(channelstate.ChannelStateStore(statefile).states) == 16
+
+
+def test_unreadable_state_starts_empty(statefile):
+    with open(statefile, 'w') as handle:
+        handle.write('{truncated')
+    assert channelstate.ChannelStateStore(statefile).states == {}
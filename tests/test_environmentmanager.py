@@ -0,0 +1,44 @@
+import os
+import shutil
+
+import pytest
+
+import EnvironmentManager
+import gpiobackend
+import lightsconfig
+import rfarbiter
+from rcswitch import RCSwitch
+
+CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'EnvironmentManager.cfg')
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    monkeypatch.setenv('RCSWITCH_BACKEND', 'sim')
+    # a copy, so the config snapshot is not written next to the shipped file
+    config = lightsconfig.load(shutil.copy(CONFIG, str(tmp_path)))
+    manager = EnvironmentManager.EnvironmentManager(config)
+    manager.registry.radio = rfarbiter.AirtimeArbiter(str(tmp_path / 'radio.lock'))
+    return manager
+
+
+def test_set_channel_sends_on_the_configured_pin(manager):
+    assert manager.setChannel('channel4', 'on')
+    backend = manager.switch.backend
+    reference = RCSwitch(transmitterPin=11, pulseLength=185, backend=gpiobackend.SimulatedBackend())
+    reference.enableTransmit(11)
+    reference.send(89347, 24)
+    assert manager.config.lights.txpin == 11
+    # the session leaves the pin low once more at the end
+    assert backend.durations_us(11)[:-1] == pytest.approx(reference.backend.durations_us(11), abs=1)
+
+
+def test_set_channel_sends_a_group_in_one_session(manager):
+    assert manager.setChannel('daytime', 'off')
+    frames = len(manager.switch.backend.edges(11)) // (2 * 24 + 2)
+    assert frames == 2 * manager.switch.repeatTransmit
+    assert manager.registry.radio.stats.as_dict()['high']['grants'] == 2
+
+
+def test_set_channel_rejects_unknown_names(manager):
+    assert not manager.setChannel('nosuchchannel', 'on')
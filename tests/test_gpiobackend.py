@@ -0,0 +1,26 @@
+import pytest
+
+import gpiobackend
+
+
+def test_board_pins_map_to_their_gpio():
+    # the 433 MHz transmitter data line, receiver and DHT22 of the shipped wiring
+    assert gpiobackend.bcm_gpio(11) == 17
+    assert gpiobackend.bcm_gpio(13) == 27
+    assert gpiobackend.bcm_gpio(7) == 4
+    assert len(set(gpiobackend.BOARD_TO_BCM.values())) == len(gpiobackend.BOARD_TO_BCM) == 28
+
+
+@pytest.mark.parametrize('pin', [1, 2, 4, 6, 9, 14, 17, 20, 25, 30, 34, 39, 41])
+def test_power_and_ground_pins_are_refused(pin):
+    with pytest.raises(ValueError):
+        gpiobackend.bcm_gpio(pin)
+
+
+def test_bcm_numbering_passes_gpio_numbers_through():
+    assert gpiobackend.bcm_gpio(17, 'bcm') == 17
+
+
+def test_unknown_numbering_is_refused():
+    with pytest.raises(ValueError):
+        gpiobackend.check_numbering('wiringpi')
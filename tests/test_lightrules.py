@@ -0,0 +1,26 @@
+import pytest
+
+import lightrules
+from lightrules import RuleError, compile_rule
+
+
+@pytest.mark.parametrize('clause,days', [
+    ('daily', range(7)),
+    ('weekdays', range(5)),
+    ('weekdays only', range(5)),
+    ('weekends only', (5, 6)),
+    ('mon wed fri', (0, 2, 4)),
+    ('monday/wednesday', (0, 2)),
+    ('tues thurs', (1, 3)),
+    ('thur only', (3,)),
+    ('sat sunday', (5, 6)),
+])
+def test_day_clauses(clause, days):
+    assert compile_rule('sunset, %s' % clause).days == frozenset(days)
+
+
+@pytest.mark.parametrize('clause', ['monkey', 'sundae', 'thursdays', 'fridge', 'weekday', 'only', 'mon only fri'])
+def test_day_clauses_must_name_days(clause):
+    assert lightrules.parse_days(clause) is None
+    with pytest.raises(RuleError):
+        compile_rule('sunset, %s' % clause)
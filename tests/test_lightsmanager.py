@@ -0,0 +1,110 @@
+import time
+
+import pytest
+
+import LightsManager_v2
+import lightsconfig
+
+CHANNELS = [
+    {"name": "porch", "on": 87347, "off": 87356, "manage": True},
+    {"name": "hall", "on": 87491, "off": 87500, "manage": True},
+]
+
+
+@pytest.fixture
+def config(tmp_path, monkeypatch):
+    monkeypatch.setenv('RCSWITCH_BACKEND', 'sim')
+    monkeypatch.setattr(LightsManager_v2, 'SCHEDULE', {})
+    return lightsconfig.compile_config({
+        "location": {"latitude": 39.63, "longitude": -119.9},
+        "radio": {"lock": str(tmp_path / 'radio.lock')},
+        "lights": {"txpin": 11, "pulse": {"start": 184, "end": 186, "retransmit": 1},
+                   "state_file": str(tmp_path / 'state.json'), "channels": CHANNELS},
+    })
+
+
+def test_set_replies_at_the_first_edge(config):
+    reply = LightsManager_v2.set_channels(config, {'command': 'set', 'channel': 'hall', 'state': 'on'})
+    assert 'error' not in reply
+    assert reply['channels'] == {'hall': 'on'}
+    assert reply['latency_ms'] < 100.0
+    transmitter = LightsManager_v2.SCHEDULE['transmitter']
+    assert transmitter.transmitterPin == 11
+    assert transmitter.backend.edges(11)
+
+
+def test_transmitter_is_set_up_once(config):
+    first = LightsManager_v2.get_transmitter(config)
+    assert LightsManager_v2.cycle_lights(config, 'on') == 0
+    assert LightsManager_v2.get_transmitter(config) is first
+    # two channels at two pulse lengths, 10 repeats of 24 bits and a sync each
+    assert len(first.backend.edges(11)) >= 2 * 2 * 10 * 50
+
+
+def test_send_failures_are_reported(config, monkeypatch):
+    def broken(config):
+        raise RuntimeError('no GPIO here')
+    monkeypatch.setattr(LightsManager_v2, 'get_transmitter', broken)
+    reply = LightsManager_v2.set_channels(config, {'command': 'set', 'channel': 'porch', 'state': 'off'})
+    assert reply['error'] == '2 frames failed to send'
+    assert 'latency_ms' not in reply
+
+
+def verify_config(tmp_path, confirmations):
+    obj = {
+        "location": {"latitude": 39.63, "longitude": -119.9},
+        "radio": {"lock": str(tmp_path / 'radio.lock')},
+        "lights": {"txpin": 11, "pulse": {"start": 184, "end": 186},
+                   "state_file": str(tmp_path / 'state.json'), "channels": CHANNELS,
+                   "verify": {"rxpin": 13, "confirmations": confirmations,
+                              "stats_file": str(tmp_path / 'verify.json')}},
+    }
+    return lightsconfig.compile_config(obj)
+
+
+def test_one_verifier_for_concurrent_sweeps(config, tmp_path):
+    import threading
+    config = verify_config(tmp_path, 2)
+    verifiers = []
+    threads = [threading.Thread(target=lambda: verifiers.append(LightsManager_v2.get_verifier(config)))
+               for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(map(id, verifiers))) == 1
+    for verifier in verifiers:
+        LightsManager_v2.release_verifier(verifier)
+    assert not LightsManager_v2.VERIFIER_USERS
+    verifiers[0].stop()
+
+
+def test_reload_waits_for_the_verifier_in_use(config, tmp_path):
+    (before, after) = (verify_config(tmp_path, 2), verify_config(tmp_path, 3))
+    busy = LightsManager_v2.get_verifier(before)
+    # a sweep is still listening: the reloaded settings do not stop it under it
+    same = LightsManager_v2.get_verifier(after)
+    assert same is busy and busy.receiver.receiverInterrupt == 13
+    LightsManager_v2.release_verifier(same)
+    LightsManager_v2.release_verifier(busy)
+    replaced = LightsManager_v2.get_verifier(after)
+    assert replaced is not busy and replaced.confirmations == 3
+    assert busy.receiver.receiverInterrupt == -1
+    LightsManager_v2.release_verifier(replaced)
+    replaced.stop()
+
+
+def test_next_day_starts_after_local_midnight():
+    now = time.mktime((2024, 6, 21, 22, 30, 0, 0, 0, -1))
+    when = LightsManager_v2.next_day(now)
+    assert time.localtime(when)[:6] == (2024, 6, 22, 0, 1, 0)
+    assert LightsManager_v2.next_day(when) - when == pytest.approx(86400, abs=3600)
+
+
+def test_night_wait_takes_in_reloads(config, tmp_path, monkeypatch):
+    reloaded = verify_config(tmp_path, 1)
+    answers = [reloaded, None]
+    monkeypatch.setattr(LightsManager_v2, 'wait_until', lambda when, watcher: answers.pop(0))
+    assert LightsManager_v2.wait_for_day(config, watcher=object()) is reloaded
+    assert LightsManager_v2.SCHEDULE['config'] is reloaded
+    assert LightsManager_v2.SCHEDULE['next'] > time.time()
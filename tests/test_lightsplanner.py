@@ -0,0 +1,58 @@
+import lightsplanner
+
+CHANNELS = [{'name': 'channel%d' % (i + 1), 'on': 87347 + 144 * i, 'manage': True} for i in range(3)]
+PULSES = range(184, 188)
+
+
+class SteppingClock():
+    '''
+    Moves on `step` seconds every time it is read
+    '''
+    def __init__(self, step):
+        self.now = 0.0
+        self.step = step
+
+    def __call__(self):
+        self.now += self.step
+        return self.now
+
+
+def test_every_channel_keeps_a_frame_past_the_deadline():
+    airtime = lightsplanner.frame_airtime(184)
+    plan = lightsplanner.build_plan(CHANNELS, 'on', PULSES, 2, deadline=1.5 * airtime)
+    assert sorted(frame.channel for frame in plan) == [0, 1, 2]
+    assert plan.dropped == 3 * len(PULSES) * 2 - 3
+
+
+def test_late_frames_are_not_send_errors():
+    plan = lightsplanner.build_plan(CHANNELS, 'on', PULSES, 2, deadline=60.0)
+    plan.deadline = 0.5
+    errors = lightsplanner.execute_plan(plan, lambda frame: True, clock=SteppingClock(0.2), sleep=lambda wait: None)
+    assert errors == 0
+    assert sum(plan.sent.values()) + sum(plan.late.values()) == len(plan)
+    assert sum(plan.late.values()) > 0
+    assert plan.unsent() == []
+
+
+def test_last_frame_of_an_unsent_channel_goes_out_after_the_deadline():
+    plan = lightsplanner.build_plan(CHANNELS, 'on', PULSES, 2, deadline=60.0)
+    plan.deadline = 0.5
+    sent = []
+
+    def send(frame):
+        sent.append(frame)
+        return frame.channel != 2 or len([f for f in sent if f.channel == 2]) > 1
+    # the first frame of channel 3 fails, and the deadline passes before its next one
+    errors = lightsplanner.execute_plan(plan, send, clock=SteppingClock(0.1), sleep=lambda wait: None)
+    assert errors == 1
+    assert plan.sent[2] == 1
+    assert sent[-1] == [frame for frame in plan if frame.channel == 2][-1]
+    assert plan.unsent() == []
+
+
+def test_channels_with_every_frame_failed_are_unsent():
+    plan = lightsplanner.build_plan(CHANNELS, 'on', PULSES, 1)
+    errors = lightsplanner.execute_plan(plan, lambda frame: frame.channel != 1, sleep=lambda wait: None)
+    assert errors == len(PULSES)
+    assert plan.unsent() == [1]
+    assert not plan.late
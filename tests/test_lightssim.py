@@ -0,0 +1,44 @@
+import datetime
+
+import pytest
+
+import actuationqueue
+import lightssim
+import lightsschedule
+import sunevents
+
+SVALBARD = {'latitude': 78.2, 'longitude': 15.6}
+
+
+def test_polar_days_keep_the_state_of_the_sun():
+    for (date, state) in ((datetime.date(2024, 6, 21), 'on'), (datetime.date(2024, 12, 21), 'off')):
+        results = sunevents.as_results(sunevents.compute_day(date, SVALBARD['latitude'], SVALBARD['longitude']))
+        timeline = lightsschedule.sun_timeline(results)
+        assert len(timeline) == 0
+        assert timeline.state_at(0) == state
+
+
+def test_simulation_actuates_through_the_debounce_queue():
+    config = dict(lightssim.DEFAULT_CONFIG, location=SVALBARD)
+    tz = datetime.timezone(datetime.timedelta(hours=2))
+    (log, polar, queue) = lightssim.simulate(config, datetime.date(2024, 6, 20), 3, tz)
+    assert polar == {'day': 3}
+    assert queue['pending'] == 0 and queue['actuated'] > 0
+    changes = lightssim.actuations(log)
+    # the sun does not set: the channel following it is switched on once, a window after the first run
+    assert [state for (when, name, state) in changes if name == 'primary'] == ['on']
+    first = datetime.datetime.combine(datetime.date(2024, 6, 20), datetime.time(0, 5), tz).timestamp()
+    assert min(when for (when, name, state, code, pulse_len) in log) == first + actuationqueue.DEFAULT_WINDOW
+
+
+def test_failed_simulation_removes_its_state_directory(tmp_path, monkeypatch):
+    monkeypatch.setattr(lightssim.tempfile, 'tempdir', str(tmp_path))
+
+    def broken(*args, **kwargs):
+        raise RuntimeError('schedule failed')
+    monkeypatch.setattr(lightssim.LightsManager_v2, 'run_schedule', broken)
+    config = dict(lightssim.DEFAULT_CONFIG, location=SVALBARD)
+    with pytest.raises(RuntimeError):
+        lightssim.simulate(config, datetime.date(2024, 6, 20), 1)
+    assert list(tmp_path.iterdir()) == []
+    assert 'queue' not in lightssim.LightsManager_v2.SCHEDULE
@@ -0,0 +1,113 @@
+import itertools
+
+import pytest
+
+import gpiobackend
+import rcswitch
+
+
+def rc_switch_a(group, switch, status):
+    '''
+    rc-switch's getCodeWordA: a DIP switch that is on ('1') pulls its
+    address line low ('0'), one that is off leaves it floating ('F')
+    '''
+    code = ['FFFFF', '0FFFF', 'F0FFF', 'FF0FF', 'FFF0F', 'FFFF0']
+    return ''.join('F' if dip == '0' else '0' for dip in group) + code[switch] + ('0F' if status else 'F0')
+
+
+def rc_switch_b(address, channel, status):
+    '''
+    rc-switch's getCodeWordB: two rotary switches, one 'F'-padded 1-of-4
+    code each
+    '''
+    code = ['FFFF', '0FFF', 'F0FF', 'FF0F', 'FFF0']
+    return code[address] + code[channel] + 'FFF' + ('F' if status else '0')
+
+
+def rc_switch_c(family, group, device, status):
+    '''
+    rc-switch's getCodeWordC: family, then device and group, each shifted
+    out least significant bit first
+    '''
+    word = ''
+    number = ord(family) - ord('a')
+    for n in range(4):
+        word += 'F' if number & 1 else '0'
+        number >>= 1
+    for number in (device - 1, group - 1):
+        for n in range(2):
+            word += 'F' if number & 1 else '0'
+            number >>= 1
+    return word + '0FF' + ('F' if status else '0')
+
+
+@pytest.mark.parametrize('status', (True, False))
+def test_type_a_matches_rc_switch(status):
+    for dips in itertools.product('01', repeat=5):
+        group = ''.join(dips)
+        for switch in range(1, 6):
+            assert rcswitch.codeWords()[('A', group, switch, status)].triState == rc_switch_a(group, switch, status)
+
+
+@pytest.mark.parametrize('status', (True, False))
+def test_type_b_matches_rc_switch(status):
+    for address in range(1, 5):
+        for channel in range(1, 5):
+            assert rcswitch.codeWords()[('B', address, channel, status)].triState == rc_switch_b(address, channel, status)
+
+
+@pytest.mark.parametrize('status', (True, False))
+def test_type_c_matches_rc_switch(status):
+    for family in 'abcdefghijklmnop':
+        for group in range(1, 5):
+            for device in range(1, 5):
+                word = rcswitch.codeWords()[('C', family, group, device, status)].triState
+                assert word == rc_switch_c(family, group, device, status)
+
+
+@pytest.mark.parametrize('key,word', [
+    (('A', '11001', 2, True), '00FF0F0FFF0F'),
+    (('A', '00000', 5, False), 'FFFFFFFFF0F0'),
+    (('B', 1, 2, True), '0FFFF0FFFFFF'),
+    (('B', 4, 4, False), 'FFF0FFF0FFF0'),
+    (('C', 'a', 1, 1, True), '000000000FFF'),
+    # device 2 of group 1 is address 0b0001, sent LSB first; the Python 2
+    # table sent it MSB first as 000F
+    (('C', 'a', 1, 2, True), '0000F0000FFF'),
+    (('C', 'c', 3, 1, False), '0F00000F0FF0'),
+])
+def test_known_code_words(key, word):
+    assert rcswitch.codeWords()[key].triState == word
+
+
+def test_table_size():
+    kinds = [key[0] for key in rcswitch.codeWords()]
+    assert (kinds.count('A'), kinds.count('B'), kinds.count('C')) == (320, 32, 512)
+
+
+def test_code_words_go_out_as_two_bits_per_symbol():
+    word = rcswitch.codeWords()[('C', 'a', 1, 2, True)]
+    assert (word.code, word.length) == (int('000000000100000000010101', 2), 24)
+    assert rcswitch.triStateCode('0F1') == (0b000111, 6)
+
+
+def test_switch_on_sends_the_table_word():
+    backend = gpiobackend.SimulatedBackend(capacity=10000)
+    switch = rcswitch.RCSwitch(transmitterPin=11, pulseLength=350, repeatTransmit=1, backend=backend)
+    switch.enableTransmit(11)
+    switch.switchOn(family='a', group=1, device=2)
+    word = rcswitch.codeWords()[('C', 'a', 1, 2, True)]
+    # one frame: two edges per bit and a sync pair; the last low runs into the idle line
+    durations = backend.durations_us()
+    assert len(durations) == 2 * word.length + 1
+    bits = ''.join('0' if durations[n] < durations[n + 1] else '1' for n in range(0, 2 * word.length, 2))
+    assert bits == format(word.code, '024b')
+
+
+def test_unknown_code_words_are_refused():
+    switch = rcswitch.RCSwitch(backend=gpiobackend.SimulatedBackend())
+    with pytest.raises(ValueError):
+        switch.codeWord(True, family='q', group=1, device=1)
+    with pytest.raises(ValueError):
+        switch.codeWord(True, groupNumber=5, switchNumber=1)
+    assert switch.getCodeWordA('11111', 6, True) is None
@@ -0,0 +1,88 @@
+import random
+
+import pytest
+
+import rcswitch
+
+
+def dec2binWzerofill(dec, length):
+    '''
+    The original rcswitch.dec2binWzerofill, with its bytearray of bytes
+    turned into a list of characters so that it runs under Python 3
+    '''
+    binVal = ['\0'] * 64
+    i = 0
+    while dec > 0:
+        if dec & 1 > 0:
+            binVal[32+i] = '1'
+        else:
+            binVal[32+i] = '0'
+        i += 1
+        dec = dec >> 1
+    for j in range(length):
+        if j >= length - i:
+            binVal[j] = binVal[ 31 + i - (j - (length - i)) ]
+        else:
+            binVal[j] = '0'
+    binVal[length] = chr(0)
+    return ''.join(binVal[:length])
+
+
+def encoded(code, length):
+    return ''.join(map(str, rcswitch.encodeCode(code, length)))
+
+
+def samples(count=1000, seed=1):
+    '''
+    Random (code, length) pairs within the old function's 32 bit buffer:
+    codes that fit with room to spare, codes that need every bit of the
+    length and codes too wide for it
+    '''
+    rng = random.Random(seed)
+    for n in range(count):
+        length = rng.randint(0, 31)
+        width = rng.choice((rng.randint(0, length), length, rng.randint(length + 1, 32)))
+        yield (rng.getrandbits(width) | (1 << width - 1 if width else 0), length)
+
+
+@pytest.mark.parametrize('code,length', list(samples()))
+def test_encode_code_matches_the_old_conversion(code, length):
+    assert encoded(code, length) == dec2binWzerofill(code, length)
+    assert rcswitch.dec2binWzerofill(code, length) == dec2binWzerofill(code, length)
+
+
+def test_zero_length_encodes_nothing():
+    for code in (0, 1, 87347, 2**32 - 1):
+        assert rcswitch.encodeCode(code, 0) == ()
+        assert dec2binWzerofill(code, 0) == ''
+
+
+def test_code_needing_the_full_width_keeps_its_top_bit():
+    assert encoded(0b100000000000000000000001, 24) == '100000000000000000000001'
+    assert encoded(2**24 - 1, 24) == '1' * 24
+    assert encoded(2**31, 32) == '1' + '0' * 31
+
+
+def test_code_too_wide_keeps_its_low_bits():
+    assert encoded(0b1011, 2) == '11'
+    assert encoded(2**24 + 5, 24) == '0' * 21 + '101'
+    assert encoded(2**24 + 5, 24) == dec2binWzerofill(2**24 + 5, 24)
+
+
+def test_wide_codes_match_format():
+    rng = random.Random(2)
+    for n in range(2000):
+        (length, code) = (rng.randint(33, 80), rng.getrandbits(rng.randint(0, 90)))
+        assert encoded(code, length) == format(code & ((1 << length) - 1), '0%db' % length)
+
+
+def test_negative_values_are_rejected():
+    with pytest.raises(ValueError):
+        rcswitch.encodeCode(-1, 24)
+    with pytest.raises(ValueError):
+        rcswitch.encodeCode(1, -1)
+
+
+def test_encode_codes_encodes_each_code():
+    codes = [87347, 87491, 87347, 0]
+    assert rcswitch.encodeCodes(codes, 24) == [rcswitch.encodeCode(code, 24) for code in codes]
@@ -0,0 +1,104 @@
+import time
+
+import pytest
+
+import gpiobackend
+import rcswitch
+from rcswitch import RCSwitch
+
+CODE = 87347
+
+
+def receive(frames, protocol=1):
+    '''
+    Feed the edges of `frames`, (code, pulse length) pairs sent back to
+    back in `protocol`, to a receiver's interrupt handler; returns the
+    receiver
+    '''
+    receiver = RCSwitch(backend=gpiobackend.SimulatedBackend())
+    receiver.setProtocol(protocol)
+    decoded = []
+    receiver.setReceiveCallback(lambda value, bits, delay, protocol: decoded.append((value, delay, protocol)))
+    stamp = 1000000
+    receiver.lastTime = stamp
+    for (code, pulse_len) in frames:
+        for (high, low) in receiver.waveform(code, 24, pulse_len):
+            receiver.handleInterrupt(stamp)
+            stamp += high * 1000
+            receiver.handleInterrupt(stamp)
+            stamp += low * 1000
+    # the next edge, whenever it comes, ends the last sync gap
+    receiver.handleInterrupt(stamp)
+    receiver.decoded = decoded
+    return receiver
+
+
+def test_one_frame_is_not_enough():
+    assert receive([(CODE, 185)]).receivedCount == 0
+
+
+def test_first_repeat_is_decoded():
+    receiver = receive([(CODE, 185)] * 2)
+    assert receiver.receivedCount == 1
+    assert receiver.getReceivedValue() == CODE
+    assert receiver.getReceivedBitLength() == 24
+
+
+def test_every_second_gap_decodes():
+    assert receive([(CODE, 185)] * 10).receivedCount == 5
+
+
+def test_gap_of_another_length_starts_over():
+    # the sync gap is 31 pulses: 5.7 ms at 185 us, 10.8 ms at 350 us
+    receiver = receive([(CODE, 185), (CODE, 350), (CODE, 350)])
+    assert receiver.receivedCount == 1
+    assert receiver.decoded[0][0] == CODE
+    assert abs(receiver.decoded[0][1] - 350) < 10
+
+
+@pytest.mark.parametrize('protocol', [2, 3, 5, 6])
+@pytest.mark.parametrize('code', [CODE, 1, 0b101010101010101010101010, 2**24 - 1])
+def test_round_trip(protocol, code):
+    pulse_len = rcswitch.PROTOCOLS[protocol].pulseLength
+    receiver = receive([(code, pulse_len)] * 4, protocol)
+    assert receiver.receivedCount == 2
+    for (value, delay, decoded) in receiver.decoded:
+        assert (value, decoded) == (code, protocol)
+        assert abs(delay - pulse_len) < pulse_len * 0.05
+    assert receiver.getReceivedBitLength() == 24
+
+
+@pytest.mark.parametrize('protocol', [2, 3, 5, 6])
+def test_round_trip_off_the_nominal_pulse_length(protocol):
+    pulse_len = int(rcswitch.PROTOCOLS[protocol].pulseLength * 1.1)
+    receiver = receive([(CODE, pulse_len)] * 2, protocol)
+    assert receiver.decoded == [(CODE, pytest.approx(pulse_len, abs=pulse_len * 0.05), protocol)]
+
+
+def test_protocol_4_is_send_only():
+    # its 6 pulse sync gap is under the separation limit at the usual pulse lengths
+    assert receive([(CODE, 380)] * 4, 4).receivedCount == 0
+    # long enough pulses make the gap a sync gap again
+    receiver = receive([(CODE, 750)] * 2, 4)
+    assert [(value, protocol) for (value, delay, protocol) in receiver.decoded] == [(CODE, 4)]
+
+
+def test_inverted_protocol_round_trips_through_the_pins():
+    backend = gpiobackend.SimulatedBackend(capacity=100000)
+    backend.connect(11, 13)
+    sender = RCSwitch(transmitterPin=11, repeatTransmit=4, backend=backend)
+    sender.setProtocol(6)
+    sender.enableTransmit(11)
+    receiver = RCSwitch(backend=backend)
+    receiver.enableReceive(13)
+    try:
+        sender.send(CODE, 24)
+        deadline = time.monotonic() + 5.0
+        while receiver.receivedCount < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        receiver.disableReceive()
+    # idle is high: the line starts with a falling edge
+    assert backend.edges(11)[0][1] == gpiobackend.LOW
+    assert receiver.getReceivedValue() == CODE
+    assert receiver.getReceivedProtocol() == 6
@@ -0,0 +1,36 @@
+import json
+import sys
+import threading
+
+import pytest
+
+numpy = pytest.importorskip('numpy')
+
+import gpiobackend
+import rcswitch
+import rfcapture
+
+
+def test_json_lists_events_and_counts_transmissions(tmp_path, monkeypatch, capsys):
+    capture = str(tmp_path / 'capture.u32')
+    rfcapture.generate(capture, 30)
+    monkeypatch.setattr(sys, 'argv', ['rfcapture.py', capture, '--json'])
+    assert rfcapture.main() == 0
+    stats = json.loads(capsys.readouterr().out)
+    assert stats['transmissions'] == len(stats['events']) > 0
+    assert set(event['code'] for event in stats['events']) <= {87347, 87356, 87491, 87500}
+
+
+def test_record_keeps_up_while_frames_arrive(tmp_path):
+    backend = gpiobackend.SimulatedBackend(capacity=100000)
+    backend.connect(11, 13)
+    sender = rcswitch.RCSwitch(transmitterPin=11, pulseLength=185, repeatTransmit=4, backend=backend)
+    sender.enableTransmit(11)
+    capture = str(tmp_path / 'capture.u32')
+    thread = threading.Timer(0.05, lambda: sender.send(87347, 24))
+    thread.start()
+    (written, lost) = rfcapture.record(capture, 13, 0.3, backend=backend)
+    thread.join()
+    assert (written, lost) == (4 * 50 - 1, 0)
+    frames = rfcapture.decode(rfcapture.load(capture), 60)
+    assert set(int(value) for value in frames['value']) == {87347}
@@ -0,0 +1,122 @@
+import pytest
+
+import rfpolicy
+
+PULSES = [183, 184, 185, 186, 187]
+
+
+@pytest.fixture
+def policy():
+    return rfpolicy.RetransmitPolicy(state_file=None, min_retransmit=1, streak=3, target=0.9)
+
+
+def succeed(policy, name, count, retransmit=6):
+    for n in range(count):
+        policy.outcome(name, True, retransmit)
+
+
+def test_unknown_channel_gets_the_global_settings(policy):
+    assert policy.candidates('porch', PULSES, 6) == (PULSES, 6)
+
+
+def test_success_streak_drops_one_repeat_at_a_time(policy):
+    succeed(policy, 'porch', 2)
+    assert policy.candidates('porch', PULSES, 6)[1] == 6
+    succeed(policy, 'porch', 1)
+    assert policy.candidates('porch', PULSES, 6)[1] == 5
+    succeed(policy, 'porch', 3 * 10)
+    assert policy.candidates('porch', PULSES, 6)[1] == 1
+
+
+def test_rate_under_the_target_keeps_the_repeats(policy):
+    policy.outcome('porch', False, 6)
+    succeed(policy, 'porch', 3)
+    # one miss weighs 0.8 ** 3 = 0.51 three sweeps on: a 0.49 rate
+    assert policy.channels['porch'].rate < policy.target
+    assert policy.candidates('porch', PULSES, 6)[1] == 6
+
+
+def test_miss_goes_back_to_the_maximum_and_sets_a_floor(policy):
+    succeed(policy, 'porch', 3 * 5)
+    assert policy.candidates('porch', PULSES, 6)[1] == 1
+    policy.outcome('porch', False, 6)
+    state = policy.channels['porch']
+    assert (state.retransmit, state.floor, state.wide) == (6, 2, True)
+    # back down, but not under one repeat over the count that failed
+    succeed(policy, 'porch', rfpolicy.FLOOR_STREAK - 5)
+    assert policy.candidates('porch', PULSES, 6)[1] == 2
+    succeed(policy, 'porch', 5)
+    assert policy.channels['porch'].floor is None
+    succeed(policy, 'porch', 3)
+    assert policy.candidates('porch', PULSES, 6)[1] == 1
+
+
+def test_bounds_clamp_the_repeats():
+    policy = rfpolicy.RetransmitPolicy(state_file=None, min_retransmit=2, max_retransmit=4)
+    assert policy.candidates('porch', PULSES, 10)[1] == 4
+    assert policy.candidates('porch', PULSES, 1)[1] == 2
+    policy.outcome('porch', False, 10)
+    assert policy.channels['porch'].retransmit == 4
+
+
+def test_hits_go_first_best_first(policy):
+    for (pulse_len, heard) in ((186, True), (186, True), (184, True), (184, False), (183, False)):
+        policy.observe('porch', pulse_len, heard)
+    policy.outcome('porch', True, 6)
+    # 186 always heard, 184 at 0.8; 185 and 187 untried go before 183 that missed
+    assert policy.candidates('porch', PULSES, 6, verified=True)[0] == [186, 184, 185, 187, 183]
+
+
+def test_blind_sweeps_send_only_the_hits(policy):
+    policy.observe('porch', 185, True)
+    policy.outcome('porch', True, 6)
+    assert policy.candidates('porch', PULSES, 6) == ([185], 6)
+
+
+def test_blind_sweeps_send_at_least_min_pulses():
+    policy = rfpolicy.RetransmitPolicy(state_file=None, min_pulses=3)
+    policy.observe('porch', 185, True)
+    policy.observe('porch', 183, False)
+    policy.outcome('porch', True, 6)
+    assert policy.candidates('porch', PULSES, 6)[0] == [185, 184, 186]
+
+
+def test_wide_after_a_miss_sends_the_full_range(policy):
+    policy.observe('porch', 185, True)
+    policy.outcome('porch', False, 6)
+    assert policy.candidates('porch', PULSES, 6) == (PULSES, 6)
+    policy.outcome('porch', True, 6)
+    assert policy.candidates('porch', PULSES, 6) == ([185], 6)
+
+
+def test_record_sweep_observes_and_accounts_each_channel(policy):
+    names = {0: 'porch', 1: 'hall'}
+    results = [(0, 183, False), (0, 184, True), (1, 183, False), (1, 184, False)]
+    policy.record_sweep(names, results, confirmed={0}, retransmit=6)
+    assert policy.channels['porch'].pulses == {'183': 0.0, '184': 1.0}
+    assert (policy.channels['porch'].streak, policy.channels['hall'].wide) == (1, True)
+
+
+def test_overrides_cover_the_given_channels(policy):
+    names = ['porch', 'hall', 'garage']
+    policy.observe('hall', 187, True)
+    policy.outcome('hall', True, 6)
+    assert policy.overrides(names, [1, 2], PULSES, 6) == {1: ([187], 6), 2: (PULSES, 6)}
+
+
+def test_as_dict_counts_the_frames_saved(policy):
+    policy.observe('hall', 187, True)
+    succeed(policy, 'hall', 3)
+    stats = policy.as_dict(['porch', 'hall'], PULSES, 6)
+    assert stats['channels']['hall']['frames'] == 5
+    assert (stats['frames'], stats['frames_global']) == (5 * 6 + 5, 2 * 5 * 6)
+
+
+def test_state_survives_a_restart(tmp_path):
+    state_file = str(tmp_path / 'policy.json')
+    policy = rfpolicy.RetransmitPolicy(state_file=state_file)
+    policy.observe('porch', 185, True)
+    succeed(policy, 'porch', 3)
+    assert policy.save()
+    again = rfpolicy.RetransmitPolicy(state_file=state_file)
+    assert again.candidates('porch', PULSES, 6) == policy.candidates('porch', PULSES, 6) == ([185], 5)
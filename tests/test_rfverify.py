@@ -0,0 +1,85 @@
+import threading
+import time
+
+import pytest
+
+import gpiobackend
+import lightsplanner
+import rcswitch
+import rfverify
+
+CHANNELS = [{'name': 'porch', 'on': 87347, 'manage': True}]
+
+
+def frame(code=87347, channel=0, pulse_len=185):
+    return lightsplanner.Frame(0.0, channel, code, pulse_len, 0.05)
+
+
+def test_failed_send_stops_counting_its_code():
+    verifier = rfverify.TransmitVerifier(27, listen=0.01, stats_file=None,
+                                         backend=gpiobackend.SimulatedBackend())
+    sweep = verifier.sweep(CHANNELS)
+    send = sweep.wrap(lambda frame: False)
+    assert send(frame()) is False
+    assert verifier.heard == {}
+    assert sweep.attempts[0] == 0
+
+
+def test_send_raising_stops_counting_its_code():
+    verifier = rfverify.TransmitVerifier(27, listen=0.01, stats_file=None,
+                                         backend=gpiobackend.SimulatedBackend())
+
+    def broken(frame):
+        raise OSError('radio gone')
+    send = verifier.sweep(CHANNELS).wrap(broken)
+    with pytest.raises(OSError):
+        send(frame())
+    assert verifier.heard == {}
+
+
+def test_looped_back_frame_is_heard():
+    backend = gpiobackend.SimulatedBackend(capacity=100000)
+    backend.connect(17, 27)
+    verifier = rfverify.TransmitVerifier(27, listen=0.5, stats_file=None, backend=backend).start()
+    switch = rcswitch.RCSwitch(backend=backend)
+    try:
+        with switch.session(17) as session:
+            sweep = verifier.sweep(CHANNELS)
+            send = sweep.wrap(lambda frame: session.send(frame.code, lightsplanner.DEFAULT_BITS,
+                                                         frame.pulse_len) or True)
+            assert send(frame()) is True
+    finally:
+        verifier.stop()
+    assert sweep.confirmed == {0}
+    assert sweep.results == [(0, 185, True)]
+    assert verifier.heard == {}
+
+
+def test_sweeps_of_the_same_channel_count_separately():
+    verifier = rfverify.TransmitVerifier(27, confirmations=2, listen=2.0, stats_file=None,
+                                         backend=gpiobackend.SimulatedBackend())
+    (first, second) = (verifier.expect(87347), verifier.expect(87347))
+    assert first != second
+    verifier.received(87347, 24, 185, 1)
+    assert not verifier.wait(first, timeout=0.01)
+    # the first sweep giving up leaves the second one's count alone
+    verifier.received(87347, 24, 185, 1)
+    assert verifier.heard == {second: 2}
+    assert verifier.wait(second, timeout=0.01)
+    assert verifier.heard == {}
+
+
+def test_concurrent_waits_on_one_code_all_return():
+    verifier = rfverify.TransmitVerifier(27, confirmations=1, listen=2.0, stats_file=None,
+                                         backend=gpiobackend.SimulatedBackend())
+    keys = [verifier.expect(87347) for n in range(4)]
+    results = {}
+    threads = [threading.Thread(target=lambda key=key: results.update({key: verifier.wait(key)}))
+               for key in keys]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.05)
+    verifier.received(87347, 24, 185, 1)
+    for thread in threads:
+        thread.join(5.0)
+    assert results == dict((key, True) for key in keys)
@@ -0,0 +1,89 @@
+import os
+
+import pytest
+
+import runlock
+
+
+@pytest.fixture
+def lockfile(tmp_path):
+    return str(tmp_path / 'test.lock')
+
+
+@pytest.fixture
+def socket_name(tmp_path):
+    # abstract sockets are shared by the whole host: keep the name unique
+    return 'runlock-test-%d-%s' % (os.getpid(), tmp_path.name)
+
+
+def test_second_holder_is_refused_until_release(lockfile):
+    (first, second) = (runlock.RunLock(lockfile), runlock.RunLock(lockfile))
+    assert first.acquire()
+    try:
+        assert not second.acquire()
+        assert second.fd is None
+    finally:
+        assert first.release() == 0
+    assert second.acquire()
+    assert second.release() == 0
+
+
+def test_pid_is_rewritten_whole(lockfile):
+    with open(lockfile, 'wb') as handle:
+        handle.write(b'123456789012345\ntrailing junk\n')
+    with runlock.RunLock(lockfile) as lock:
+        assert lock.acquire()
+        assert lock.holder() == os.getpid()
+        with open(lockfile, 'rb') as handle:
+            assert handle.read() == runlock.PID_FORMAT % os.getpid()
+
+
+def test_holder_of_a_missing_or_empty_file_is_none(lockfile):
+    assert runlock.RunLock(lockfile).holder() is None
+    open(lockfile, 'wb').close()
+    assert runlock.RunLock(lockfile).holder() is None
+
+
+def test_requests_reach_the_holder(lockfile, socket_name):
+    with runlock.RunLock(lockfile, socket_name) as lock:
+        assert lock.acquire()
+        assert lock.serve(lambda request: {'echo': request})
+        assert runlock.send(socket_name, {'command': 'status'}) == {'echo': {'command': 'status'}}
+    assert runlock.send(socket_name, {'command': 'status'}, timeout=0.5) is None
+
+
+def test_handler_errors_are_replied(lockfile, socket_name):
+    def broken(request):
+        raise ValueError('no such channel')
+    with runlock.RunLock(lockfile, socket_name) as lock:
+        assert lock.acquire()
+        lock.serve(broken)
+        assert runlock.send(socket_name, {}) == {'error': 'no such channel'}
+
+
+@pytest.mark.parametrize('uid', [os.geteuid() + 1, None])
+def test_other_users_are_refused(lockfile, socket_name, monkeypatch, uid):
+    handled = []
+    # None: SO_PEERCRED could not be read
+    monkeypatch.setattr(runlock, 'peer_uid', lambda conn: uid)
+    with runlock.RunLock(lockfile, socket_name) as lock:
+        assert lock.acquire()
+        lock.serve(handled.append)
+        assert runlock.send(socket_name, {'command': 'apply'}) == {'error': 'permission denied'}
+    assert handled == []
+
+
+def test_peer_uid_is_ours(lockfile, socket_name, monkeypatch):
+    uids = []
+    peer_uid = runlock.peer_uid
+    monkeypatch.setattr(runlock, 'peer_uid', lambda conn: uids.append(peer_uid(conn)) or uids[-1])
+    with runlock.RunLock(lockfile, socket_name) as lock:
+        assert lock.acquire()
+        lock.serve(lambda request: {})
+        assert runlock.send(socket_name, {}) == {}
+    assert uids == [os.geteuid()]
+
+
+def test_serving_needs_the_lock(lockfile, socket_name):
+    lock = runlock.RunLock(lockfile, socket_name)
+    assert not lock.serve(lambda request: {})
@@ -0,0 +1,114 @@
+import datetime
+import sqlite3
+import time
+
+import pytest
+
+import suncache
+import sunprovider
+from sunapi_standin import StandInServer
+
+pytest.importorskip('requests')
+
+LATITUDE = 39.63
+LONGITUDE = -119.9
+DATE = datetime.date(2024, 6, 21)
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def serve(**kwargs):
+        server = StandInServer(**kwargs).start()
+        servers.append(server)
+        return server
+    yield serve
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def provider(tmp_path):
+    providers = []
+
+    def provider(url, **kwargs):
+        # no prefetching: only the day asked for goes to the stand-in
+        kwargs.setdefault('prefetch_days', 0)
+        provider = sunprovider.SunTimesProvider(LATITUDE, LONGITUDE,
+                                                suncache.SunCacheStore(str(tmp_path / 'suncache.db')),
+                                                url=url, retries=0, **kwargs)
+        providers.append(provider)
+        return provider
+    yield provider
+    for provider in providers:
+        provider.close(wait=False)
+
+
+def test_answer_within_the_deadline_is_used(serve, provider):
+    server = serve(skew=60)
+    sun = provider(server.url, deadline=5.0)
+    results = sun.get(DATE)
+    assert results.get('source') != 'local'
+    assert sun.stats.as_dict()['flagged'] == 0
+    assert server.requests == 1
+
+
+def test_slow_api_falls_back_to_local_times(serve, provider):
+    server = serve(delay=2.0)
+    sun = provider(server.url, deadline=0.3, timeout=(1.0, 5.0))
+    start = time.monotonic()
+    results = sun.get(DATE)
+    elapsed = time.monotonic() - start
+    assert results == sun.local(DATE)
+    assert results['source'] == 'local'
+    assert elapsed < 1.0
+
+
+def test_skewed_answer_is_replaced_by_local_times(serve, provider):
+    server = serve(skew=900)
+    sun = provider(server.url, deadline=5.0, tolerance=300)
+    results = sun.get(DATE)
+    assert results == sun.local(DATE)
+    stats = sun.stats.as_dict()
+    assert (stats['checked'], stats['flagged'], stats['replaced']) == (1, 1, 1)
+    assert stats['max_seconds']['sunrise'] == pytest.approx(900, abs=1)
+    # the replacement is what gets cached
+    assert sun.cache.get(sun.location, DATE)['source'] == 'local'
+
+
+def test_skewed_answer_is_kept_when_only_flagging(serve, provider):
+    server = serve(skew=900)
+    sun = provider(server.url, deadline=5.0, tolerance=300, on_deviation='flag')
+    results = sun.get(DATE)
+    assert results.get('source') != 'local'
+    assert set(results['deviation']) == set(sunprovider.CHECKED_EVENTS)
+    assert sun.stats.as_dict()['replaced'] == 0
+
+
+def test_close_without_waiting_returns_immediately(serve, provider):
+    server = serve(delay=2.0)
+    sun = provider(server.url, deadline=0.1, timeout=(1.0, 5.0))
+    sun.get(DATE)
+    assert sun.inflight
+    start = time.monotonic()
+    sun.close(wait=False)
+    assert time.monotonic() - start < 0.5
+
+
+def test_close_without_waiting_releases_after_the_fetch(serve, provider, tmp_path):
+    server = serve(delay=0.5)
+    sun = provider(server.url, deadline=0.05, timeout=(1.0, 5.0))
+    assert sun.get(DATE)['source'] == 'local'
+    sun.close(wait=False)
+    sun.closing.join(5.0)
+    assert not sun.closing.is_alive()
+    assert not sun.inflight
+    with pytest.raises(sqlite3.ProgrammingError):
+        sun.cache.db.execute('SELECT 1')
+    # the late answer still reached the cache before it was closed
+    cache = suncache.SunCacheStore(str(tmp_path / 'suncache.db'))
+    try:
+        assert cache.get(sun.location, DATE) is not None
+    finally:
+        cache.close()
@@ -0,0 +1,103 @@
+import datetime
+
+import pytest
+
+import suncache
+
+HERE = '39.6300,-119.9000'
+THERE = '51.4769,-0.0005'
+DAY = datetime.date(2024, 6, 21)
+RESULTS = {'sunrise': '2024-06-21T12:31:00+00:00', 'sunset': '2024-06-22T03:28:00+00:00'}
+
+
+class Clock():
+    def __init__(self, now=1718900000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(suncache.time, 'time', clock.time)
+    return clock
+
+
+@pytest.fixture
+def store(tmp_path, clock):
+    stores = []
+
+    def store(ttl=3600):
+        store = suncache.SunCacheStore(str(tmp_path / 'suncache.db'), ttl=ttl)
+        stores.append(store)
+        return store
+    yield store
+    for store in stores:
+        store.close()
+
+
+def days(count):
+    return [(DAY + datetime.timedelta(days=n), dict(RESULTS, day=n)) for n in range(count)]
+
+
+def test_rows_expire_after_the_ttl(store, clock):
+    cache = store(ttl=3600)
+    assert cache.put(HERE, DAY, RESULTS)
+    clock.now += 3599
+    assert cache.get(HERE, DAY) == RESULTS
+    # the memo honours the expiry as well as the table
+    clock.now += 2
+    assert cache.get(HERE, DAY) is None
+    assert store(ttl=3600).get(HERE, DAY) is None
+
+
+def test_rows_are_keyed_by_location_and_date(store):
+    cache = store()
+    cache.put(HERE, DAY, RESULTS)
+    assert cache.get(THERE, DAY) is None
+    assert cache.get(HERE, DAY + datetime.timedelta(days=1)) is None
+    assert cache.locations() == [HERE]
+
+
+def test_put_many_stores_every_day(store):
+    cache = store()
+    assert cache.put_many(HERE, days(7))
+    other = store()
+    for (day, results) in days(7):
+        assert other.get(HERE, day) == results
+
+
+def test_put_many_replaces_rows_and_renews_them(store, clock):
+    cache = store(ttl=3600)
+    cache.put_many(HERE, days(3))
+    clock.now += 3000
+    cache.put_many(HERE, [(DAY, dict(RESULTS, day='again'))])
+    clock.now += 3000
+    assert cache.get(HERE, DAY)['day'] == 'again'
+    assert cache.get(HERE, DAY + datetime.timedelta(days=1)) is None
+    assert store().get(HERE, DAY)['day'] == 'again'
+
+
+def test_put_many_of_nothing_is_fine(store):
+    assert store().put_many(HERE, [])
+
+
+def test_failed_put_leaves_no_transaction_open(store):
+    cache = store()
+    cache.db.execute('DROP TABLE suntimes')
+    assert not cache.put_many(HERE, days(2))
+    assert not cache.db.in_transaction
+
+
+def test_purge_removes_only_expired_rows(store, clock):
+    cache = store(ttl=3600)
+    cache.put_many(HERE, days(2))
+    clock.now += 1800
+    cache.put(THERE, DAY, RESULTS)
+    clock.now += 1801
+    assert cache.purge() == 2
+    assert cache.locations() == [THERE]
+    assert cache.get(THERE, DAY) == RESULTS
+    assert cache.purge() == 0